@@ -0,0 +1,286 @@
+import numpy as np
+import threading
+import common
+import codec
+import time
+import os
+
+
+def _polling_client_class():
+    import client
+    class PollingClient(client.Client):
+        '''
+        "client.Client" with the status waits of the baseline client: the attribute set by the MQTT thread is polled,
+        every 1/100 s in "action_game" and every 0.1 s in "reset_game". The step itself is awaited with the same event.
+        '''
+        PERIODS = {'status_waiting_for_action': 1/100, 'status_initializing_game': 0.1}
+
+        def _wait_status(self, attr, timeout):
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not getattr(self, attr) and self.status != False:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError("No '{}' status from the server after {} s.".format(attr, timeout))
+                time.sleep(PollingClient.PERIODS[attr])
+            self._check_server()
+    return PollingClient
+
+
+def bench_wait_latency(steps=300, resets=3, tick_rate=0.0, timeout=60.0):
+    '''
+    Measure "client.Client.action_game" and "client.Client.reset_game" against a synthetic server (see synthetic.py) through the
+    in-process "loopback.LoopbackBroker": the baseline polling of the server status against the condition variable notified
+    by "Client._on_message" and the new step event.
+    Parameters:
+        steps (int): Number of actions per waiting strategy, spread over the episodes.
+        resets (int): Number of episodes per waiting strategy.
+        tick_rate (float): Ticks per second of the synthetic game. 0 run it as fast as possible.
+        timeout (float): Maximum time in seconds to wait for each server answer.
+    Returns:
+        An dict {strategy: {'step': latencies, 'reset': latencies}} in seconds (np.ndarray).
+    '''
+    import loopback
+    import server
+    import client
+    import synthetic
+    import scale_harness
+    broker  = loopback.LoopbackBroker()
+    manager = server.Manager(instance_id="00000000", broker=broker, backend=synthetic.SyntheticBackend(tick_rate=tick_rate, seed=0))
+    manager.set_mode(server.Manager.Mode.TRAINING)
+    threading.Thread(target=manager.loop, daemon=True).start()
+    game_setup = scale_harness.make_game_setup(max_step=steps + 1)
+    strategies = {
+        'polling (baseline)'    : _polling_client_class(),
+        'condition / event'     : client.Client,
+    }
+    results = {}
+    try:
+        for name, client_class in strategies.items():
+            instance = client_class(None, None, "00000000", broker=broker)
+            instance.start()
+            instance.wait_server(timeout)
+            step_latencies  = []
+            reset_latencies = []
+            for episode in range(resets):
+                instance.setup_game(game_setup)
+                start = time.perf_counter()
+                instance.reset_game(timeout)
+                reset_latencies.append(time.perf_counter() - start)
+                for _ in range(steps // resets):
+                    start = time.perf_counter()
+                    instance.action_game(True, False, 0.0, 0.0, False, False, False, timeout=timeout)
+                    step_latencies.append(time.perf_counter() - start)
+            instance.mqtt.disconnect()
+            results[name] = {'step': np.array(step_latencies), 'reset': np.array(reset_latencies)}
+    finally:
+        manager.close()
+    return results
+
+
+def _motion_sequence(frame, length, shift=1):
+    # Consecutive steps approximated by a frame scrolling a few pixels per step
+    return [np.roll(frame, idx*shift, axis=1) for idx in range(length)]
+
+
+def bench_frame_codecs(frames_path="../datas/img", repeat=5, jpeg_quality=90, sequence_length=10):
+    '''
+    Measure the encode / decode time of each frame codec against the bytes sent per step.
+    The reference track images (real game frames) are used as keyframes, each one followed by "sequence_length - 1"
+    scrolled copies to give the inter-frame codec (DELTA) correlated consecutive frames.
+    Parameters:
+        frames_path (str): Folder of the ".npy" frames (STEP_FRAME_SHAPE, uint8).
+        repeat (int): Number of passes over the frames.
+        jpeg_quality (int): Quality of the JPEG codec.
+        sequence_length (int): Number of consecutive frames generated from each reference frame.
+    Returns:
+        An dict {codec name: dict(encode, decode (seconds per frame), bytes (mean per frame), error (mean absolute pixel error))}.
+    '''
+    frames = []
+    for name in sorted(os.listdir(frames_path)):
+        frames += _motion_sequence(np.load(os.path.join(frames_path, name)), sequence_length)
+    results = {}
+    for codec_id in common.Server.FrameCodec:
+        # Inter-frame codecs are stateful: one encoder / decoder per pass, like a new client
+        try:
+            encoder     = codec.get_codec(codec_id, jpeg_quality, keyframe_interval=sequence_length)
+            payloads    = [encoder.encode(frame) for frame in frames]
+        except RuntimeError as e:
+            print("{:10s} : skipped ({})".format(codec_id.name, e))
+            continue
+        start = time.perf_counter()
+        for _ in range(repeat):
+            encoder     = codec.get_codec(codec_id, jpeg_quality, keyframe_interval=sequence_length)
+            payloads    = [encoder.encode(frame) for frame in frames]
+        encode = (time.perf_counter() - start) / (repeat*len(frames))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decoder = codec.get_codec(codec_id)
+            for payload in payloads:
+                decoder.decode(payload)
+        decode = (time.perf_counter() - start) / (repeat*len(frames))
+        decoder = codec.get_codec(codec_id)
+        error   = np.mean([np.mean(np.abs(frame.astype(np.int16) - decoder.decode(payload))) for frame, payload in zip(frames, payloads)])
+        results[codec_id.name] = {'encode': encode, 'decode': decode, 'bytes': np.mean([len(p) for p in payloads]), 'error': error}
+    return results
+
+
+def _naive_observation_chain(crop, size, stack):
+    # The usual chain of generic gym wrappers: each stage returns a new array, the stack is rebuilt at every step
+    import collections
+    import cv2
+    top, bottom, left, right = crop
+    history = collections.deque(maxlen=stack)
+    def observe(frame, first):
+        img = frame[top:bottom, left:right].copy()
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        img = cv2.resize(img, (size[1], size[0]), interpolation=cv2.INTER_AREA)[..., np.newaxis]
+        if first:
+            history.extend([img]*stack)
+        history.append(img)
+        return np.stack(history)
+    return observe
+
+
+def bench_observation_pipeline(frames_path="../datas/img", repeat=20, crop=(0, 128, 0, 128), size=(84, 84), stack=4):
+    '''
+    Measure the preprocessing time of a frame (crop, grayscale, resize, frame stacking):
+    "preprocessing.ObservationPipeline" against the equivalent chain of naive wrappers allocating new arrays at every stage.
+    Parameters:
+        frames_path (str): Folder of the ".npy" frames (STEP_FRAME_SHAPE, uint8).
+        repeat (int): Number of passes over the frames.
+        crop (tuple): Area (top, bottom, left, right) kept.
+        size (tuple): Size (height, width) of the observation.
+        stack (int): Number of stacked frames.
+    Returns:
+        An dict {strategy: seconds per frame}.
+    '''
+    import preprocessing
+    frames      = [np.load(os.path.join(frames_path, name)) for name in sorted(os.listdir(frames_path))]
+    pipeline    = preprocessing.ObservationPipeline(crop=crop, grayscale=True, size=size, stack=stack)
+    naive       = _naive_observation_chain(crop, size, stack)
+    # Same observations from both strategies
+    pipeline.reset(frames[0])
+    naive(frames[0], True)
+    for frame in frames[1:]:
+        if not np.array_equal(pipeline.step(frame), naive(frame, False)):
+            raise RuntimeError("The observation pipeline and the naive chain disagree.")
+    strategies = {
+        'naive wrappers'    : lambda frame, first: naive(frame, first),
+        'pipeline'          : lambda frame, first: pipeline.reset(frame) if first else pipeline.step(frame),
+    }
+    results = {}
+    for name, observe in strategies.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            observe(frames[0], True)
+            for frame in frames[1:]:
+                observe(frame, False)
+        results[name] = (time.perf_counter() - start) / (repeat*len(frames))
+    return results
+
+
+def bench_replay(frames_path="../datas/img", episodes=8, episode_length=500, batch_size=16, window_length=64, repeat=20):
+    '''
+    Measure the throughput of "gym_mk8.EnvMarioKart8Replay" on a recording generated from the reference frames.
+    Parameters:
+        frames_path (str): Folder of the ".npy" frames (STEP_FRAME_SHAPE, uint8).
+        episodes (int): Number of recorded episodes.
+        episode_length (int): Number of steps per episode.
+        batch_size (int): Number of windows per "sample_windows()".
+        window_length (int): Number of steps per window.
+        repeat (int): Number of "sample_windows()" calls.
+    Returns:
+        An dict {'record', 'replay' (steps per second), 'windows' (windows per second)}.
+    '''
+    import gym_mk8
+    import recorder
+    import tempfile
+    import types
+    frames  = [np.load(os.path.join(frames_path, name)) for name in sorted(os.listdir(frames_path))]
+    action  = np.zeros(7, dtype=np.float32)
+    # Stand-in for the "step_<name>" attributes of a client
+    client  = types.SimpleNamespace(**{'step_'+name: 0 for name in common.STEP_SCHEMA.names})
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        trajectories = recorder.TrajectoryRecorder(path, shard_size=1024)
+        for episode in range(episodes):
+            for step in range(episode_length):
+                last = step == episode_length - 1
+                trajectories.record(frames[step % len(frames)], None if step == 0 else action, 0.0, last, False, step == 0, client)
+        trajectories.close()
+        results['record'] = episodes*episode_length / (time.perf_counter() - start)
+        #
+        env = gym_mk8.EnvMarioKart8Replay(path, shuffle=False)
+        start = time.perf_counter()
+        for episode in range(episodes):
+            env.reset()
+            for step in range(episode_length - 1):
+                env.step(None)
+        results['replay'] = episodes*episode_length / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            env.sample_windows(batch_size, window_length)
+        results['windows'] = repeat*batch_size / (time.perf_counter() - start)
+    return results
+
+
+def bench_loopback_step(steps=2000, sequenced=False):
+    '''
+    Measure the round trip of "client.Client.action_game" through the in-process "loopback.LoopbackBroker":
+    the cost of the protocol (encode, dispatch, decode and wake up) without the broker and TCP.
+    The server is a "server.Server" answering each action with a PACKED step record and a raw frame, without game.
+    Parameters:
+        steps (int): Number of actions.
+        sequenced (bool): Use the sequenced step protocol (see "client.ClientProtocol").
+    Returns:
+        An dict {'latencies' (np.ndarray, seconds), 'messages' and 'bytes' (delivered by the broker per step)}.
+    '''
+    import loopback
+    import server
+    import client
+    broker  = loopback.LoopbackBroker()
+    frame   = bytes(np.zeros(common.STEP_FRAME_SHAPE, dtype=np.uint8))
+    root    = "Mario_Kart_8/00000000"
+    state   = {'no': 0}
+    def reply(mqtt_client, order):
+        if order[0] == common.Server.Order.ACTION:
+            state['no'] += 1
+            header = common.STEP_SCHEMA.pack_dict({'no': state['no'], 'seq': order[1][7], 'frame_codec': common.Server.FrameCodec.RAW})
+            mqtt_client.publish(root+"/step/record", payload=header+frame, qos=0 if order[1][7] != 0 else 1, retain=True)
+    responder = server.Server(server_callback=reply, instance_id="00000000", broker=broker)
+    responder.mqtt.publish(root+"/status/waiting_for_action", payload=common.STATUS_SCHEMA.pack_field('waiting_for_action', True), qos=1, retain=True)
+    responder.mqtt.loop_start()
+    instance = client.Client(None, None, "00000000", sequenced=sequenced, broker=broker)
+    instance.start()
+    instance.isReady.wait()
+    broker.reset_stats()
+    latencies = np.zeros(steps)
+    for idx in range(steps):
+        start = time.perf_counter()
+        instance.action_game(True, False, 0.0, 0.0, False, False, False, timeout=10.0)
+        latencies[idx] = time.perf_counter() - start
+    results = {'latencies': latencies, 'messages': broker.delivered_messages / steps, 'bytes': broker.delivered_bytes / steps}
+    instance.mqtt.disconnect()
+    responder.mqtt.loop_stop()
+    return results
+
+
+if __name__ == "__main__":
+    print("Client waits (action_game / reset_game against a synthetic server, loopback broker):")
+    for name, r in bench_wait_latency().items():
+        step = r['step'] * 1000.0
+        print("{:20s} : step p50 {:8.3f} ms | p99 {:8.3f} ms | reset p50 {:7.3f} s | max {:7.3f} s".format(name, np.percentile(step, 50), np.percentile(step, 99), np.percentile(r['reset'], 50), np.max(r['reset'])))
+    print("Frame codecs (per frame):")
+    for name, r in bench_frame_codecs().items():
+        print("{:10s} : encode {:8.3f} ms | decode {:8.3f} ms | {:8.0f} bytes ({:5.1f} %) | error {:6.3f}".format(name, r['encode']*1000.0, r['decode']*1000.0, r['bytes'], 100.0*r['bytes']/np.prod(common.STEP_FRAME_SHAPE), r['error']))
+    print("Observation pipeline (crop, grayscale, resize 84x84, stack 4, per frame):")
+    for name, duration in bench_observation_pipeline().items():
+        print("{:20s} : {:8.3f} us".format(name, duration*1e6))
+    print("Trajectories (windows of 64 steps):")
+    for name, rate in bench_replay().items():
+        print("{:10s} : {:12.0f} /s".format(name, rate))
+    print("Loopback step round trip (protocol without broker):")
+    for sequenced in (False, True):
+        r = bench_loopback_step(sequenced=sequenced)
+        latencies = r['latencies'] * 1e6
+        print("{:10s} : mean {:8.1f} us | p50 {:8.1f} us | p99 {:8.1f} us | {:4.1f} messages {:8.0f} bytes per step".format("sequenced" if sequenced else "qos 1", np.mean(latencies), np.percentile(latencies, 50), np.percentile(latencies, 99), r['messages'], r['bytes']))
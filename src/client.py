@@ -1,61 +1,112 @@
 import paho.mqtt.client as mqtt
-import numpy as np
+import concurrent.futures
 import threading
-import struct
+import warnings
+import frame_ring
+import asyncio
+import common
+import codec
 import time
 
 
-class Client(threading.Thread):
+class ServerLostError(RuntimeError):
     '''
-    Client to be used to communicate with the server via MQTT.
+    The server instance is dead (its "status" is False), e.g. the emulator crashed and is being relaunched by "server_launcher.ServerInstance".
+    '''
+    pass
+
+
+class ClientProtocol:
+    '''
+    Transport independent part of the client: the last step / status received from the server and the decoding of the MQTT messages.
+    Subclasses provide the MQTT connection ("self.mqtt") and the synchronisation primitives used to wait the server.
     '''
 
-    def __init__(self, host, port, target_id):
+    def __init__(self, target_id, sequenced=False, retransmit_timeout=0.5):
         '''
-        Instanciate one client instance.
-        Call "start()" to connect the client.
         Parameters:
-            host (str): IPv4 address of the MQTT server.
-            port (int): TCP/IP Port of the MQTT server.
             target_id (str): The id of the instance used to create the MQTT topic.
-        Returns:
-            An "Client" waiting to start.
+            sequenced (bool): Each action carries a sequence id echoed by its step reply. Actions and steps are sent with qos 0,
+                an action is sent again if its reply is not received after "retransmit_timeout" seconds, stale and duplicated replies are dropped.
+            retransmit_timeout (float): See "sequenced".
         '''
-        super().__init__()
-        #
-        self.isReady = threading.Event()
-        self.isReady.clear()
         self.target_id = target_id
-        self.mqtt = mqtt.Client()
-        self.mqtt.on_connect = self._on_connect
-        self.mqtt.on_message = self._on_message
-        self.mqtt.connect(host, port, 60)
+        self.sequenced = sequenced
+        self.retransmit_timeout = retransmit_timeout
         #
+        # One "step_<name>" attribute per field of common.STEP_SCHEMA (step_timer, step_speed, step_terminal, ...)
+        self._step_attrs = tuple('step_'+name for name in common.STEP_SCHEMA.names[1:])
         self.step_no = None
         self.step_frame = None
-        self.step_timer = None
-        self.step_speed = None
-        self.step_coins = None
-        self.step_status = None
-        self.step_rank = None
-        self.step_lap_continuous = None
-        self.step_lap_discrete = None
-        self.step_pos_x = None
-        self.step_pos_y = None
-        self.step_pos_z = None
-        self.step_towing = None
-        self.step_track = None
-        self.step_terminal = None
-        self.step_terminated_by_timeout = None
-        self.step_is_race_finish = None
+        self.step_frame_stale = False # The frame of the step could not be decoded, "step_frame" is the previous one
+        self.step_frame_shared = False # "step_frame" is a view on the shared memory ring, overwritten by the server a few steps later
+        for attr in self._step_attrs:
+            setattr(self, attr, None)
         self.status = None
         self.status_waiting_for_action = None
         self.status_initializing_game = None
         self.status_playing_game = None
         #
+        # Optional callable(client) called from "_on_message" each time a new step is received
+        self.callback_new_step = None
+        # Optional callable(client) called from "_on_message" when the server status becomes False
+        self.callback_server_lost = None
+        # Number of times the server came back after being lost
+        self.server_restarts = 0
+        #
         self._last_step = None
-        self._event_new_step = threading.Event()
-        self._event_new_step.clear()
+        self._pending_step = None # Future of the step in flight (see "Client.step_async")
+        self._frame_ring = None # Attached on the first record without frame (server in SHARED_MEMORY layout)
+        self._frame_codecs = {} # common.Server.FrameCodec -> decoder, created on first use
+        self._seq = 0
+        self._expected_seq = None # Sequence id of the action waiting its reply (sequenced mode)
+        self._last_action = None # Payload of this action, sent again on timeout
+        self._handlers = self._build_handlers()
+
+    def _build_handlers(self):
+        # Topic -> decoder table compiled once from the protocol schemas (see common.py)
+        root        = "Mario_Kart_8/"+self.target_id
+        handlers    = {}
+        handlers[root+"/step/record"]   = self._decode_step_record
+        handlers[root+"/step/frame"]    = self._decode_step_frame
+        handlers[root+"/step"]          = self._decode_step_no
+        for name in common.STEP_SCHEMA.names[1:]:
+            handlers[root+"/step/"+name] = self._field_decoder('step_'+name, common.STEP_SCHEMA.scalars[name])
+        handlers[root+"/status"] = self._decode_status
+        for name in common.STATUS_SCHEMA.names[1:]:
+            handlers[root+"/status/"+name] = self._status_decoder('status_'+name, common.STATUS_SCHEMA.scalars[name])
+        handlers[root+"/status/playing_game"] = self._decode_playing_game
+        return handlers
+
+    def _field_decoder(self, attr, scalar):
+        def decode(payload):
+            setattr(self, attr, scalar.unpack(payload)[0])
+        return decode
+
+    def _status_decoder(self, attr, scalar):
+        def decode(payload):
+            setattr(self, attr, scalar.unpack(payload)[0])
+            self._status_updated()
+        return decode
+
+    def _decode_playing_game(self, payload):
+        self.status_playing_game = common.STATUS_SCHEMA.unpack_field('playing_game', payload)
+        if not self.status_playing_game:
+            # A new server of the instance (e.g. after a restart) recreates the ring: attach again on the next game
+            self._drop_frame_ring()
+        self._status_updated()
+
+    def _drop_frame_ring(self):
+        if self._frame_ring is not None:
+            self._frame_ring.close()
+            self._frame_ring = None
+
+    def _status_updated(self):
+        '''
+        Called from "_on_message" each time a "status/<name>" value is received.
+        Hook for the subclasses to wake up their waits on the status, does nothing by default.
+        '''
+        pass
 
     def _on_connect(self, client, userdata, flags, rc):
         client.subscribe("Mario_Kart_8/"+self.target_id+"/step")
@@ -64,103 +115,248 @@ class Client(threading.Thread):
         client.subscribe("Mario_Kart_8/"+self.target_id+"/status/+")
 
     def _on_message(self, client, userdata, msg):
-        if msg.topic == "Mario_Kart_8/"+self.target_id+"/step":
-            self.step_no = struct.unpack('I', msg.payload)[0]
-            if self._last_step != self.step_no:
-                self._last_step = self.step_no
-                self._event_new_step.set()
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/timer":
-            self.step_timer = struct.unpack('i', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/speed":
-            self.step_speed = struct.unpack('f', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/coins":
-            self.step_coins = struct.unpack('i', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/status":
-            self.step_status = struct.unpack('i', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/rank":
-            self.step_rank = struct.unpack('i', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/lap_continuous":
-            self.step_lap_continuous = struct.unpack('f', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/lap_discrete":
-            self.step_lap_discrete = struct.unpack('B', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/pos_x":
-            self.step_pos_x = struct.unpack('f', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/pos_y":
-            self.step_pos_y = struct.unpack('f', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/pos_z":
-            self.step_pos_z = struct.unpack('f', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/towing":
-            self.step_towing = struct.unpack('B', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/track":
-            self.step_track = struct.unpack('i', msg.payload)[0]
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/frame":
-            image           = np.frombuffer(msg.payload, dtype=np.uint8)
-            image           = np.reshape(image, (128, 128, 3))
-            self.step_frame = image
-
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/terminal":
-            self.step_terminal = struct.unpack('B', msg.payload)[0]
+        handler = self._handlers.get(msg.topic)
+        if handler is not None:
+            handler(msg.payload)
+
+    def _signal_step(self, step_no):
+        self.step_no = step_no
+        if self._last_step != self.step_no:
+            self._last_step = self.step_no
+            self._event_new_step.set()
+            future, self._pending_step = self._pending_step, None
+            if future is not None:
+                future.set_result(step_no)
+            if self.callback_new_step is not None:
+                self.callback_new_step(self)
+
+    def _accept_step(self, step_no, seq):
+        # Sequenced mode: only the first reply to the last action is accepted, stale and duplicated replies are dropped
+        if self._expected_seq is None:
+            return True
+        return seq == self._expected_seq and step_no != self._last_step
+
+    def _decode_step_record(self, payload):
+        header = common.STEP_SCHEMA.unpack(payload)
+        if not self._accept_step(header[0], header[1]):
+            return
+        frame = None
+        if len(payload) == common.STEP_SCHEMA.size:
+            # The frame is in the shared memory ring of the server, "step_frame" is a view on it
+            try:
+                if self._frame_ring is None:
+                    self._frame_ring = frame_ring.FrameRing(self.target_id)
+                frame = self._frame_ring.frame(header[0])
+            except (FileNotFoundError, RuntimeError):
+                # Ring not created yet or stale (retained) record: keep the last step, frame flagged, and wait for the next one
+                self.step_frame_stale = True
+                return
+        for attr, value in zip(self._step_attrs, header[1:]):
+            setattr(self, attr, value)
+        if frame is not None:
+            self.step_frame_stale = False
+            self.step_frame_shared = True
+            self.step_frame = frame
+        else:
+            # Inline frame, encoded with the "frame_codec" of this record
+            self.step_frame_shared = False
+            self.step_frame = self._decode_frame(memoryview(payload)[common.STEP_SCHEMA.size:])
+        # The step number is set last: the whole record is available once the new step is signaled
+        self._signal_step(header[0])
+
+    def _decode_step_no(self, payload):
+        step_no = common.STEP_SCHEMA.unpack_field('no', payload)
+        if self._accept_step(step_no, self.step_seq):
+            self._signal_step(step_no)
+
+    def _decode_step_frame(self, payload):
+        self.step_frame = self._decode_frame(payload)
+
+    def _decode_frame(self, payload):
+        # Servers that predate the codecs send raw frames and no "frame_codec" field
+        codec_id = self.step_frame_codec if self.step_frame_codec is not None else common.Server.FrameCodec.RAW
+        decoder = self._frame_codecs.get(codec_id)
+        if decoder is None:
+            decoder = self._frame_codecs[codec_id] = codec.get_codec(codec_id)
+        frame = decoder.decode(payload)
+        if frame is None:
+            # Delta of a frame we don't have (missed or out-of-order step): keep the last frame, flagged, until the keyframe
+            self._publish_keyframe_request()
+            self.step_frame_stale = True
+            return self.step_frame
+        self.step_frame_stale = False
+        return frame
+
+    def _decode_status(self, payload):
+        status = common.STATUS_SCHEMA.unpack_field('status', payload)
+        if status == True:
+            if self.status == False:
+                self.server_restarts += 1
+            self.status = status
+            self.isReady.set()
+        else:
+            self.status = status
+            self.isReady.clear()
+            # The relaunched server starts again from step 0 and publishes its own statuses
+            self.status_waiting_for_action = None
+            self.status_initializing_game = None
+            self.status_playing_game = None
+            self._last_step = None
+            self._drop_frame_ring()
+            # Wake up the waits in progress, they raise "ServerLostError"
+            self._status_updated()
+            self._event_new_step.set()
+            future, self._pending_step = self._pending_step, None
+            if future is not None:
+                future.set_exception(ServerLostError("Server seem to be dead."))
+            if self.callback_server_lost is not None:
+                self.callback_server_lost(self)
+
+    def _encode_action(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, seq=0):
+        return common.ACTION_SCHEMA.pack(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, seq)
+
+    def _check_server(self):
+        if self.status != True:
+            raise ServerLostError("Server seem to be dead.")
 
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/terminated_by_timeout":
-            self.step_terminated_by_timeout = struct.unpack('B', msg.payload)[0]
+    def _publish_keyframe_request(self):
+        self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/keyframe", payload=None, qos=1, retain=False)
 
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/step/is_race_finish":
-            self.step_is_race_finish = struct.unpack('B', msg.payload)[0]
+    def _publish_reset(self):
+        self._expected_seq = None
+        self._last_action = None
+        # A step still in flight will never be waited
+        self._cancel_pending_step()
+        self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/reset", payload=None, qos=1, retain=False)
 
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/status":
-            self.status = struct.unpack('B', msg.payload)[0]
-            if self.status == True:
-                self.isReady.set()
+    def _cancel_pending_step(self):
+        future, self._pending_step = self._pending_step, None
+        if future is not None:
+            future.cancel()
+
+    def _publish_action(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift):
+        seq = 0
+        if self.sequenced:
+            self._seq = (self._seq % 0xFFFFFFFF) + 1
+            seq = self._seq
+        datas = self._encode_action(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, seq)
+        self._event_new_step.clear()
+        if self.sequenced:
+            self._expected_seq = seq
+            self._last_action = datas
+            self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/action", payload=datas, qos=0, retain=False)
+        else:
+            self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/action", payload=datas, qos=1, retain=False)
+
+    def _retransmit_action(self):
+        self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/action", payload=self._last_action, qos=0, retain=False)
+
+    def _retransmit_wait(self, deadline):
+        # Time to wait the reply before sending the action again (or raising at the deadline)
+        if deadline is None:
+            return self.retransmit_timeout
+        return max(0.0, min(self.retransmit_timeout, deadline - time.monotonic()))
 
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/status/waiting_for_action":
-            self.status_waiting_for_action = struct.unpack('B', msg.payload)[0]
+    def setup_game(self, game_setup):
+        '''
+        Send the game setup.
+        This will take effect when a new game will be created.
+        Parameters:
+            game_setup (dict): The wanted game state (see "gym_mk8.EnvMarioKart8" for the format).
+        '''
+        self._check_server()
+        #
+        for k,v in game_setup.items():
+            if k not in common.SETUP_SCHEMA.formats:
+                warnings.warn("Unknown game setup key '{}' ignored.".format(k))
+                continue
+            self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/setup/{}".format(k), payload=common.SETUP_SCHEMA.pack_field(k, v), qos=1, retain=True)
 
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/status/initializing_game":
-            self.status_initializing_game = struct.unpack('B', msg.payload)[0]
 
-        elif msg.topic == "Mario_Kart_8/"+self.target_id+"/status/playing_game":
-            self.status_playing_game = struct.unpack('B', msg.payload)[0]
+class Client(ClientProtocol, threading.Thread):
+    '''
+    Client to be used to communicate with the server via MQTT.
+    '''
 
-    def _encode_action(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift):
-        payload = bytes()
-        payload += struct.pack('b', go_forward)
-        payload += struct.pack('b', go_backward)
-        payload += struct.pack('f', go_x_direction)
-        payload += struct.pack('f', set_y_direction)
-        payload += struct.pack('b', look_backward)
-        payload += struct.pack('b', throw_horn)
-        payload += struct.pack('b', bump_drift)
-        return payload
+    def __init__(self, host, port, target_id, sequenced=False, retransmit_timeout=0.5, broker=None):
+        '''
+        Instanciate one client instance.
+        Call "start()" to connect the client.
+        Parameters:
+            host (str): IPv4 address of the MQTT server.
+            port (int): TCP/IP Port of the MQTT server.
+            target_id (str): The id of the instance used to create the MQTT topic.
+            sequenced (bool): Use the sequenced qos 0 step protocol (see "ClientProtocol").
+            retransmit_timeout (float): Delay in seconds before an action without reply is sent again (sequenced protocol).
+            broker (loopback.LoopbackBroker): In-memory broker used instead of MQTT ("host" and "port" are ignored).
+        Returns:
+            An "Client" waiting to start.
+        '''
+        threading.Thread.__init__(self)
+        ClientProtocol.__init__(self, target_id, sequenced, retransmit_timeout)
+        #
+        self.isReady = threading.Event()
+        self.isReady.clear()
+        self.mqtt = mqtt.Client() if broker is None else broker.client()
+        self.mqtt.on_connect = self._on_connect
+        self.mqtt.on_message = self._on_message
+        # "loop_forever()" reconnects to the broker with this backoff, "_on_connect" subscribes again
+        self.mqtt.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.mqtt.connect(host, port, 60)
+        #
+        self._event_new_step = threading.Event()
+        self._event_new_step.clear()
+        # Notified by "_on_message" each time a "status/<name>" value is received
+        self._status_changed = threading.Condition()
+
+    def _status_updated(self):
+        with self._status_changed:
+            self._status_changed.notify_all()
+
+    def _wait_status(self, attr, timeout):
+        with self._status_changed:
+            if not self._status_changed.wait_for(lambda: getattr(self, attr) or self.status == False, timeout):
+                raise TimeoutError("No '{}' status from the server after {} s.".format(attr, timeout))
+        self._check_server()
+
+    def _wait_new_step(self, timeout):
+        if self._last_action is None:
+            if not self._event_new_step.wait(timeout):
+                raise TimeoutError("No new step from the server after {} s.".format(timeout))
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._event_new_step.wait(self._retransmit_wait(deadline)):
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError("No new step from the server after {} s.".format(timeout))
+                self._retransmit_action()
+        self._check_server()
+
+    def wait_server(self, timeout=None):
+        '''
+        Block the execution until the server is alive ("status" True), e.g. after a crash of the emulator.
+        Parameters:
+            timeout (float): Maximum time in seconds to wait. None wait forever.
+        '''
+        if not self.isReady.wait(timeout):
+            raise TimeoutError("Server not available after {} s.".format(timeout))
 
-    def reset_game(self):
+    def reset_game(self, timeout=None):
         '''
         Send an reset order to the game.
         This will block the execution until the reset was done.
+        Parameters:
+            timeout (float): Maximum time in seconds to wait for each server answer. None wait forever.
+                A "TimeoutError" is raised if the server does not answer in time.
         '''
-        if self.status != True:
-            raise RuntimeError("Server seem to be dead.")
+        self._check_server()
         #
-        self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/reset", payload=None, qos=1, retain=False)
+        self._publish_reset()
         #
-        while not self.status_initializing_game:
-            time.sleep(0.1)
+        self._wait_status('status_initializing_game', timeout)
         self._event_new_step.clear()
-        self._event_new_step.wait()
+        self._wait_new_step(timeout)
 
-    def action_game(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift):
+    def action_game(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, timeout=None):
         '''
         Send an reset action to the game.
         This will block the execution until the action was done.
@@ -172,36 +368,54 @@ class Client(threading.Thread):
             look_backward (bool): Activates or deactivates the controller button used to look backward.
             throw_horn (bool): Activates or deactivates the controller button used to horn/throw.
             bump_drift (bool): Activates or deactivates the controller button used to bump/drift.
+            timeout (float): Maximum time in seconds to wait for each server answer. None wait forever.
+                A "TimeoutError" is raised if the server does not answer in time.
         '''
-        if self.status != True:
-            raise RuntimeError("Server seem to be dead.")
+        self.send_action(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, timeout)
+        self.wait_step(timeout)
+
+    def send_action(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, timeout=None):
+        '''
+        Send an action to the game without waiting for the resulting step.
+        Call "wait_step()" to get the result. This allows to send the actions of several instances before waiting all of them.
+        See "action_game" for the parameters.
+        '''
+        self._check_server()
         #
-        while not self.status_waiting_for_action:
-            time.sleep(1/100)
+        self._wait_status('status_waiting_for_action', timeout)
         #
-        datas = self._encode_action(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift)
-        self._event_new_step.clear()
-        self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/action", payload=datas, qos=1, retain=False)
-        self._event_new_step.wait()
+        self._publish_action(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift)
 
-    def setup_game(self, game_setup):
+    def step_async(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, timeout=None):
         '''
-        Send the game setup.
-        This will take effect when a new game will be created.
+        Send an action to the game and return immediately.
+        See "action_game" for the parameters ("timeout" only apply to the wait of the server "waiting_for_action" status).
+        Returns:
+            An "concurrent.futures.Future" completed with the step number once the resulting step was received.
+        '''
+        if self._pending_step is not None:
+            raise RuntimeError("A step is already in flight.")
+        future = concurrent.futures.Future()
+        self._pending_step = future
+        try:
+            self.send_action(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, timeout)
+        except:
+            self._pending_step = None
+            raise
+        return future
+
+    def wait_step(self, timeout=None):
+        '''
+        Block the execution until the step resulting of the last "send_action()" was received.
         Parameters:
-            go_forward (bool): Activates or deactivates the controller button used to move forward.
-            go_backward (bool): Activates or deactivates the controller button used to move backward.
-            go_x_direction (float): Move the controller joystick on X axis. Range [-1.0; 1.0].
-            set_y_direction (float): Move the controller joystick on Y axis. Range [-1.0; 1.0].
-            look_backward (bool): Activates or deactivates the controller button used to look backward.
-            throw_horn (bool): Activates or deactivates the controller button used to horn/throw.
-            bump_drift (bool): Activates or deactivates the controller button used to bump/drift.
+            timeout (float): Maximum time in seconds to wait. None wait forever.
         '''
-        if self.status != True:
-            raise RuntimeError("Server seem to be dead.")
-        #
-        for k,v in game_setup.items():
-            self.mqtt.publish("Mario_Kart_8/"+self.target_id+"/order/setup/{}".format(k), payload=struct.pack('i', v), qos=1, retain=True)
+        try:
+            self._wait_new_step(timeout)
+        except TimeoutError:
+            # The step is given up: the next "step_async()" can send a new action
+            self._cancel_pending_step()
+            raise
 
     def _connection_loop(self):
         self.mqtt.loop_forever()
@@ -210,6 +424,163 @@ class Client(threading.Thread):
         self._connection_loop()
 
 
+class AsyncClient(ClientProtocol):
+    '''
+    Asyncio version of "Client".
+    The MQTT socket is driven by the running event loop instead of a dedicated thread,
+    so one event loop can drive many game instances from a single process.
+    '''
+
+    def __init__(self, host, port, target_id, sequenced=False, retransmit_timeout=0.5):
+        '''
+        Instanciate one client instance.
+        Call "await start()" from the event loop to connect the client.
+        Parameters:
+            host (str): IPv4 address of the MQTT server.
+            port (int): TCP/IP Port of the MQTT server.
+            target_id (str): The id of the instance used to create the MQTT topic.
+            sequenced (bool): Use the sequenced qos 0 step protocol (see "ClientProtocol").
+            retransmit_timeout (float): Delay in seconds before an action without reply is sent again (sequenced protocol).
+        Returns:
+            An "AsyncClient" waiting to start.
+        '''
+        super().__init__(target_id, sequenced, retransmit_timeout)
+        #
+        self.host = host
+        self.port = port
+        self.mqtt = mqtt.Client()
+        self.mqtt.on_connect = self._on_connect
+        self.mqtt.on_message = self._on_message
+        self.mqtt.on_socket_open = self._on_socket_open
+        self.mqtt.on_socket_close = self._on_socket_close
+        self.mqtt.on_socket_register_write = self._on_socket_register_write
+        self.mqtt.on_socket_unregister_write = self._on_socket_unregister_write
+        self.mqtt.reconnect_delay_set(min_delay=1, max_delay=30)
+        # Asyncio primitives are bound to the event loop: they are created by "start()"
+        self.isReady = None
+        self._event_new_step = None
+        self._status_changed = None
+        self._loop = None
+        self._task_misc = None
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # Keepalive and retries, the equivalent of what "loop_forever()" does between two socket events,
+        # including the reconnection to the broker with an exponential backoff ("_on_connect" subscribes again)
+        delay = 1
+        while True:
+            if self.mqtt.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                delay = 1
+                await asyncio.sleep(1.0)
+                continue
+            await asyncio.sleep(delay)
+            delay = min(delay*2, 30)
+            try:
+                self.mqtt.reconnect()
+            except OSError:
+                pass
+
+    async def start(self):
+        '''
+        Connect the client and wait until the server is ready.
+        '''
+        self._loop = asyncio.get_running_loop()
+        self.isReady = asyncio.Event()
+        self._event_new_step = asyncio.Event()
+        self._status_changed = asyncio.Event()
+        self.mqtt.connect(self.host, self.port, 60)
+        self._task_misc = self._loop.create_task(self._misc_loop())
+        await self.isReady.wait()
+
+    async def close(self):
+        '''
+        Disconnect the client.
+        '''
+        self.mqtt.disconnect()
+        if self._task_misc is not None:
+            self._task_misc.cancel()
+        self._drop_frame_ring()
+
+    def _status_updated(self):
+        self._status_changed.set()
+
+    async def _wait_status(self, attr, timeout):
+        async def wait():
+            while not getattr(self, attr) and self.status != False:
+                self._status_changed.clear()
+                await self._status_changed.wait()
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("No '{}' status from the server after {} s.".format(attr, timeout))
+        self._check_server()
+
+    async def _wait_new_step(self, timeout):
+        if self._last_action is None:
+            try:
+                await asyncio.wait_for(self._event_new_step.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("No new step from the server after {} s.".format(timeout))
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._event_new_step.is_set():
+                try:
+                    await asyncio.wait_for(self._event_new_step.wait(), self._retransmit_wait(deadline))
+                except asyncio.TimeoutError:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError("No new step from the server after {} s.".format(timeout))
+                    self._retransmit_action()
+        self._check_server()
+
+    async def wait_server(self, timeout=None):
+        '''
+        Wait until the server is alive ("status" True), e.g. after a crash of the emulator.
+        Parameters:
+            timeout (float): Maximum time in seconds to wait. None wait forever.
+        '''
+        try:
+            await asyncio.wait_for(self.isReady.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Server not available after {} s.".format(timeout))
+
+    async def reset_game(self, timeout=None):
+        '''
+        Send an reset order to the game and wait until the reset was done.
+        Parameters:
+            timeout (float): Maximum time in seconds to wait for each server answer. None wait forever.
+        '''
+        self._check_server()
+        #
+        self._publish_reset()
+        #
+        await self._wait_status('status_initializing_game', timeout)
+        self._event_new_step.clear()
+        await self._wait_new_step(timeout)
+
+    async def action_game(self, go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift, timeout=None):
+        '''
+        Send an action to the game and wait until the action was done.
+        See "Client.action_game" for the parameters.
+        '''
+        self._check_server()
+        #
+        await self._wait_status('status_waiting_for_action', timeout)
+        #
+        self._publish_action(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift)
+        await self._wait_new_step(timeout)
+
+
 # if __name__ == "__main__":
 #     client = Client("192.168.27.66", 1883, "00000000")
 #     client.start()
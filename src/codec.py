@@ -0,0 +1,162 @@
+import numpy as np
+import common
+import struct
+import zlib
+import io
+
+# The server side has Pillow, the client side OpenCV (see requirements_*.txt): use whichever is installed
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class Codec:
+    '''
+    Interface of the frame codecs: "encode(frame) -> bytes" on the server, "decode(bytes) -> frame" on the client.
+    '''
+    def request_keyframe(self):
+        '''
+        Make the next encoded frame decodable without the previous ones. Only meaningful for the inter-frame codecs.
+        '''
+        pass
+
+
+class RawCodec(Codec):
+    '''
+    Frame sent as is (STEP_FRAME_SHAPE uint8 bytes). Fastest, biggest.
+    '''
+    def encode(self, frame):
+        return frame.tobytes()
+
+    def decode(self, payload):
+        return np.frombuffer(payload, dtype=np.uint8).reshape(common.STEP_FRAME_SHAPE)
+
+
+class ZlibCodec(Codec):
+    '''
+    Lossless zlib compression of the raw frame bytes.
+    '''
+    def __init__(self, level=1):
+        self.level = level
+
+    def encode(self, frame):
+        return zlib.compress(frame.tobytes(), self.level)
+
+    def decode(self, payload):
+        return np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(common.STEP_FRAME_SHAPE)
+
+
+class ImageCodec(Codec):
+    '''
+    Frame compressed as an image file (PNG is lossless, JPEG is lossy).
+    '''
+    def __init__(self, pil_format, cv2_ext, params):
+        self.pil_format = pil_format
+        self.cv2_ext    = cv2_ext
+        self.params     = params
+
+    def encode(self, frame):
+        if PIL is not None:
+            buffer = io.BytesIO()
+            PIL.Image.fromarray(frame).save(buffer, format=self.pil_format, **self.params['pil'])
+            return buffer.getvalue()
+        if cv2 is not None:
+            success, data = cv2.imencode(self.cv2_ext, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), self.params['cv2'])
+            if not success:
+                raise RuntimeError("Unable to encode the frame as {}.".format(self.pil_format))
+            return data.tobytes()
+        raise RuntimeError("Pillow or OpenCV is required for the {} codec.".format(self.pil_format))
+
+    def decode(self, payload):
+        if cv2 is not None:
+            frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if PIL is not None:
+            return np.asarray(PIL.Image.open(io.BytesIO(payload)).convert("RGB"))
+        raise RuntimeError("Pillow or OpenCV is required for the {} codec.".format(self.pil_format))
+
+
+class DeltaCodec(Codec):
+    '''
+    Inter-frame codec: a zlib compressed keyframe every "keyframe_interval" frames,
+    the zlib compressed difference (modulo 256) with the previous frame in between (consecutive frames are highly correlated).
+    Each payload starts with DELTA_HEADER: the frame kind and a sequence number incremented by each encoded frame.
+    The decoder can't rebuild a delta which doesn't follow the last decoded frame (missed or out-of-order step),
+    "decode" returns None in this case and the client should ask a keyframe (see "Client._decode_frame").
+    A payload with the sequence number of the last decoded frame is a duplicate (reply sent again by the server to a retransmitted action),
+    "decode" returns the last decoded frame.
+    Each decoded frame is a new read-only array: the frames kept by the caller (replay buffer, frame stack) are never overwritten.
+    '''
+    KEYFRAME    = 0
+    DELTA       = 1
+    DELTA_HEADER = struct.Struct('<BI')
+
+    def __init__(self, keyframe_interval=30):
+        self.keyframe_interval = keyframe_interval
+        # Encoder
+        self._seq = 0
+        self._force_keyframe = True
+        self._since_keyframe = 0
+        self._last_encoded = np.zeros(common.STEP_FRAME_SHAPE, dtype=np.uint8)
+        self._residual = np.zeros(common.STEP_FRAME_SHAPE, dtype=np.uint8)
+        # Decoder: the last decoded frame, reference of the next delta
+        self._decoded_seq = None
+        self._decoded = None
+
+    def request_keyframe(self):
+        self._force_keyframe = True
+
+    def encode(self, frame):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        if self._force_keyframe or self._since_keyframe >= self.keyframe_interval:
+            self._force_keyframe = False
+            self._since_keyframe = 1
+            np.copyto(self._last_encoded, frame)
+            return DeltaCodec.DELTA_HEADER.pack(DeltaCodec.KEYFRAME, self._seq) + zlib.compress(self._last_encoded.data, 1)
+        self._since_keyframe += 1
+        np.subtract(frame, self._last_encoded, out=self._residual)
+        np.copyto(self._last_encoded, frame)
+        return DeltaCodec.DELTA_HEADER.pack(DeltaCodec.DELTA, self._seq) + zlib.compress(self._residual.data, 1)
+
+    def decode(self, payload):
+        kind, seq = DeltaCodec.DELTA_HEADER.unpack_from(payload)
+        if seq == self._decoded_seq:
+            return self._decoded
+        if kind == DeltaCodec.DELTA and (self._decoded_seq is None or seq != ((self._decoded_seq + 1) & 0xFFFFFFFF)):
+            return None
+        data    = np.frombuffer(zlib.decompress(payload[DeltaCodec.DELTA_HEADER.size:]), dtype=np.uint8).reshape(common.STEP_FRAME_SHAPE)
+        if kind == DeltaCodec.KEYFRAME:
+            frame = data
+        else:
+            frame = np.add(self._decoded, data)
+            frame.flags.writeable = False
+        self._decoded_seq = seq
+        self._decoded = frame
+        return frame
+
+
+def get_codec(codec_id, quality=90, keyframe_interval=30):
+    '''
+    Parameters:
+        codec_id (common.Server.FrameCodec): The wanted codec.
+        quality (int): JPEG quality in [1; 100] (only used by the JPEG codec).
+        keyframe_interval (int): Number of frames between two keyframes (only used by the DELTA codec).
+    Returns:
+        An object with "encode(frame) -> bytes" and "decode(bytes) -> frame" methods.
+    '''
+    if codec_id == common.Server.FrameCodec.RAW:
+        return RawCodec()
+    if codec_id == common.Server.FrameCodec.ZLIB:
+        return ZlibCodec()
+    if codec_id == common.Server.FrameCodec.PNG:
+        return ImageCodec("PNG", ".png", {'pil': {'compress_level': 1}, 'cv2': [cv2.IMWRITE_PNG_COMPRESSION, 1] if cv2 else []})
+    if codec_id == common.Server.FrameCodec.JPEG:
+        return ImageCodec("JPEG", ".jpg", {'pil': {'quality': quality}, 'cv2': [cv2.IMWRITE_JPEG_QUALITY, quality] if cv2 else []})
+    if codec_id == common.Server.FrameCodec.DELTA:
+        return DeltaCodec(keyframe_interval)
+    raise RuntimeError("Unknow frame codec {}".format(codec_id))
@@ -1,3 +1,5 @@
+import numpy as np
+import struct
 import enum
 
 class Server:
@@ -5,6 +7,171 @@ class Server:
         RESET       = 0
         ACTION      = 1
         GAME_SETUP  = 2
+        KEYFRAME    = 3
+
+    class StepLayout(enum.IntEnum):
+        PACKED          = 0 # One "step/record" message per step: scalar header followed by the frame bytes
+        PER_TOPIC       = 1 # Legacy layout: one retained message per field, then "step"
+        SHARED_MEMORY   = 2 # "step/record" carries only the scalar header, the frame goes to a shared memory ring (see frame_ring.py)
+
+    class FrameCodec(enum.IntEnum):
+        RAW     = 0 # Raw RGB bytes
+        ZLIB    = 1 # Lossless, zlib compressed raw bytes
+        PNG     = 2 # Lossless
+        JPEG    = 3 # Lossy, see the "FRAME_QUALITY" game setup
+        DELTA   = 4 # Lossless, keyframe every "FRAME_KEYFRAME_INTERVAL" steps and compressed differences in between
+
+    class Backend(enum.IntEnum):
+        YUZU        = 0 # The real game: Yuzu, GDB, screenshots of the window and virtual controller
+        SYNTHETIC   = 1 # Simulated game, no emulator, GDB nor display required (see synthetic.py)
+
+
+class Schema:
+    '''
+    Declarative description of a binary message shared by the client and the server.
+    The fields are compiled once into a "struct.Struct" for the packed record, a numpy dtype
+    for batch decoding and one "struct.Struct" per field for the per-topic layout.
+    '''
+
+    def __init__(self, fields, byte_order='<'):
+        '''
+        Compile a schema.
+        Parameters:
+            fields (tuple): Ordered pairs (name, struct format character).
+            byte_order (str): The struct byte order prefix used on the wire.
+        Returns:
+            An "Schema" ready to encode / decode.
+        '''
+        self.fields     = tuple(fields)
+        self.names      = tuple(name for name, _ in self.fields)
+        self.formats    = dict(self.fields)
+        self.record     = struct.Struct(byte_order + ''.join(fmt for _, fmt in self.fields))
+        self.dtype      = np.dtype([(name, byte_order + fmt) for name, fmt in self.fields])
+        self.scalars    = {name: struct.Struct(byte_order + fmt) for name, fmt in self.fields}
+        self.size       = self.record.size
+
+    def pack(self, *values):
+        return self.record.pack(*values)
+
+    def pack_dict(self, values, default=0):
+        '''
+        Pack a record from a dict. Missing fields are replaced by "default".
+        '''
+        return self.record.pack(*(values.get(name, default) for name in self.names))
+
+    def unpack(self, payload, offset=0):
+        return self.record.unpack_from(payload, offset)
+
+    def unpack_dict(self, payload, offset=0):
+        return dict(zip(self.names, self.record.unpack_from(payload, offset)))
+
+    def pack_field(self, name, value):
+        return self.scalars[name].pack(value)
+
+    def unpack_field(self, name, payload):
+        return self.scalars[name].unpack(payload)[0]
+
+
+# Raw values read in the game memory by the server debugger: (name, data type, memory address).
+DEBUGGER_FIELDS = (
+    ('scene_id'             , 'i', 0x846cb88c),
+    ('pause_menu_idx'       , 'i', 0x84c38764),
+    ('quit_menu_idx'        , 'i', 0x84c38124),
+    ('main_menu_idx'        , 'i', 0x84c382c4),
+    ('solo_menu_idx'        , 'i', 0x84c382e4),
+    ('race_end_menu_idx'    , 'i', 0x84c38794),
+    ('player_menu_idx'      , 'i', 0x84c38374),
+    ('player_alt_menu_idx'  , 'i', 0x8c9e6974),
+    ('car_body_idx'         , 'i', 0x8cabd37c),
+    ('car_wheel_idx'        , 'i', 0x8cabde2c),
+    ('car_wing_idx'         , 'i', 0x8cabe7ac),
+    ('car_menu_idx'         , 'i', 0x84c383a4),
+    ('rule_menu_idx'        , 'i', 0x87665654),
+    ('track_cup_sel_idx'    , 'B', 0x84c38404),
+    ('race_rule_cc'         , 'B', 0x84db2790),
+    ('race_rule_team'       , 'B', 0x84db276c),
+    ('race_rule_item'       , 'B', 0x84db277c),
+    ('race_rule_ai'         , 'B', 0x84db2798),
+    ('race_rule_car_ai'     , 'B', 0x84db27ac),
+    ('race_rule_track'      , 'B', 0x84db27c0),
+    ('race_rule_num'        , 'B', 0x84db27c8),
+    ('timer'                , 'i', 0x96afe398),
+    ('speed'                , 'f', 0x96bfade8),
+    ('coins'                , 'i', 0x96bf4ac4),
+    ('status'               , 'i', 0x96bf4ab0),
+    ('rank'                 , 'i', 0x96bf4ab4),
+    ('lap_continuous'       , 'f', 0x80cc172c),
+    ('lap_discrete'         , 'B', 0x8e697f8d),
+    ('pos_x'                , 'f', 0x96af34d4),
+    ('pos_y'                , 'f', 0x96af34d8),
+    ('pos_z'                , 'f', 0x96af34dc),
+    ('towing'               , 'B', 0x954def14),#0 if in towing else 154 (do not use for the reward)
+    ('track'                , 'i', 0x84cc187c),#start @ 1401
+)
+DEBUGGER_SCHEMA = Schema(tuple((name, fmt) for name, fmt, _ in DEBUGGER_FIELDS))
+
+# Debugger values published with each step (TRAINING mode only). Exposed as "Client.step_<name>".
+STEP_DEBUGGER_FIELDS = ('timer', 'speed', 'coins', 'status', 'rank', 'lap_continuous', 'lap_discrete', 'pos_x', 'pos_y', 'pos_z', 'towing', 'track')
+
+# Step results: "Mario_Kart_8/{instance_id}/step/record" carries STEP_SCHEMA followed by the RGB frame (STEP_FRAME_SHAPE, uint8)
+# encoded with the codec "frame_codec" (see codec.py).
+# In the per-topic layout each field is published on "Mario_Kart_8/{instance_id}/step/{name}" and "no" on ".../step".
+STEP_SCHEMA = Schema((
+    ('no'                   , 'I'),
+    ('seq'                  , 'I'),
+    ('terminal'             , 'B'),
+    ('terminated_by_timeout', 'B'),
+    ('is_race_finish'       , 'B'),
+    ('frame_codec'          , 'B'),
+) + tuple((name, DEBUGGER_SCHEMA.formats[name]) for name in STEP_DEBUGGER_FIELDS))
+STEP_FRAME_SHAPE = (128, 128, 3)
+
+# Server status: "status" is published on "Mario_Kart_8/{instance_id}/status", the others on ".../status/{name}".
+STATUS_SCHEMA = Schema((
+    ('status'               , 'B'),
+    ('waiting_for_action'   , 'B'),
+    ('initializing_game'    , 'B'),
+    ('playing_game'         , 'B'),
+))
+
+# Action order: "Mario_Kart_8/{instance_id}/order/action".
+ACTION_SCHEMA = Schema((
+    ('go_forward'           , 'b'),
+    ('go_backward'          , 'b'),
+    ('go_x_direction'       , 'f'),
+    ('set_y_direction'      , 'f'),
+    ('look_backward'        , 'b'),
+    ('throw_horn'           , 'b'),
+    ('bump_drift'           , 'b'),
+    ('seq'                  , 'I'), # 0 for the legacy protocol, else echoed by the step reply (see "Client" sequenced mode)
+))
+# Action of the clients that predate the sequenced protocol: the same fields without "seq"
+ACTION_LEGACY_SCHEMA = Schema(ACTION_SCHEMA.fields[:-1])
+
+# Game setup orders: one retained message per key on "Mario_Kart_8/{instance_id}/order/setup/{name}".
+SETUP_SCHEMA = Schema((
+    ('MAIN_MODE'             , 'i'),
+    ('GAME_MODE'             , 'i'),
+    ('PLAYER'                , 'i'),
+    ('PLAYER_VARIANT'        , 'i'),
+    ('CAR_BODY'              , 'i'),
+    ('CAR_WHEEL'             , 'i'),
+    ('CAR_WING'              , 'i'),
+    ('RACE_RULE_MODE'        , 'i'),
+    ('RACE_RULE_TEAMS'       , 'i'),
+    ('RACE_RULE_ITEMS'       , 'i'),
+    ('RACE_RULE_COM'         , 'i'),
+    ('RACE_RULE_COM_VEHICLES', 'i'),
+    ('RACE_RULE_COURSES'     , 'i'),
+    ('RACE_RULE_RACE_COUNT'  , 'i'),
+    ('COURSE_CUP'            , 'i'),
+    ('COURSE'                , 'i'),
+    ('MAX_STEP'              , 'i'),
+    ('FRAME_CODEC'           , 'i'),
+    ('FRAME_QUALITY'         , 'i'),
+    ('FRAME_KEYFRAME_INTERVAL', 'i'),
+))
+
 
 class GameSetup:
     class MainMenu(enum.IntEnum):
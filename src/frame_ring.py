@@ -0,0 +1,103 @@
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import sys
+import os
+import common
+
+
+class FrameRing:
+    '''
+    Ring buffer of frames in shared memory, used when the client and the server run on the same host
+    (see "common.Server.StepLayout.SHARED_MEMORY").
+    The server writes the frame of step "no" in the slot "no % slots" before publishing the scalar record on MQTT,
+    the client reads it in place. Since the server waits an action before producing the next step,
+    a frame stays valid until "slots - 1" steps have been produced after it.
+    The shared memory is named "mk8_frames_{instance_id}", it starts with the number of slots followed by the slots.
+    '''
+
+    SLOT_DTYPE = np.dtype([('no', '<u4'), ('frame', np.uint8, common.STEP_FRAME_SHAPE)], align=True)
+    HEADER_SIZE = 8
+
+    # Names of the rings created (and not yet removed) by the current process
+    _owned = set()
+
+    def __init__(self, instance_id, slots=4, create=False):
+        '''
+        Parameters:
+            instance_id (str): The id of the instance, used to name the shared memory.
+            slots (int): Number of frames kept in the ring (only used with "create").
+            create (bool): True for the server (owner of the ring), False to attach to an existing ring.
+        Returns:
+            An "FrameRing" mapped in the current process.
+        '''
+        self.name   = "mk8_frames_"+instance_id
+        self.owner  = create
+        if create:
+            size = FrameRing.HEADER_SIZE + slots*FrameRing.SLOT_DTYPE.itemsize
+            try:
+                self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+            except FileExistsError:
+                # Left by a previous server of this instance (e.g. killed by the watchdog)
+                old = shared_memory.SharedMemory(name=self.name)
+                old.close()
+                old.unlink()
+                self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+            FrameRing._owned.add(self.name)
+            np.ndarray((1,), dtype='<u4', buffer=self._shm.buf)[0] = slots
+        else:
+            self._shm = FrameRing._attach(self.name)
+            slots = int(np.ndarray((1,), dtype='<u4', buffer=self._shm.buf)[0])
+        self.slots      = slots
+        records         = np.ndarray((slots,), dtype=FrameRing.SLOT_DTYPE, buffer=self._shm.buf, offset=FrameRing.HEADER_SIZE)
+        self._no        = records['no']
+        self._frames    = records['frame']
+        if create:
+            # No step number is written before the first frame, make the empty slots invalid
+            self._no[:] = np.iinfo(np.uint32).max
+        else:
+            # The views given to the client must not alter the frames of the server
+            self._frames.flags.writeable = False
+
+    @staticmethod
+    def _attach(name):
+        # Only the owner removes the shared memory, the resource tracker of a client process would unlink it when the client exits
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix' and name not in FrameRing._owned:
+            # The owner runs in another process: drop the registration done by the attach (POSIX names start with "/")
+            resource_tracker.unregister("/"+shm.name, "shared_memory")
+        return shm
+
+    def write(self, step_no, frame):
+        '''
+        Copy the frame of a step into the ring. The step number is written last to validate the slot.
+        '''
+        slot = step_no % self.slots
+        self._frames[slot] = frame
+        self._no[slot] = step_no
+
+    def frame(self, step_no):
+        '''
+        Returns:
+            A zero-copy numpy view (STEP_FRAME_SHAPE, uint8) on the frame of the step.
+        '''
+        slot = step_no % self.slots
+        if self._no[slot] != step_no:
+            raise RuntimeError("Frame of step {} is not in the ring (slot holds step {}).".format(step_no, self._no[slot]))
+        return self._frames[slot]
+
+    def close(self):
+        '''
+        Unmap the ring, the owner also removes the shared memory.
+        The mapping stays alive as long as views returned by "frame()" are referenced.
+        '''
+        self._no     = None
+        self._frames = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        if self.owner:
+            self._shm.unlink()
+            FrameRing._owned.discard(self.name)
@@ -1,7 +1,14 @@
+import concurrent.futures
+import preprocessing
 import numpy as np
+import threading
+import recorder
 import common
 import client
+import queue
+import time
 import gym
+import os
 
 
 
@@ -12,7 +19,7 @@ class EnvMarioKart8(gym.Env):
 
     metadata = {"render_modes": ["human", "rgb_array"], "render_fps": 4}
 
-    def __init__(self, host, port, target_instance, game_setup, callback_reset_game_setup, render_mode="rgb_array"):
+    def __init__(self, host, port, target_instance, game_setup, callback_reset_game_setup, render_mode="rgb_array", sequenced=False, timeout=None, reset_timeout=None, preprocess=None, record=None, broker=None):
         '''
         Instanciate one client instance.
         Call "start()" to connect the client.
@@ -38,18 +45,34 @@ class EnvMarioKart8(gym.Env):
                 - COURSE_CUP               = common.GameSetup.Course.Cup.<value>
                 - COURSE                   = common.GameSetup.Course.Cup.Special.<value>
                 - MAX_STEP                 = <int value> which represent max step to done before closing the game instance.
+                - FRAME_CODEC              = common.Server.FrameCodec.<value> (optional, RAW by default) compression of the frames sent by the server.
+                - FRAME_QUALITY            = <int value> in [1; 100] (optional, 90 by default) quality of the JPEG codec.
+                - FRAME_KEYFRAME_INTERVAL  = <int value> (optional, 30 by default) steps between two keyframes of the DELTA codec.
                 See common.py to find what values exists.
             callback_reset_game_setup (callable): This callback is called when a reset command is sent by the agent.
                 This callback is triggered just before the client reports the reset order to the server.
                 It's therefore the ideal place to modify the game setup if you wish.
             render_mode (str): Set this option to "human" if you want to display a debug viewer to see what's currently happening in the game.
+            sequenced (bool): Use the sequenced qos 0 step protocol, with retransmission of the lost actions (see "client.ClientProtocol").
+            timeout (float): Maximum time in seconds to wait for each server answer. None wait forever.
+                A step without answer, or a step during which the server died, is returned as a truncated terminal step.
+                The next "reset()" waits for the server to come back (see "server_launcher.ServerInstance") and sends the game setup again.
+            reset_timeout (float): Maximum time in seconds to wait for each server answer during "reset()", the menu navigation takes seconds.
+                None wait forever. The reset is not sent again on timeout (a late duplicate would abort the new episode): "TimeoutError" is raised.
+            preprocess (dict): Arguments of an "preprocessing.ObservationPipeline" (crop, grayscale, size, stack) applied to the frames,
+                e.g. {'grayscale': True, 'size': (84, 84), 'stack': 4}. None keep the RGB frame as observation.
+                The observation is then a view on the frame stack of the pipeline, overwritten by the next steps.
+            record (str): Folder where the trajectories are recorded (see "recorder.TrajectoryRecorder"). None disable the recording.
+            broker (loopback.LoopbackBroker): Talk to a server of the same process through this in-memory broker instead of MQTT ("host" and "port" are ignored).
         Returns:
             An "EnvMarioKart8" OpenAI Gym environment.
         '''
         self.window_size = 128
+        self.pipeline = None if preprocess is None else preprocessing.ObservationPipeline(**preprocess)
+        obs_shape = common.STEP_FRAME_SHAPE if self.pipeline is None else self.pipeline.shape
         self.observation_space = gym.spaces.Dict(
             {
-                'image': gym.spaces.Box(low=0, high=255, shape=(self.window_size, self.window_size, 3), dtype=np.uint8),
+                'image': gym.spaces.Box(low=0, high=255, shape=obs_shape, dtype=np.uint8),
             }
         )
         self.action_space = gym.spaces.Dict(
@@ -63,18 +86,29 @@ class EnvMarioKart8(gym.Env):
         self.game_setup = game_setup
         self.callback_reset_game_setup = callback_reset_game_setup
         #
-        self.client = client.Client(host, port, target_instance)
-        self.client.start()
-        self.client.isReady.wait()
+        self.sequenced = sequenced
+        self.timeout = timeout
+        self.reset_timeout = reset_timeout
+        self.recorder = None if record is None else recorder.TrajectoryRecorder(record)
+        self.broker = broker
+        self.client = self._make_client(host, port, target_instance)
         #
         self._frame     = None
         self._last_lap  = None
         self._last_time = None
+        self._step_future = None
+        self._action    = None
         #
         if self.render_mode == "human":
             cv2.namedWindow("image", cv2.WINDOW_NORMAL)
             cv2.waitKey(10)
 
+    def _make_client(self, host, port, target_instance):
+        instance = client.Client(host, port, target_instance, sequenced=self.sequenced, broker=self.broker)
+        instance.start()
+        instance.isReady.wait()
+        return instance
+
     def compute_reward(self):
         '''
         Example of a reward function. Feel free to edit this function to test your ideas.
@@ -137,10 +171,23 @@ class EnvMarioKart8(gym.Env):
 
         return reward
 
+    def _take_frame(self):
+        # A frame of the shared memory ring is overwritten by the server a few steps later: the observation gets its own copy
+        # (the pipeline already copies the frames in its stack)
+        frame = self.client.step_frame
+        if self.client.step_frame_shared and self.pipeline is None:
+            return frame.copy()
+        return frame
+
     def _get_obs(self):
+        if self.pipeline is not None:
+            return {'image': self.pipeline.observation()}
         return {'image': self.render()}
 
     def _get_info(self):
+        # The server sent a frame that could not be decoded (see "client.ClientProtocol._decode_frame"): the observation repeats the previous frame
+        if self.client.step_frame_stale:
+            return {'frame_stale': True}
         return {}
 
     def reset(self):
@@ -150,6 +197,11 @@ class EnvMarioKart8(gym.Env):
             observation (dict): The current observation (the rgb frame of the game) in the format {'image':...}.
             info (dict): Always empty.
         '''
+        self._prepare_reset()
+        self._reset_game()
+        return self._reset_results()
+
+    def _prepare_reset(self):
         super().reset()
 
         self._frame     = None
@@ -157,13 +209,29 @@ class EnvMarioKart8(gym.Env):
         self._last_time = None
 
         self.callback_reset_game_setup(self)
-        self.client.setup_game(self.game_setup)
-        self.client.reset_game()
-        self._frame = self.client.step_frame
+
+    def _reset_game(self):
+        # The setup and the reset are sent again once the server is back: a crashed emulator is relaunched by "server_launcher.ServerInstance"
+        while True:
+            try:
+                self.client.wait_server()
+                self.client.setup_game(self.game_setup)
+                self.client.reset_game(self.reset_timeout)
+                return
+            except client.ServerLostError:
+                pass
+
+    def _reset_results(self):
+        self._frame = self._take_frame()
+        if self.pipeline is not None:
+            self.pipeline.reset(self._frame)
 
         observation = self._get_obs()
         info = self._get_info()
 
+        if self.recorder is not None:
+            self.recorder.record(self._frame, None, 0.0, False, False, True, self.client)
+
         if self.render_mode == "human":
             self._render_frame()
 
@@ -180,18 +248,72 @@ class EnvMarioKart8(gym.Env):
               Note : The float is casted to the bool value True if the scalar is > 0.0 then False.
             reward (float): The current reward.
             terminated (bool): If this is the terminal step.
-            info (dict): Always empty.
+            info (dict): Empty, or {'frame_stale': True} when the frame of the step was lost and the observation is the previous frame.
         '''
-        go_forward      = action['action'][0] > 0.0
-        go_backward     = action['action'][1] > 0.0
-        look_backward   = action['action'][2] > 0.0
-        throw_horn      = action['action'][3] > 0.0
-        bump_drift      = action['action'][4] > 0.0
-        go_x_direction  = action['action'][5]
-        set_y_direction = action['action'][6]
+        try:
+            self.client.action_game(*self._parse_action(action), timeout=self.timeout)
+        except (client.ServerLostError, TimeoutError):
+            return self._truncated_results()
+        return self._step_results()
 
-        self.client.action_game(go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift)
-        self._frame = self.client.step_frame
+    def step_async(self, action):
+        '''
+        Send the action and return without waiting for the game.
+        Call "step_wait()" to get the result. Meanwhile the caller can compute the action of another environment.
+        Parameters:
+            action (dict): See "step()".
+        Returns:
+            The "concurrent.futures.Future" of the step in flight, done when "step_wait()" will not block.
+        '''
+        try:
+            self._step_future = self.client.step_async(*self._parse_action(action), timeout=self.timeout)
+        except (client.ServerLostError, TimeoutError) as e:
+            # "step_wait()" will return a truncated step
+            self._step_future = concurrent.futures.Future()
+            self._step_future.set_exception(e)
+        return self._step_future
+
+    def step_wait(self, timeout=None):
+        '''
+        Wait the result of the last "step_async()".
+        Parameters:
+            timeout (float): Maximum time in seconds to wait. None wait forever.
+        Returns:
+            The same values as "step()".
+        '''
+        if self._step_future is None:
+            raise RuntimeError("No step in flight, call step_async() first.")
+        future, self._step_future = self._step_future, None
+        if timeout is None:
+            timeout = self.timeout
+        if future.cancelled():
+            # Given up by the client (timeout of a previous wait, reset)
+            return self._truncated_results()
+        try:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+            # Wait through the client: in sequenced mode the action is sent again if its reply is lost
+            self.client.wait_step(timeout)
+        except (client.ServerLostError, TimeoutError):
+            return self._truncated_results()
+        return self._step_results()
+
+    def _parse_action(self, action):
+        # Returns the arguments of "Client.action_game". The action is kept for the recorder
+        self._action = action['action']
+        go_forward      = bool(action['action'][0] > 0.0)
+        go_backward     = bool(action['action'][1] > 0.0)
+        look_backward   = bool(action['action'][2] > 0.0)
+        throw_horn      = bool(action['action'][3] > 0.0)
+        bump_drift      = bool(action['action'][4] > 0.0)
+        go_x_direction  = float(action['action'][5])
+        set_y_direction = float(action['action'][6])
+        return go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift
+
+    def _step_results(self):
+        self._frame = self._take_frame()
+        if self.pipeline is not None:
+            self.pipeline.step(self._frame)
 
         observation = self._get_obs()
         info        = self._get_info()
@@ -199,6 +321,9 @@ class EnvMarioKart8(gym.Env):
         step_no     = self.client.step_no
         terminated  = self.client.step_terminal
 
+        if self.recorder is not None:
+            self.recorder.record(self._frame, self._action, reward, terminated, False, False, self.client)
+
         if self.render_mode == "human":
             self._render_frame()
         
@@ -209,6 +334,15 @@ class EnvMarioKart8(gym.Env):
 
         return observation, reward, terminated, info
 
+    def _truncated_results(self):
+        # The server died or did not answer: the episode ends on the last frame received
+        observation = self._get_obs()
+        info        = dict(self._get_info(), server_lost=True)
+        info['TimeLimit.truncated'] = True
+        if self.recorder is not None and self._frame is not None:
+            self.recorder.record(self._frame, self._action, 0.0, True, True, False, self.client)
+        return observation, 0.0, True, info
+
     def render(self):
         return self._render_frame()
 
@@ -218,6 +352,567 @@ class EnvMarioKart8(gym.Env):
             cv2.waitKey(10)
         return self._frame
 
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class AsyncEnvMarioKart8(EnvMarioKart8):
+    '''
+    Asyncio version of "EnvMarioKart8": "reset()" and "step()" are coroutines.
+    All the instances created in the same event loop share one thread, so a single learner process can drive many remote game instances.
+    Usage:
+        env = AsyncEnvMarioKart8(host, port, target_instance, game_setup, callback_reset_game_setup)
+        await env.start()
+        obs, nfo = await env.reset()
+        obs, rwd, end, nfo = await env.step(act)
+    '''
+
+    def _make_client(self, host, port, target_instance):
+        if self.broker is not None:
+            raise ValueError("The loopback broker is not available with asyncio (the client needs the paho sockets).")
+        return client.AsyncClient(host, port, target_instance, sequenced=self.sequenced)
+
+    async def start(self):
+        '''
+        Connect the client and wait until the server is ready.
+        '''
+        await self.client.start()
+
+    async def reset(self):
+        '''
+        Reset the environment. See "EnvMarioKart8.reset".
+        '''
+        self._prepare_reset()
+        await self._reset_game()
+        return self._reset_results()
+
+    async def _reset_game(self):
+        while True:
+            try:
+                await self.client.wait_server()
+                self.client.setup_game(self.game_setup)
+                await self.client.reset_game(self.reset_timeout)
+                return
+            except client.ServerLostError:
+                pass
+
+    async def step(self, action):
+        '''
+        Make one step in the environment. See "EnvMarioKart8.step".
+        '''
+        try:
+            await self.client.action_game(*self._parse_action(action), timeout=self.timeout)
+        except (client.ServerLostError, TimeoutError):
+            return self._truncated_results()
+        return self._step_results()
+
+    async def close(self):
+        await self.client.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class EnvMarioKart8Vec(gym.Env):
+    '''
+    Batched environment over several server instances.
+    The N actions are sent at once and the N steps are awaited together, so the network round trips of the instances overlap.
+    An instance that terminates is reset on its own (auto-reset):
+        - By default the reset is done during the "step()" and the observation is the first one of the new episode.
+        - With "background_reset=True" the reset runs in background while the other instances keep stepping.
+          Until the instance rejoins the batch, its action is ignored and its info contains 'resetting': True (last frame, reward 0).
+          The step where it rejoins returns the first observation of the new episode with 'reset': True in its info.
+    '''
+
+    metadata = EnvMarioKart8.metadata
+
+    def __init__(self, host, port, target_instances, game_setup, callback_reset_game_setup, background_reset=False, timeout=None, reset_timeout=None, preprocess=None, record=None):
+        '''
+        Instanciate one "EnvMarioKart8" per instance and connect them in parallel.
+        Parameters:
+            host (str): IPv4 address of the MQTT server.
+            port (int): TCP/IP Port of the MQTT server.
+            target_instances (list): The ids of the instances which the servers are listening.
+            game_setup (dict): The wanted game state (see "EnvMarioKart8"). Each instance get its own copy.
+            callback_reset_game_setup (callable): Called with the "EnvMarioKart8" of the instance just before it is reset.
+            background_reset (bool): Reset the terminated instances in background instead of blocking "step()".
+            timeout (float): Maximum time in seconds to wait for each server answer (see "EnvMarioKart8").
+                An instance whose server died returns a truncated terminal step and is auto-reset once the server is back.
+            reset_timeout (float): Maximum time in seconds to wait for each server answer during a reset (see "EnvMarioKart8").
+            preprocess (dict): Observation pipeline of each instance (see "EnvMarioKart8").
+            record (str): Folder where the trajectories are recorded, one sub-folder per instance (see "EnvMarioKart8").
+        Returns:
+            An "EnvMarioKart8Vec" environment.
+        '''
+        self.num_envs = len(target_instances)
+        self.background_reset = background_reset
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_envs)
+        # Each constructor block until its server is ready: run them in parallel
+        self.envs = list(self._executor.map(lambda target_instance: EnvMarioKart8(host, port, target_instance, dict(game_setup), callback_reset_game_setup, timeout=timeout, reset_timeout=reset_timeout, preprocess=preprocess, record=None if record is None else os.path.join(record, target_instance)), target_instances))
+        #
+        self.window_size = self.envs[0].window_size
+        self.observation_space = gym.spaces.Dict(
+            {
+                'image': gym.spaces.Box(low=0, high=255, shape=(self.num_envs,) + self.envs[0].observation_space['image'].shape, dtype=np.uint8),
+            }
+        )
+        self.action_space = gym.spaces.Dict(
+            {
+                'action': gym.spaces.Box(low=-1.0, high=1.0, shape=(self.num_envs, 7), dtype=np.float32)
+            }
+        )
+        #
+        self._frames = np.zeros(self.observation_space['image'].shape, dtype=np.uint8)
+        self._resets = {} # Index -> Future of the instances being reset in background
+
+    def _reset_envs(self, indices):
+        # The menu navigation of each instance runs on its own server: reset them in parallel
+        return list(self._executor.map(lambda idx: self.envs[idx].reset(), indices))
+
+    def reset(self):
+        '''
+        Reset all the instances.
+        Returns:
+            observation (dict): The stacked frames {'image': np.ndarray (N, 128, 128, 3) uint8}, or (N,) + the shape of the preprocessed observation.
+            info (list): One info dict per instance.
+        '''
+        # The instances already being reset in background are not reset twice
+        pending = self._resets
+        self._resets = {}
+        results = self._reset_envs([idx for idx in range(self.num_envs) if idx not in pending])
+        results = iter(results)
+        info = [None] * self.num_envs
+        for idx in range(self.num_envs):
+            obs, info[idx] = pending[idx].result() if idx in pending else next(results)
+            self._frames[idx] = obs['image']
+        return {'image': self._frames.copy()}, info
+
+    def step(self, actions):
+        '''
+        Make one step in all the instances.
+        Parameters:
+            actions (dict): An dict with an 'action' key of shape (N, 7). See "EnvMarioKart8.step" for the layout of each row.
+        Returns:
+            observation (dict): The stacked frames {'image': np.ndarray (N, 128, 128, 3) uint8}, or (N,) + the shape of the preprocessed observation.
+            reward (np.ndarray): The rewards (N,) float32.
+            terminated (np.ndarray): The terminal flags (N,) bool.
+            info (list): One info dict per instance. When an instance was auto-reset, its last observation is in info['final_observation'].
+        '''
+        if self._resets and len(self._resets) == self.num_envs:
+            # Nothing to step: wait for the first instance to rejoin the batch
+            concurrent.futures.wait(self._resets.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+        #
+        active = [idx for idx in range(self.num_envs) if idx not in self._resets]
+        for idx in active:
+            self.envs[idx].step_async({'action': actions['action'][idx]})
+        #
+        frames      = self._frames
+        reward      = np.zeros(self.num_envs, dtype=np.float32)
+        terminated  = np.zeros(self.num_envs, dtype=bool)
+        info        = [None] * self.num_envs
+        for idx in active:
+            obs, reward[idx], terminated[idx], info[idx] = self.envs[idx].step_wait()
+            frames[idx] = obs['image']
+        # Background resets: the instance rejoins the batch once its first step was received
+        for idx, future in list(self._resets.items()):
+            if future.done():
+                obs, nfo = future.result()
+                frames[idx] = obs['image']
+                info[idx] = dict(nfo, reset=True)
+                del self._resets[idx]
+            else:
+                info[idx] = {'resetting': True}
+        #
+        done = np.flatnonzero(terminated)
+        if len(done) > 0:
+            if self.background_reset:
+                for idx in done:
+                    self._resets[idx] = self._executor.submit(self.envs[idx].reset)
+            else:
+                for idx, (obs, _) in zip(done, self._reset_envs(done)):
+                    info[idx] = dict(info[idx], final_observation={'image': frames[idx].copy()})
+                    frames[idx] = obs['image']
+        return {'image': frames.copy()}, reward, terminated, info
+
+    def render(self):
+        return np.stack([env.render() for env in self.envs])
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+        self._executor.shutdown(wait=False)
+
+
+class InstanceStatistics:
+    '''
+    Step rate statistics of one server instance, used to find the lagging hosts.
+    The rates are exponential moving averages so they follow the recent behavior of the instance.
+    '''
+
+    def __init__(self, smoothing=0.05):
+        self.smoothing      = smoothing
+        self.steps          = 0
+        self.resets         = 0
+        self.latency        = None # Mean time between "send()" and the arrival of the step (s)
+        self.interval       = None # Mean time between two steps of the instance (s)
+        self._last_time     = None
+
+    def _average(self, mean, value):
+        if mean is None:
+            return value
+        return mean + self.smoothing * (value - mean)
+
+    def record_step(self, latency, now):
+        self.steps      += 1
+        self.latency    = self._average(self.latency, latency)
+        if self._last_time is not None:
+            self.interval = self._average(self.interval, now - self._last_time)
+        self._last_time = now
+
+    def record_reset(self):
+        self.resets     += 1
+        # The reset duration must not be counted as an step interval
+        self._last_time = None
+
+    def as_dict(self):
+        return {
+            'steps'             : self.steps,
+            'resets'            : self.resets,
+            'latency'           : self.latency,
+            'steps_per_second'  : (1.0 / self.interval) if self.interval else None,
+        }
+
+
+class EnvMarioKart8Pool:
+    '''
+    Asynchronous pool of server instances (EnvPool-like API).
+    "send()" dispatches actions to some instances and "recv()" returns the first "batch_size" instances that published their next step,
+    so a slow emulator does not hold back the whole batch.
+    An instance that terminates is reset by the next "send()" to it: the action is ignored and "recv()" will return the first observation of the new episode.
+    With "background_reset=True" the reset starts as soon as "recv()" returns the terminal step, so the menu navigation overlaps the stepping of the other instances.
+    The next action sent to this instance is ignored in the same way.
+    Usage:
+        pool = EnvMarioKart8Pool(host, port, target_instances, game_setup, callback_reset_game_setup, batch_size=4)
+        pool.reset()
+        while True:
+            obs, rwd, end, nfo, env_ids = pool.recv()
+            pool.send(policy(obs), env_ids)
+    '''
+
+    def __init__(self, host, port, target_instances, game_setup, callback_reset_game_setup, batch_size=None, background_reset=False, timeout=None, reset_timeout=None, preprocess=None, record=None):
+        '''
+        Instanciate one "EnvMarioKart8" per instance and connect them in parallel.
+        Parameters:
+            host (str): IPv4 address of the MQTT server.
+            port (int): TCP/IP Port of the MQTT server.
+            target_instances (list): The ids of the instances which the servers are listening.
+            game_setup (dict): The wanted game state (see "EnvMarioKart8"). Each instance get its own copy.
+            callback_reset_game_setup (callable): Called with the "EnvMarioKart8" of the instance just before it is reset.
+            batch_size (int): Number of instances returned by "recv()". Default to all the instances (synchronous pool).
+            background_reset (bool): Start the reset of the terminated instances from "recv()" instead of waiting the next "send()".
+            timeout (float): Maximum time in seconds to wait for the server before sending an action (see "EnvMarioKart8").
+                An instance whose server died is returned by "recv()" with a truncated terminal step and reset once the server is back.
+            reset_timeout (float): Maximum time in seconds to wait for each server answer during a reset (see "EnvMarioKart8").
+            preprocess (dict): Observation pipeline of each instance (see "EnvMarioKart8").
+            record (str): Folder where the trajectories are recorded, one sub-folder per instance (see "EnvMarioKart8").
+        Returns:
+            An "EnvMarioKart8Pool".
+        '''
+        self.num_envs   = len(target_instances)
+        self.background_reset = background_reset
+        self.batch_size = self.num_envs if batch_size is None else batch_size
+        if not (0 < self.batch_size <= self.num_envs):
+            raise ValueError("batch_size must be in [1; {}].".format(self.num_envs))
+        self.target_instances = list(target_instances)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_envs)
+        self.envs = list(self._executor.map(lambda target_instance: EnvMarioKart8(host, port, target_instance, dict(game_setup), callback_reset_game_setup, timeout=timeout, reset_timeout=reset_timeout, preprocess=preprocess, record=None if record is None else os.path.join(record, target_instance)), target_instances))
+        #
+        self.statistics = [InstanceStatistics() for _ in range(self.num_envs)]
+        # Ids of the instances whose result is available, filled from the client threads
+        self._ready         = queue.Queue()
+        self._lock          = threading.Lock()
+        self._pending       = [None] * self.num_envs # None, "step", "done" (step put in "_ready") or "reset"
+        self._needs_reset   = [False] * self.num_envs
+        self._skip_send     = [False] * self.num_envs
+        self._sent_time     = [None] * self.num_envs
+        self._lost          = [False] * self.num_envs # The step in flight will never come (server dead)
+        self._reset_error   = [None] * self.num_envs # Exception raised by the reset in background
+        self._deferred_error = None # Reset error to raise at the next "recv()"
+        for idx, env in enumerate(self.envs):
+            env.client.callback_new_step = self._new_step_callback(idx)
+            env.client.callback_server_lost = self._server_lost_callback(idx)
+
+    def _step_done(self, idx, lost):
+        # Single "step" -> "done" transition: the instance is put once in "_ready", by the first of the step, the server loss or the send error
+        with self._lock:
+            if self._pending[idx] != "step":
+                return False
+            self._pending[idx] = "done"
+            self._lost[idx] = lost
+        self._ready.put(idx)
+        return True
+
+    def _new_step_callback(self, idx):
+        def callback(instance):
+            now = time.perf_counter()
+            if self._step_done(idx, False):
+                self.statistics[idx].record_step(now - self._sent_time[idx], now)
+        return callback
+
+    def _server_lost_callback(self, idx):
+        def callback(instance):
+            self._step_done(idx, True)
+        return callback
+
+    def _reset_task(self, idx):
+        env = self.envs[idx]
+        try:
+            env._prepare_reset()
+            env._reset_game()
+        except Exception as e:
+            # Given to "recv()", which starts the reset again and raises it
+            self._reset_error[idx] = e
+        else:
+            self.statistics[idx].record_reset()
+        self._ready.put(idx)
+
+    def _start_reset(self, idx):
+        with self._lock:
+            self._pending[idx] = "reset"
+        self._needs_reset[idx] = False
+        self._executor.submit(self._reset_task, idx)
+
+    def reset(self):
+        '''
+        Send the reset order to all the instances.
+        The first observations are then returned by "recv()".
+        '''
+        for idx in range(self.num_envs):
+            self._start_reset(idx)
+
+    def send(self, actions, env_ids):
+        '''
+        Send the actions of some instances without waiting for the results.
+        Parameters:
+            actions (dict): An dict with an 'action' key of shape (len(env_ids), 7). See "EnvMarioKart8.step" for the layout of each row.
+            env_ids (list): The index of the instance of each row, as returned by "recv()".
+        '''
+        for idx, action in zip(env_ids, actions['action']):
+            if self._skip_send[idx]:
+                # Action of a terminal step, the instance is already being reset in background
+                self._skip_send[idx] = False
+                continue
+            if self._needs_reset[idx]:
+                self._start_reset(idx)
+                continue
+            env = self.envs[idx]
+            with self._lock:
+                self._pending[idx] = "step"
+            self._sent_time[idx] = time.perf_counter()
+            try:
+                env.client.send_action(*env._parse_action({'action': action}), timeout=env.timeout)
+            except (client.ServerLostError, TimeoutError):
+                self._step_done(idx, True)
+
+    def recv(self, timeout=None):
+        '''
+        Wait for the first "batch_size" instances that have a result available.
+        An instance whose reset failed (e.g. "reset_timeout" exceeded) is reset again and the error is raised,
+        by the next call when the results of other instances are already taken.
+        Parameters:
+            timeout (float): Maximum time in seconds to wait for each instance. None wait forever.
+        Returns:
+            observation (dict): The stacked frames {'image': np.ndarray (K, 128, 128, 3) uint8}, or (K,) + the shape of the preprocessed observation.
+            reward (np.ndarray): The rewards (K,) float32. 0.0 for the first step of an episode.
+            terminated (np.ndarray): The terminal flags (K,) bool.
+            info (list): One info dict per instance with the keys 'env_id' and 'target_instance'.
+            env_ids (np.ndarray): The index of the instances (K,), to be passed back to "send()".
+        '''
+        env_ids     = np.zeros(self.batch_size, dtype=np.int64)
+        frames      = np.empty((self.batch_size,) + self.envs[0].observation_space['image'].shape, dtype=np.uint8)
+        reward      = np.zeros(self.batch_size, dtype=np.float32)
+        terminated  = np.zeros(self.batch_size, dtype=bool)
+        info        = [None] * self.batch_size
+        error, self._deferred_error = self._deferred_error, None
+        if error is not None:
+            raise error
+        for row in range(self.batch_size):
+            while True:
+                try:
+                    idx = self._ready.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError("No instance published a step after {} s.".format(timeout))
+                with self._lock:
+                    kind = self._pending[idx]
+                    lost = self._lost[idx]
+                    error = self._reset_error[idx]
+                    self._pending[idx] = None
+                    self._lost[idx] = False
+                    self._reset_error[idx] = None
+                if error is None:
+                    break
+                # The instance stays in the pool: its reset is started again
+                self._start_reset(idx)
+                if row == 0:
+                    raise error
+                self._deferred_error = error
+            env = self.envs[idx]
+            if kind == "reset":
+                obs, nfo = env._reset_results()
+            else:
+                if lost:
+                    obs, reward[row], terminated[row], nfo = env._truncated_results()
+                else:
+                    obs, reward[row], terminated[row], nfo = env._step_results()
+                if terminated[row]:
+                    if self.background_reset:
+                        self._skip_send[idx] = True
+                        self._start_reset(idx)
+                    else:
+                        self._needs_reset[idx] = True
+            env_ids[row]    = idx
+            frames[row]     = obs['image']
+            info[row]       = dict(nfo, env_id=idx, target_instance=self.target_instances[idx])
+        return {'image': frames}, reward, terminated, info, env_ids
+
+    def get_statistics(self):
+        '''
+        Get the step rate statistics of each instance.
+        Returns:
+            An dict {target_instance: {'steps', 'resets', 'latency', 'steps_per_second'}}.
+        '''
+        return {target_instance: stats.as_dict() for target_instance, stats in zip(self.target_instances, self.statistics)}
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+        self._executor.shutdown(wait=False)
+
+
+class EnvMarioKart8Replay(gym.Env):
+    '''
+    Offline environment serving the episodes recorded by an "EnvMarioKart8" (see its "record" argument), without emulator nor broker.
+    It has the spaces and the "reset()" / "step()" of "EnvMarioKart8" but the recorded trajectory is replayed:
+    the action given to "step()" is ignored and the recorded one is returned in info['action'].
+    The frames are zero-copy views on the memory-mapped shards, so learner input pipelines can be benchmarked at memory speed.
+    Usage:
+        env = EnvMarioKart8Replay("./trajectories")
+        obs, nfo = env.reset()
+        obs, rwd, end, nfo = env.step(act)
+        windows = env.sample_windows(batch_size=16, length=64)
+    '''
+
+    metadata = EnvMarioKart8.metadata
+
+    def __init__(self, path, preprocess=None, shuffle=True, seed=None):
+        '''
+        Map the recordings.
+        Parameters:
+            path (str): Folder of a recording, or folder of several recordings (e.g. one per instance of an "EnvMarioKart8Vec").
+            preprocess (dict): Observation pipeline applied to the recorded frames (see "EnvMarioKart8").
+            shuffle (bool): "reset()" picks a random episode. Otherwise the episodes are served in the recorded order, in loop.
+            seed (int): Seed of the random episodes and windows.
+        Returns:
+            An "EnvMarioKart8Replay" environment.
+        '''
+        if os.path.exists(os.path.join(path, recorder.INDEX_FILE)):
+            paths = [path]
+        else:
+            paths = sorted(os.path.join(path, name) for name in os.listdir(path) if os.path.exists(os.path.join(path, name, recorder.INDEX_FILE)))
+        self.readers = [recorder.TrajectoryReader(p) for p in paths]
+        self.episodes = [(reader,) + episode for reader in self.readers for episode in reader.episodes]
+        if not self.episodes:
+            raise ValueError("No recorded episode in '{}'.".format(path))
+        #
+        self.window_size = 128
+        self.pipeline = None if preprocess is None else preprocessing.ObservationPipeline(**preprocess)
+        obs_shape = common.STEP_FRAME_SHAPE if self.pipeline is None else self.pipeline.shape
+        self.observation_space = gym.spaces.Dict(
+            {
+                'image': gym.spaces.Box(low=0, high=255, shape=obs_shape, dtype=np.uint8),
+            }
+        )
+        self.action_space = gym.spaces.Dict(
+            {
+                'action': gym.spaces.Box(low=-1.0, high=1.0, shape=(7,), dtype=np.float32)
+            }
+        )
+        self.render_mode = "rgb_array"
+        #
+        self.shuffle    = shuffle
+        self._rng       = np.random.default_rng(seed)
+        self._next      = 0
+        self._episode   = None
+        self._pos       = None
+        self._row       = None
+
+    def _get_obs(self):
+        if self.pipeline is not None:
+            return {'image': self.pipeline.observation()}
+        return {'image': self._row['frame']}
+
+    def reset(self):
+        '''
+        Start the replay of an episode.
+        Returns:
+            observation (dict): The first recorded observation in the format {'image':...}.
+            info (dict): Always empty.
+        '''
+        super().reset()
+        if self.shuffle:
+            self._episode = self.episodes[self._rng.integers(len(self.episodes))]
+        else:
+            self._episode = self.episodes[self._next]
+            self._next = (self._next + 1) % len(self.episodes)
+        self._pos = 0
+        self._row = self._episode[0].row(self._episode[1])
+        if self.pipeline is not None:
+            self.pipeline.reset(self._row['frame'])
+        return self._get_obs(), {}
+
+    def step(self, action):
+        '''
+        Serve the next recorded step.
+        Parameters:
+            action (dict): Ignored, the recorded action is returned in info['action'].
+        Returns:
+            observation (dict): The recorded observation.
+            reward (float): The recorded reward.
+            terminated (bool): If this is the last step of the episode.
+            info (dict): {'action': the recorded action}, with 'TimeLimit.truncated' if the episode was truncated or not finished.
+        '''
+        reader, start, length, _, _ = self._episode
+        if self._pos + 1 >= length:
+            raise RuntimeError("End of the episode, call reset() first.")
+        self._pos += 1
+        self._row = reader.row(start + self._pos)
+        if self.pipeline is not None:
+            self.pipeline.step(self._row['frame'])
+        last        = self._pos + 1 == length
+        terminated  = bool(self._row['terminal']) or last
+        info        = {'action': self._row['action']}
+        if self._row['truncated'] or (last and not self._row['terminal']):
+            info['TimeLimit.truncated'] = True
+        return self._get_obs(), float(self._row['reward']), terminated, info
+
+    def sample_windows(self, batch_size, length):
+        '''
+        Draw random windows of consecutive steps among all the recorded episodes (see "recorder.TrajectoryReader.sample_windows").
+        Returns:
+            A list of "batch_size" arrays of "length" rows (see "recorder.RECORD_DTYPE"), zero-copy slices of the shards.
+        '''
+        counts = np.array([sum(max(0, episode[1] - length + 1) for episode in reader.episodes) for reader in self.readers], dtype=np.float64)
+        if counts.sum() == 0:
+            raise ValueError("No episode has {} rows.".format(length))
+        picks = self._rng.choice(len(self.readers), size=batch_size, p=counts/counts.sum())
+        windows = []
+        for idx, count in zip(*np.unique(picks, return_counts=True)):
+            windows += self.readers[idx].sample_windows(int(count), length, self._rng)
+        return windows
+
+    def render(self):
+        return self._row['frame']
+
     def close(self):
         pass
 
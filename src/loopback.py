@@ -0,0 +1,203 @@
+import threading
+import queue
+
+
+def topic_matches(subscription, topic):
+    '''
+    MQTT topic filter matching: "+" matches one level, "#" (last level only) matches the remaining levels, including none.
+    '''
+    sub_levels  = subscription.split('/')
+    levels      = topic.split('/')
+    for idx, sub_level in enumerate(sub_levels):
+        if sub_level == '#':
+            return True
+        if idx >= len(levels):
+            return False
+        if sub_level != '+' and sub_level != levels[idx]:
+            return False
+    return len(sub_levels) == len(levels)
+
+
+def _to_payload(payload):
+    # Same conversions as paho: None is an empty message, numbers and strings are sent as text
+    if payload is None:
+        return b''
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('ascii')
+    return bytes(payload)
+
+
+class LoopbackMessage:
+    '''
+    Message delivered to "on_message", with the attributes of "paho.mqtt.client.MQTTMessage" used by the protocol.
+    '''
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload, qos, retain):
+        self.topic      = topic
+        self.payload    = payload
+        self.qos        = qos
+        self.retain     = retain
+
+
+class LoopbackBroker:
+    '''
+    In-process stand-in for the MQTT broker: the clients and servers of the same process exchange their messages through in-memory queues.
+    The topic semantics of a broker are kept (retained messages, "+" / "#" subscriptions, last will), so the protocol code runs unchanged
+    and its cost can be measured without the broker and TCP overhead.
+    The qos is kept on the messages but every message is delivered exactly once, in publish order, to each subscribed client.
+    Usage:
+        broker  = LoopbackBroker()
+        manager = server.Manager(instance_id="00000000", broker=broker, backend=synthetic.SyntheticBackend())
+        env     = gym_mk8.EnvMarioKart8(None, None, "00000000", game_setup, callback_reset_game_setup, broker=broker)
+    '''
+
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._clients   = []
+        self._retained  = {} # topic -> LoopbackMessage
+        self.reset_stats()
+
+    def client(self):
+        '''
+        Returns:
+            An "LoopbackClient" connected to this broker, used in place of "paho.mqtt.client.Client()".
+        '''
+        return LoopbackClient(self)
+
+    def reset_stats(self):
+        with self._lock:
+            self.published_messages = 0
+            self.published_bytes    = 0 # Topic and payload bytes, as carried by a broker
+            self.delivered_messages = 0
+            self.delivered_bytes    = 0
+
+    def _connect(self, client):
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+
+    def _disconnect(self, client, clean):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        if not clean and client._will is not None:
+            self.publish(*client._will)
+
+    def _subscribe(self, client, subscription):
+        with self._lock:
+            client._subscriptions.add(subscription)
+            for topic, msg in self._retained.items():
+                if topic_matches(subscription, topic):
+                    self._deliver(client, msg)
+
+    def _unsubscribe(self, client, subscription):
+        with self._lock:
+            client._subscriptions.discard(subscription)
+
+    def _deliver(self, client, msg):
+        self.delivered_messages += 1
+        self.delivered_bytes    += len(msg.topic) + len(msg.payload)
+        client._inbox.put(msg)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        payload = _to_payload(payload)
+        with self._lock:
+            self.published_messages += 1
+            self.published_bytes    += len(topic) + len(payload)
+            if retain:
+                # An empty retained message clears the retained message of the topic
+                if len(payload) == 0:
+                    self._retained.pop(topic, None)
+                else:
+                    self._retained[topic] = LoopbackMessage(topic, payload, qos, True)
+            msg = LoopbackMessage(topic, payload, qos, False)
+            for client in self._clients:
+                if any(topic_matches(subscription, topic) for subscription in client._subscriptions):
+                    self._deliver(client, msg)
+
+
+class LoopbackClient:
+    '''
+    Drop-in replacement of "paho.mqtt.client.Client" connected to an "LoopbackBroker".
+    Only the part of the paho interface used by the client and the server is provided.
+    Like paho, the callbacks are called from the network loop ("loop_forever()" or the thread of "loop_start()").
+    '''
+
+    # Wakes the network loop to call "on_connect" / to stop it
+    _CONNECT    = object()
+    _STOP       = object()
+
+    def __init__(self, broker):
+        self.broker         = broker
+        self.on_connect     = None
+        self.on_message     = None
+        self._subscriptions = set()
+        self._inbox         = queue.Queue()
+        self._will          = None
+        self._thread        = None
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self._will = (topic, payload, qos, retain)
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect(self, host=None, port=None, keepalive=60):
+        '''
+        Connect to the broker, "host" and "port" are ignored.
+        '''
+        self.broker._connect(self)
+        self._inbox.put(LoopbackClient._CONNECT)
+
+    def reconnect(self):
+        self.connect()
+
+    def disconnect(self):
+        '''
+        Clean disconnection: the last will is not published. The network loop stops.
+        '''
+        self.broker._disconnect(self, clean=True)
+        self._subscriptions.clear()
+        self._inbox.put(LoopbackClient._STOP)
+
+    def kill(self):
+        '''
+        Unexpected disconnection (e.g. a crashed server): the broker publishes the last will. The network loop stops.
+        '''
+        self.broker._disconnect(self, clean=False)
+        self._subscriptions.clear()
+        self._inbox.put(LoopbackClient._STOP)
+
+    def subscribe(self, topic, qos=0):
+        self.broker._subscribe(self, topic)
+
+    def unsubscribe(self, topic):
+        self.broker._unsubscribe(self, topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload=payload, qos=qos, retain=retain)
+
+    def loop_forever(self):
+        while True:
+            msg = self._inbox.get()
+            if msg is LoopbackClient._STOP:
+                return
+            if msg is LoopbackClient._CONNECT:
+                if self.on_connect is not None:
+                    self.on_connect(self, None, {}, 0)
+            elif self.on_message is not None:
+                self.on_message(self, None, msg)
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop_forever, daemon=True)
+            self._thread.start()
+
+    def loop_stop(self):
+        if self._thread is not None:
+            self._inbox.put(LoopbackClient._STOP)
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,218 @@
+import numpy as np
+import subprocess
+import itertools
+import platform
+import argparse
+import loopback
+import common
+import timeit
+import types
+import json
+import time
+import os
+
+
+# Microbenchmarks of the per-step hot paths of the client and the server, with reproducible inputs and a JSON output comparable across commits.
+# Run it from the "src" directory:
+#     python microbench.py --output before.json
+#     python microbench.py --output after.json --compare before.json
+# Each case is timed with "timeit": the number of calls is calibrated to last at least "min_time" seconds, then the measure is repeated.
+# The times are per call, in seconds. A group of cases whose dependencies are missing (e.g. gym on a server, Xlib on a client) is skipped.
+
+
+ROOT = "Mario_Kart_8/00000000"
+
+
+def _reference_frame(frames_path):
+    return np.load(os.path.join(frames_path, sorted(os.listdir(frames_path))[0]))
+
+
+def _message(topic, payload):
+    return loopback.LoopbackMessage(topic, payload, 0, False)
+
+
+def _alternate(handler, messages):
+    # The step messages alternate between two step numbers so that each call signals a new step
+    messages = itertools.cycle(messages)
+    return lambda: handler(None, None, next(messages))
+
+
+def _cases_client(frames_path, seed):
+    import client
+    frame = _reference_frame(frames_path)
+    instance = client.Client(None, None, "00000000", broker=loopback.LoopbackBroker())
+    steps = [{name: 0 for name in common.STEP_SCHEMA.names} for _ in range(2)]
+    for no, values in enumerate(steps, start=1):
+        values['no'] = no
+        values['frame_codec'] = common.Server.FrameCodec.RAW
+    cases = {}
+    cases['client_on_message/step/record'] = _alternate(instance._on_message, [_message(ROOT+"/step/record", common.STEP_SCHEMA.pack_dict(values)+frame.tobytes()) for values in steps])
+    cases['client_on_message/step/frame'] = _alternate(instance._on_message, [_message(ROOT+"/step/frame", frame.tobytes())])
+    for name in common.STEP_SCHEMA.names[1:]:
+        cases['client_on_message/step/'+name] = _alternate(instance._on_message, [_message(ROOT+"/step/"+name, common.STEP_SCHEMA.pack_field(name, 0))])
+    cases['client_on_message/step'] = _alternate(instance._on_message, [_message(ROOT+"/step", common.STEP_SCHEMA.pack_field('no', values['no'])) for values in steps])
+    cases['client_on_message/status'] = _alternate(instance._on_message, [_message(ROOT+"/status", common.STATUS_SCHEMA.pack_field('status', True))])
+    for name in common.STATUS_SCHEMA.names[1:]:
+        cases['client_on_message/status/'+name] = _alternate(instance._on_message, [_message(ROOT+"/status/"+name, common.STATUS_SCHEMA.pack_field(name, True))])
+    cases['client_encode_action'] = lambda: instance._encode_action(1, 0, 0.5, -0.25, 0, 1, 0, 42)
+    return cases
+
+
+def _cases_server(frames_path, seed):
+    import server
+    instance = server.Server(server_callback=lambda client, order: None, instance_id="00000000", broker=loopback.LoopbackBroker())
+    cases = {}
+    cases['server_on_message/order/action'] = _alternate(instance._on_message, [_message(ROOT+"/order/action", common.ACTION_SCHEMA.pack(1, 0, 0.5, -0.25, 0, 1, 0, 42))])
+    cases['server_on_message/order/setup'] = _alternate(instance._on_message, [_message(ROOT+"/order/setup/PLAYER", common.SETUP_SCHEMA.pack_field('PLAYER', common.GameSetup.Player.MASKASS))])
+    return cases
+
+
+def _cases_manager(frames_path, seed):
+    import server
+    frame = _reference_frame(frames_path)
+    # Only the image methods are measured: no game, debugger nor MQTT
+    manager = server.Manager.__new__(server.Manager)
+    cases = {}
+    cases['manager_img_invariant_transformation'] = lambda: manager._img_invariant_transformation(frame)
+    cases['manager_match_track'] = lambda: manager._match_track(frame)
+    return cases
+
+
+def _cases_sampler(frames_path, seed):
+    import synthetic
+    import server
+    # Sampling of the debugger addresses in the memory of a synthetic game (not running), one read per span
+    game    = synthetic.SyntheticGame(seed=seed)
+    items   = list(server.GameDebugger.make_addr_dict().values())
+    cases   = {}
+    for max_gap in (0, 1024):
+        sampler = server.TimerSampler(game, server.GameDebugger.ADDRESSES['timer'], items, max_gap=max_gap)
+        cases['timer_sampler_sample/all/max_gap={}'.format(max_gap)] = sampler.sample
+    # Tiered sampling: only the values of the current scene (the synthetic game starts on the title screen)
+    sampler = server.TimerSampler(game, server.GameDebugger.ADDRESSES['timer'], items, addr_scene=server.GameDebugger.ADDRESSES['scene_id'])
+    cases['timer_sampler_sample/scene'] = sampler.sample
+    return cases
+
+
+def _cases_reward(frames_path, seed):
+    import gym_mk8
+    # The step values of a client racing on the first track, the timer and the lap progress at each call
+    env = gym_mk8.EnvMarioKart8.__new__(gym_mk8.EnvMarioKart8)
+    env.client = types.SimpleNamespace(step_coins=3, step_rank=4, step_timer=0, step_lap_continuous=0.0, step_towing=154, step_track=1401, step_is_race_finish=0)
+    env._last_lap = None
+    env._last_time = None
+    def step():
+        env.client.step_timer += 6
+        env.client.step_lap_continuous += 0.001
+        return env.compute_reward()
+    return {'env_compute_reward': step}
+
+
+def _cases_monitor(frames_path, seed, width=1280, height=720):
+    import platform_specific
+    # Screenshot of the yuzu window as returned by Xlib "get_image" (ZPixmap, 32 bits per pixel)
+    data = np.random.default_rng(seed).integers(0, 256, size=width*height*4, dtype=np.uint8).tobytes()
+    return {'monitor_frame_from_bgrx/{}x{}'.format(width, height): lambda: platform_specific.frame_from_bgrx(data, width, height)}
+
+
+GROUPS = {
+    'client'    : _cases_client,
+    'server'    : _cases_server,
+    'manager'   : _cases_manager,
+    'sampler'   : _cases_sampler,
+    'reward'    : _cases_reward,
+    'monitor'   : _cases_monitor,
+}
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    '''
+    Parameters:
+        fn (callable): The case, called without argument.
+        repeat (int): Number of measures.
+        min_time (float): Minimum duration in seconds of one measure.
+    Returns:
+        An dict {'number' (calls per measure), 'repeat', 'min', 'median', 'mean' (seconds per call)}.
+    '''
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(number, int(np.ceil(number * min_time / 0.2)))
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return {'number': number, 'repeat': repeat, 'min': float(np.min(times)), 'median': float(np.median(times)), 'mean': float(np.mean(times))}
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(frames_path="../datas/img", seed=0, repeat=5, min_time=0.2, pattern=None):
+    '''
+    Run all the cases.
+    Parameters:
+        frames_path (str): Folder of the reference frames (".npy", STEP_FRAME_SHAPE, uint8) used as inputs.
+        seed (int): Seed of the generated inputs.
+        repeat (int): Number of measures per case.
+        min_time (float): Minimum duration in seconds of one measure.
+        pattern (str): Only run the cases whose name contains this string. None run all the cases.
+    Returns:
+        An dict {'meta', 'results' {case: measure (see "measure()")}, 'skipped' {group: reason}}, serializable in JSON.
+    '''
+    report = {
+        'meta'  : {
+            'commit'    : _commit(),
+            'date'      : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python'    : platform.python_version(),
+            'numpy'     : np.__version__,
+            'machine'   : platform.machine(),
+            'processor' : platform.processor(),
+            'seed'      : seed,
+        },
+        'results'   : {},
+        'skipped'   : {},
+    }
+    for group, make_cases in GROUPS.items():
+        try:
+            cases = make_cases(frames_path, seed)
+        except ImportError as e:
+            report['skipped'][group] = str(e)
+            continue
+        for name, fn in cases.items():
+            if pattern is None or pattern in name:
+                report['results'][name] = measure(fn, repeat=repeat, min_time=min_time)
+    return report
+
+
+def compare(report, baseline):
+    '''
+    Returns:
+        An dict {case: median time of "report" / median time of "baseline"} for the cases present in both.
+    '''
+    return {name: r['median'] / baseline['results'][name]['median'] for name, r in report['results'].items() if name in baseline['results']}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the client / server hot paths.")
+    parser.add_argument("--output", help="Write the results in this JSON file.")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with.")
+    parser.add_argument("--filter", help="Only run the cases whose name contains this string.")
+    parser.add_argument("--frames", default="../datas/img", help="Folder of the reference frames.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    args = parser.parse_args()
+    report = run(frames_path=args.frames, seed=args.seed, repeat=args.repeat, min_time=args.min_time, pattern=args.filter)
+    ratios = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            ratios = compare(report, json.load(f))
+    for name, r in report['results'].items():
+        ratio = " | x{:6.3f}".format(ratios[name]) if name in ratios else ""
+        print("{:50s} : median {:12.3f} us | min {:12.3f} us{}".format(name, r['median']*1e6, r['min']*1e6, ratio))
+    for group, reason in report['skipped'].items():
+        print("{:50s} : skipped ({})".format(group, reason))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
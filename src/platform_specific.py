@@ -5,6 +5,21 @@ import time
 import PIL
 
 
+def frame_from_bgrx(data, width, height):
+    '''
+    Convert a raw screenshot of the game window into a step frame.
+    Parameters:
+        data (bytes): The BGRX pixels (X11 ZPixmap image or Windows bitmap), "width" * "height" * 4 bytes.
+        width (int): Width of the screenshot in pixels.
+        height (int): Height of the screenshot in pixels.
+    Returns:
+        The RGB screenshot in the shape [128, 128, 3]
+    '''
+    image = PIL.Image.frombuffer('RGB', (width, height), data, 'raw', 'BGRX', 0, 1)
+    image = image.resize((128, 128))
+    return np.asarray(image, dtype=np.uint8)
+
+
 if platform.system() == "Linux":
     from collections import namedtuple
     import Xlib
@@ -206,9 +221,7 @@ if platform.system() == "Linux":
             x, y, w, h = self._get_window_pos()
 
             x_raw = self.root.get_image(x, y, w, h, Xlib.X.ZPixmap, 0xffffffff)
-            image = PIL.Image.frombuffer('RGB', (w, h), x_raw.data, 'raw', 'BGRX', 0, 1)
-            image = image.resize((128, 128))
-            image = np.asarray(image, dtype=np.uint8)
+            image = frame_from_bgrx(x_raw.data, w, h)
 
             return image
 
@@ -355,10 +368,7 @@ elif platform.system() == "Windows":
             cDC.BitBlt((0, 0), (frm_w, frm_h), dcObj, (frm_x - win_x, frm_y - win_y), win32con.SRCCOPY)
 
             bmpstr  = dataBitMap.GetBitmapBits(True)
-            image   = PIL.Image.frombuffer('RGB', (frm_w, frm_h), bmpstr, 'raw', 'BGRX', 0, 1)
-            # image   = image.crop((0, 50, 100, 100))
-            image   = image.resize((128, 128))
-            image   = np.asarray(image, dtype=np.uint8)
+            image   = frame_from_bgrx(bmpstr, frm_w, frm_h)
 
             # free resources
             dcObj.DeleteDC()
@@ -0,0 +1,97 @@
+import numpy as np
+import common
+import cv2
+
+
+class ObservationPipeline:
+    '''
+    Preprocessing of the game frames into the agent observation: crop, grayscale, resize then frame stacking.
+    All the buffers are allocated once, each new frame is converted by OpenCV directly into a slot of a ring of frames.
+    The ring holds each frame twice ("2 * stack" slots) so the last "stack" frames, oldest first, are always a contiguous slice of it:
+    the observation is a zero-copy view on the ring.
+    '''
+
+    def __init__(self, crop=None, grayscale=False, size=None, stack=1, interpolation=cv2.INTER_AREA):
+        '''
+        Parameters:
+            crop (tuple): Area (top, bottom, left, right) of the frame kept, in pixels. None keep the whole frame.
+            grayscale (bool): Convert the RGB frame to one luminance channel.
+            size (tuple): Size (height, width) of the observation. None keep the size of the (cropped) frame.
+            stack (int): Number of consecutive frames in the observation.
+            interpolation (int): OpenCV interpolation used by the resize.
+        Returns:
+            An "ObservationPipeline" whose observations have the shape "shape":
+            (height, width, channels) or (stack, height, width, channels) when several frames are stacked.
+        '''
+        height, width, _ = common.STEP_FRAME_SHAPE
+        top, bottom, left, right = (0, height, 0, width) if crop is None else crop
+        if not (0 <= top < bottom <= height and 0 <= left < right <= width):
+            raise ValueError("Crop {} is out of the frame {}.".format(crop, common.STEP_FRAME_SHAPE))
+        if stack < 1:
+            raise ValueError("stack must be at least 1.")
+        self.crop           = (top, bottom, left, right)
+        self.grayscale      = grayscale
+        self.size           = (bottom-top, right-left) if size is None else tuple(size)
+        self.stack          = stack
+        self.interpolation  = interpolation
+        self.frame_shape    = self.size + ((1,) if grayscale else (3,))
+        self.shape          = self.frame_shape if stack == 1 else (stack,) + self.frame_shape
+        #
+        self._window    = (slice(top, bottom), slice(left, right))
+        self._resize    = self.size != (bottom-top, right-left)
+        self._dsize     = (self.size[1], self.size[0]) # OpenCV sizes are (width, height)
+        self._gray      = np.empty((bottom-top, right-left), dtype=np.uint8) if grayscale and self._resize else None
+        self._ring      = np.zeros((2*stack,) + self.frame_shape, dtype=np.uint8)
+        self._pos       = 0
+
+    def _convert(self, frame, slot):
+        # The crop is a view, OpenCV reads it with its row stride
+        src = frame[self._window]
+        if self.grayscale:
+            dst = slot[..., 0]
+            if self._resize:
+                cv2.cvtColor(src, cv2.COLOR_RGB2GRAY, dst=self._gray)
+                cv2.resize(self._gray, self._dsize, dst=dst, interpolation=self.interpolation)
+            else:
+                cv2.cvtColor(src, cv2.COLOR_RGB2GRAY, dst=dst)
+        elif self._resize:
+            cv2.resize(src, self._dsize, dst=slot, interpolation=self.interpolation)
+        else:
+            np.copyto(slot, src)
+
+    def reset(self, frame):
+        '''
+        Start a new episode: the stack is filled with its first frame.
+        Parameters:
+            frame (np.ndarray): The RGB frame of the game (STEP_FRAME_SHAPE, uint8).
+        Returns:
+            The observation (see "observation()").
+        '''
+        self._pos = 0
+        self._convert(frame, self._ring[self.stack])
+        self._ring[:] = self._ring[self.stack]
+        return self.observation()
+
+    def step(self, frame):
+        '''
+        Push the frame of a new step on the stack.
+        Parameters:
+            frame (np.ndarray): The RGB frame of the game (STEP_FRAME_SHAPE, uint8).
+        Returns:
+            The observation (see "observation()").
+        '''
+        self._pos = (self._pos + 1) % self.stack
+        slot = self._ring[self._pos + self.stack]
+        self._convert(frame, slot)
+        if self.stack > 1:
+            self._ring[self._pos] = slot
+        return self.observation()
+
+    def observation(self):
+        '''
+        Returns:
+            A zero-copy view ("shape", uint8) on the last frames, oldest first.
+            Like the frames of the shared memory transport, the view is overwritten by the next steps: copy it to keep it.
+        '''
+        view = self._ring[self._pos+1:self._pos+1+self.stack]
+        return view if self.stack > 1 else view[0]
@@ -0,0 +1,241 @@
+import numpy as np
+import threading
+import common
+import queue
+import json
+import os
+
+
+# One row per step: the frame received, the action that produced it, the reward and the flags of the env,
+# followed by the step telemetry as received by the client ("step_<name>" for each field of common.STEP_SCHEMA).
+# The first row of an episode is the observation returned by "reset()": its action and reward are 0 and "first" is True.
+RECORD_DTYPE = np.dtype([
+    ('frame'    , np.uint8, common.STEP_FRAME_SHAPE),
+    ('action'   , '<f4', (7,)),
+    ('reward'   , '<f4'),
+    ('terminal' , '?'),
+    ('truncated', '?'),
+    ('first'    , '?'),
+] + [('step_'+name, common.STEP_SCHEMA.dtype[name]) for name in common.STEP_SCHEMA.names])
+
+INDEX_FILE = "index.json"
+
+
+def shard_path(path, shard):
+    return os.path.join(path, "shard_{:06d}.npy".format(shard))
+
+
+class TrajectoryRecorder:
+    '''
+    Record the trajectories of an environment for offline RL.
+    The rows (see "RECORD_DTYPE") are appended to fixed-size ".npy" shards memory-mapped by a background writer thread.
+    The env thread only copies the step into a preallocated staging slot: it blocks only when all the "queue_size" slots wait for the writer.
+    The file "index.json" lists the shards and the episodes (first row, length, terminated, truncated), it is rewritten at the end of each episode.
+    Usage:
+        recorder = TrajectoryRecorder("./trajectories/00000000")
+        recorder.record(frame, action, reward, terminal, truncated, first, client)
+        recorder.close()
+    '''
+
+    def __init__(self, path, shard_size=4096, queue_size=256):
+        '''
+        Parameters:
+            path (str): Folder of the shards, created if needed. An existing recording is continued.
+            shard_size (int): Number of rows per shard.
+            queue_size (int): Number of steps buffered between the env and the writer thread.
+        Returns:
+            An "TrajectoryRecorder" with its writer thread started.
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.shard_size = shard_size
+        self.steps      = 0
+        self.episodes   = []
+        index_file = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            if index['shard_size'] != shard_size:
+                raise ValueError("The recording in '{}' uses shards of {} rows.".format(path, index['shard_size']))
+            self.steps      = index['steps']
+            self.episodes   = index['episodes']
+        #
+        self._staging   = np.zeros(queue_size, dtype=RECORD_DTYPE)
+        self._free      = queue.Queue()
+        self._ready     = queue.Queue()
+        for slot in range(queue_size):
+            self._free.put(slot)
+        self._shard     = None
+        self._shard_no  = None
+        self._episode   = None # [first row, length, terminated, truncated] of the episode being written
+        self._error     = None
+        self._writer    = threading.Thread(target=self._task_writer, daemon=True)
+        self._writer.start()
+
+    def record(self, frame, action, reward, terminal, truncated, first, client):
+        '''
+        Queue one step. Blocks only if the writer thread is "queue_size" steps behind.
+        Parameters:
+            frame (np.ndarray): The frame of the step (STEP_FRAME_SHAPE, uint8), copied.
+            action (array-like): The 7 floats of the action (see "EnvMarioKart8.step"), None for the first step of an episode.
+            reward (float): The reward of the step.
+            terminal (bool): The env returned a terminal step.
+            truncated (bool): The episode was truncated (e.g. the server died).
+            first (bool): First observation of an episode (returned by "reset()").
+            client (client.ClientProtocol): The client, whose "step_<name>" attributes are copied.
+        '''
+        if self._error is not None:
+            raise RuntimeError("The trajectory writer failed.") from self._error
+        slot = self._free.get()
+        row = self._staging[slot]
+        row['frame']        = frame
+        row['action']       = 0.0 if action is None else action
+        row['reward']       = reward
+        row['terminal']     = terminal
+        row['truncated']    = truncated
+        row['first']        = first
+        for name in common.STEP_SCHEMA.names:
+            value = getattr(client, 'step_'+name)
+            row['step_'+name] = 0 if value is None else value
+        self._ready.put(slot)
+
+    def _task_writer(self):
+        while True:
+            slot = self._ready.get()
+            if slot is None:
+                break
+            try:
+                self._write(self._staging[slot])
+            except Exception as e:
+                self._error = e
+            self._free.put(slot)
+        self._flush()
+        self._write_index()
+
+    def _write(self, row):
+        shard_no, offset = divmod(self.steps, self.shard_size)
+        if shard_no != self._shard_no:
+            self._flush()
+            path = shard_path(self.path, shard_no)
+            if os.path.exists(path):
+                self._shard = np.load(path, mmap_mode='r+')
+            else:
+                self._shard = np.lib.format.open_memmap(path, mode='w+', dtype=RECORD_DTYPE, shape=(self.shard_size,))
+            self._shard_no = shard_no
+        self._shard[offset] = row
+        self.steps += 1
+        #
+        if row['first'] or self._episode is None:
+            self._end_episode()
+            self._episode = [self.steps-1, 0, False, False]
+        self._episode[1] += 1
+        if row['terminal']:
+            self._episode[2] = not bool(row['truncated'])
+            self._episode[3] = bool(row['truncated'])
+            self._end_episode()
+
+    def _end_episode(self):
+        if self._episode is None:
+            return
+        self.episodes.append(self._episode)
+        self._episode = None
+        # The rows must be on disk before the index refers to them
+        self._flush()
+        self._write_index()
+
+    def _flush(self):
+        if self._shard is not None:
+            self._shard.flush()
+
+    def _write_index(self):
+        index = {
+            'shard_size'    : self.shard_size,
+            'steps'         : self.steps,
+            'episodes'      : self.episodes + ([] if self._episode is None else [self._episode]),
+        }
+        tmp = os.path.join(self.path, INDEX_FILE+".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def close(self):
+        '''
+        Write the queued steps and the index, then stop the writer thread.
+        An episode still in progress is listed in the index as neither terminated nor truncated.
+        '''
+        self._ready.put(None)
+        self._writer.join()
+        self._shard = None
+
+
+class TrajectoryReader:
+    '''
+    Read-only access to a recording of "TrajectoryRecorder".
+    The shards are memory-mapped: a row is read from the page cache when accessed, the returned rows are zero-copy views.
+    '''
+
+    def __init__(self, path):
+        '''
+        Parameters:
+            path (str): Folder of the recording (with its "index.json").
+        Returns:
+            An "TrajectoryReader" with all the shards mapped.
+        '''
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.shard_size = index['shard_size']
+        self.steps      = index['steps']
+        # One (first row, length, terminated, truncated) tuple per episode
+        self.episodes   = [tuple(episode) for episode in index['episodes']]
+        shards          = -(-self.steps // self.shard_size)
+        self.shards     = [np.load(shard_path(path, no), mmap_mode='r') for no in range(shards)]
+
+    def __len__(self):
+        return self.steps
+
+    def row(self, idx):
+        '''
+        Returns:
+            A zero-copy view on the row "idx" (see "RECORD_DTYPE").
+        '''
+        shard_no, offset = divmod(idx, self.shard_size)
+        return self.shards[shard_no][offset]
+
+    def window(self, start, length):
+        '''
+        Returns:
+            The rows [start; start+length[. A zero-copy slice of a shard, or a copy if the window crosses the end of a shard.
+        '''
+        shard_no, offset = divmod(start, self.shard_size)
+        if offset + length <= self.shard_size:
+            return self.shards[shard_no][offset:offset+length]
+        parts = []
+        while length > 0:
+            count = min(length, self.shard_size - offset)
+            parts.append(self.shards[shard_no][offset:offset+count])
+            length -= count
+            shard_no, offset = shard_no+1, 0
+        return np.concatenate(parts)
+
+    def sample_windows(self, batch_size, length, rng=None):
+        '''
+        Draw windows of consecutive rows uniformly among all the windows that fit in an episode.
+        Parameters:
+            batch_size (int): Number of windows.
+            length (int): Number of rows per window.
+            rng (np.random.Generator): Random generator. None use a new default generator.
+        Returns:
+            A list of "batch_size" windows (see "window()").
+        '''
+        rng = np.random.default_rng() if rng is None else rng
+        starts  = np.array([episode[0] for episode in self.episodes if episode[1] >= length], dtype=np.int64)
+        counts  = np.array([episode[1] - length + 1 for episode in self.episodes if episode[1] >= length], dtype=np.int64)
+        if len(counts) == 0:
+            raise ValueError("No episode has {} rows.".format(length))
+        # Window number "n" among all the windows, then the episode it belongs to
+        ends    = np.cumsum(counts)
+        picks   = rng.integers(0, ends[-1], size=batch_size)
+        episode = np.searchsorted(ends, picks, side='right')
+        rows    = starts[episode] + picks - (ends[episode] - counts[episode])
+        return [self.window(int(row), length) for row in rows]
@@ -0,0 +1,312 @@
+import concurrent.futures
+import numpy as np
+import contextlib
+import subprocess
+import threading
+import traceback
+import argparse
+import loopback
+import common
+import json
+import time
+import sys
+import os
+
+
+# End-to-end scale test on one host: N synthetic game servers (see synthetic.py) driven by M client threads of "gym_mk8.EnvMarioKart8".
+# The servers speak the real protocol with generated frames. The broker is either the in-process "loopback.LoopbackBroker"
+# (servers and clients share the process and its GIL) or a local MQTT broker (one process per server).
+# Run it from the "src" directory:
+#     python scale_harness.py --servers 1 2 4 8 --output scale.json
+#     python scale_harness.py --servers 1 2 4 8 --broker 127.0.0.1:1883
+
+
+def make_game_setup(max_step=1000):
+    game_setup = {}
+    game_setup['MAIN_MODE']                = common.GameSetup.MainMenu.SINGLE_PLAYER
+    game_setup['GAME_MODE']                = common.GameSetup.GameMode.VS_RACE
+    game_setup['PLAYER']                   = common.GameSetup.Player.MASKASS
+    game_setup['PLAYER_VARIANT']           = common.GameSetup.Player.MaskassVariant.DEFAULT
+    game_setup['CAR_BODY']                 = common.GameSetup.Car.Body.BIDDYBUGGY
+    game_setup['CAR_WHEEL']                = common.GameSetup.Car.Wheel.ROLLER
+    game_setup['CAR_WING']                 = common.GameSetup.Car.Wing.CLOUD_GLIDER
+    game_setup['RACE_RULE_MODE']           = common.GameSetup.RaceRule.Mode.CC_150
+    game_setup['RACE_RULE_TEAMS']          = common.GameSetup.RaceRule.Teams.NO_TEAMS
+    game_setup['RACE_RULE_ITEMS']          = common.GameSetup.RaceRule.Items.FRANTIC_ITEMS
+    game_setup['RACE_RULE_COM']            = common.GameSetup.RaceRule.COM.HARD
+    game_setup['RACE_RULE_COM_VEHICLES']   = common.GameSetup.RaceRule.COMVehicles.ALL
+    game_setup['RACE_RULE_COURSES']        = common.GameSetup.RaceRule.Courses.CHOOSE
+    game_setup['RACE_RULE_RACE_COUNT']     = common.GameSetup.RaceRule.RaceCount.FOUR
+    game_setup['COURSE_CUP']               = common.GameSetup.Course.Cup.SPECIAL
+    game_setup['COURSE']                   = common.GameSetup.Course.Cup.Special.RAINBOW_ROAD
+    game_setup['MAX_STEP']                 = max_step
+    return game_setup
+
+
+class TrafficMeter:
+    '''
+    Count the messages and bytes (topic and payload) of the instances, as seen by one subscriber of the broker.
+    '''
+
+    def __init__(self, host, port):
+        import paho.mqtt.client as mqtt
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self.mqtt = mqtt.Client()
+        self.mqtt.on_connect = lambda client, userdata, flags, rc: client.subscribe("Mario_Kart_8/#")
+        self.mqtt.on_message = self._on_message
+        self.mqtt.connect(host, port, 60)
+        self.mqtt.loop_start()
+
+    def _on_message(self, client, userdata, msg):
+        with self._lock:
+            self.delivered_messages += 1
+            self.delivered_bytes    += len(msg.topic) + len(msg.payload)
+
+    def reset_stats(self):
+        with self._lock:
+            self.delivered_messages = 0
+            self.delivered_bytes    = 0
+
+    def close(self):
+        self.mqtt.disconnect()
+        self.mqtt.loop_stop()
+
+
+def _start_loopback_servers(broker, instance_ids, tick_rate):
+    import synthetic
+    import server
+    def start(args):
+        idx, instance_id = args
+        manager = server.Manager(instance_id=instance_id, broker=broker, backend=synthetic.SyntheticBackend(tick_rate=tick_rate, seed=idx))
+        manager.set_mode(server.Manager.Mode.TRAINING)
+        thread = threading.Thread(target=manager.loop, daemon=True)
+        thread.start()
+        return manager, thread
+    # Each manager waits its debugger: start them in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_ids)) as executor:
+        return list(executor.map(start, enumerate(instance_ids)))
+
+
+def _check_loopback_servers(handles):
+    for manager, thread in handles:
+        if manager.game.error is not None:
+            raise RuntimeError("Synthetic game of the instance {} stopped on an error.".format(manager.server.instance_id)) from manager.game.error
+        if not thread.is_alive():
+            raise RuntimeError("Manager of the instance {} stopped.".format(manager.server.instance_id))
+
+
+def _stop_loopback_servers(handles):
+    for manager, _ in handles:
+        manager.close()
+
+
+def _start_process_servers(host, port, instance_ids, tick_rate):
+    processes = []
+    for instance_id in instance_ids:
+        env = os.environ.copy()
+        env['INSTANCE_ID']          = instance_id
+        env['MQTT_HOST']            = host
+        env['MQTT_PORT']            = str(port)
+        env['SERVER_MODE']          = '0'
+        env['GAME_BACKEND']         = str(int(common.Server.Backend.SYNTHETIC))
+        env['SYNTHETIC_TICK_RATE']  = str(tick_rate)
+        processes.append(subprocess.Popen([sys.executable, "server.py"], env=env, stdout=subprocess.DEVNULL))
+    return processes
+
+
+def _check_process_servers(processes):
+    for process in processes:
+        if process.poll() is not None:
+            raise RuntimeError("Server process {} exited with code {}.".format(process.pid, process.returncode))
+
+
+def _stop_process_servers(processes):
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def _join(threads, errors, deadline, check_servers, what):
+    # Wait for the threads until the deadline, fail as soon as a thread or a server failed
+    for thread in threads:
+        while thread.is_alive():
+            if errors:
+                raise RuntimeError("{} failed.".format(what)) from errors[0]
+            check_servers()
+            if time.monotonic() >= deadline:
+                raise TimeoutError("{} not finished in time.".format(what))
+            thread.join(0.5)
+    if errors:
+        raise RuntimeError("{} failed.".format(what)) from errors[0]
+
+
+def _start_threads(target, args_list, errors):
+    # Daemon threads: a thread blocked on a dead server does not keep the process alive
+    def run(*args):
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=args, daemon=True) for args in args_list]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _drive(envs, deadline, seed, step_latencies, reset_latencies):
+    # One client thread: step its environments in turn until the deadline, reset the terminated ones
+    rng = np.random.default_rng(seed)
+    while time.monotonic() < deadline:
+        for env in envs:
+            action = {'action': [1.0, 0.0, 0.0, 0.0, 0.0, rng.uniform(-0.3, 0.3), 0.0]}
+            start = time.perf_counter()
+            _, _, end, _ = env.step(action)
+            step_latencies.append(time.perf_counter() - start)
+            if end:
+                start = time.perf_counter()
+                env.reset()
+                reset_latencies.append(time.perf_counter() - start)
+
+
+def _percentile(values, q):
+    # None when nothing was measured (e.g. no step completed in the window with a slow "--tick-rate" or a short "--duration")
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def _format(value, scale, width, precision):
+    return "{:{}.{}f}".format(value*scale, width, precision) if value is not None else "{:>{}}".format("n/a", width)
+
+
+def run_point(servers, clients, duration=20.0, broker=None, tick_rate=0.0, max_step=1000, timeout=60.0):
+    '''
+    Measure one configuration.
+    Parameters:
+        servers (int): Number of synthetic servers (and environments, one per server).
+        clients (int): Number of client threads, the environments are shared among them.
+        duration (float): Duration in seconds of the stepping phase (after the first reset of all the environments).
+        broker (tuple): (host, port) of a local MQTT broker, the servers run in their own process. None use an in-process "loopback.LoopbackBroker".
+        tick_rate (float): Ticks per second of the synthetic games. 0 run them as fast as possible.
+        max_step (int): Steps before the servers end an episode.
+        timeout (float): Maximum time in seconds of the first reset of all the environments, and of the end of the stepping phase
+            after "duration" (a reset may be in progress). It is also the timeout of each server answer.
+    Returns:
+        An dict of the aggregated metrics (steps per second, step, reset and step boundary latencies in seconds, broker traffic per step, CPU of the process).
+    '''
+    import gym_mk8
+    instance_ids    = ["{:08d}".format(idx) for idx in range(servers)]
+    clients         = max(1, min(clients, servers))
+    step_latencies  = []
+    reset_latencies = []
+    errors          = []
+    envs            = []
+    handles         = []
+    # The servers and the clients log each step: keep the console for the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if broker is None:
+            transport   = loopback.LoopbackBroker()
+            meter       = transport
+            host, port  = None, None
+            check       = lambda: _check_loopback_servers(handles)
+        else:
+            transport   = None
+            host, port  = broker
+            meter       = TrafficMeter(host, port)
+            check       = lambda: _check_process_servers(handles)
+        try:
+            if broker is None:
+                handles.extend(_start_loopback_servers(transport, instance_ids, tick_rate))
+            else:
+                handles.extend(_start_process_servers(host, port, instance_ids, tick_rate))
+            for instance_id in instance_ids:
+                envs.append(gym_mk8.EnvMarioKart8(host, port, instance_id, make_game_setup(max_step), lambda env: None, render_mode=None, timeout=timeout, reset_timeout=timeout, broker=transport))
+            def reset(env):
+                start = time.perf_counter()
+                env.reset()
+                reset_latencies.append(time.perf_counter() - start)
+            _join(_start_threads(reset, [(env,) for env in envs], errors), errors, time.monotonic()+timeout, check, "First reset")
+            #
+            meter.reset_stats()
+            if broker is None:
+                for manager, _ in handles:
+                    manager.boundary_latencies.clear()
+            cpu_start   = os.times()
+            start       = time.monotonic()
+            workers     = _start_threads(_drive, [(envs[idx::clients], start+duration, idx, step_latencies, reset_latencies) for idx in range(clients)], errors)
+            _join(workers, errors, start+duration+timeout, check, "Stepping phase")
+            elapsed     = time.monotonic() - start
+            cpu_end     = os.times()
+            # Hold of the game at a step boundary -> step published, only measurable for the in-process servers
+            boundary_latencies = np.array([latency for manager, _ in handles for latency in manager.boundary_latencies]) if broker is None else np.array([])
+        finally:
+            # Disconnected, the client and server threads end and the process can exit
+            for env in envs:
+                env.close()
+                env.client.mqtt.disconnect()
+            if broker is None:
+                _stop_loopback_servers(handles)
+            else:
+                meter.close()
+                _stop_process_servers(handles)
+    steps = len(step_latencies)
+    step_latencies  = np.array(step_latencies)
+    reset_latencies = np.array(reset_latencies)
+    return {
+        'servers'                   : servers,
+        'clients'                   : clients,
+        'steps'                     : steps,
+        'steps_per_s'               : steps / elapsed,
+        'step_p50'                  : _percentile(step_latencies, 50),
+        'step_p99'                  : _percentile(step_latencies, 99),
+        'resets'                    : len(reset_latencies),
+        'reset_p50'                 : _percentile(reset_latencies, 50),
+        'reset_p99'                 : _percentile(reset_latencies, 99),
+        'broker_messages_per_step'  : meter.delivered_messages / max(steps, 1),
+        'broker_bytes_per_step'     : meter.delivered_bytes / max(steps, 1),
+        'boundary_p50'              : _percentile(boundary_latencies, 50),
+        'boundary_p99'              : _percentile(boundary_latencies, 99),
+        # Cores used by this process: close to 1.0 when the threads are bound by the GIL
+        'process_cpu'               : ((cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)) / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scale test: N synthetic servers x M client threads.")
+    parser.add_argument("--servers", type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of servers to measure.")
+    parser.add_argument("--clients", type=int, default=None, help="Client threads (default: one per server).")
+    parser.add_argument("--duration", type=float, default=20.0, help="Stepping phase of each measure in seconds.")
+    parser.add_argument("--broker", default=None, help="host:port of a local MQTT broker (one process per server). Default: in-process loopback broker.")
+    parser.add_argument("--tick-rate", type=float, default=0.0, help="Ticks per second of the synthetic games, 0 as fast as possible.")
+    parser.add_argument("--max-step", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Maximum time in seconds of the first reset and of the end of the stepping phase of each measure.")
+    parser.add_argument("--output", help="Write the results in this JSON file.")
+    args = parser.parse_args()
+    broker = None
+    if args.broker is not None:
+        host, port = args.broker.rsplit(':', 1)
+        broker = (host, int(port))
+    results = []
+    failed  = False
+    for servers in args.servers:
+        clients = servers if args.clients is None else args.clients
+        try:
+            r = run_point(servers, clients, duration=args.duration, broker=broker, tick_rate=args.tick_rate, max_step=args.max_step, timeout=args.timeout)
+        except Exception as e:
+            # A broken point is reported and the sweep goes on
+            traceback.print_exc()
+            failed = True
+            results.append({'servers': servers, 'clients': clients, 'error': repr(e)})
+            print("N={:3d} M={:3d} : FAILED ({!r})".format(servers, clients, e))
+            continue
+        results.append(r)
+        print("N={:3d} M={:3d} : {:9.1f} steps/s | step p50 {} ms p99 {} ms | reset p50 {} s p99 {} s | boundary p50 {} ms p99 {} ms | {:5.1f} msg {:9.0f} bytes per step | cpu {:5.2f}".format(
+            r['servers'], r['clients'], r['steps_per_s'],
+            _format(r['step_p50'], 1e3, 8, 3), _format(r['step_p99'], 1e3, 8, 3),
+            _format(r['reset_p50'], 1, 7, 3), _format(r['reset_p99'], 1, 7, 3),
+            _format(r['boundary_p50'], 1e3, 8, 3), _format(r['boundary_p99'], 1e3, 8, 3),
+            r['broker_messages_per_step'], r['broker_bytes_per_step'], r['process_cpu']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'broker': args.broker or 'loopback', 'tick_rate': args.tick_rate, 'results': results}, f, indent=4)
+    if failed:
+        sys.exit(1)
@@ -1,19 +1,30 @@
 import sys
 import os
 
-sys.path.append(os.environ.copy()['ENV_PATH'])
+# Set by "server_launcher.ServerInstance": the python of GDB does not have the script folder in its path
+if 'ENV_PATH' in os.environ:
+    sys.path.append(os.environ['ENV_PATH'])
 
-from platform_specific import Controller, Monitor
 import paho.mqtt.client as mqtt
 import numpy as np
+import collections
 import subprocess
 import threading
+import frame_ring
 import common
-import struct
+import codec
 import random
+import signal
 import enum
 import time
-import gdb
+
+# Only available when the server runs inside GDB (Yuzu backend), the synthetic backend runs without it (see synthetic.py)
+try:
+    import gdb
+    _Breakpoint = gdb.Breakpoint
+except ImportError:
+    gdb = None
+    _Breakpoint = object
 
 
 class SanityCheckException(Exception):
@@ -23,50 +34,316 @@ class SanityCheckException(Exception):
     pass
 
 
+class SampleRate(enum.IntEnum):
+    '''
+    When the value of an "AddressItem" is read by the "TimerSampler", in the scenes where it is needed.
+    '''
+    TICK    = 0 # On each tick
+    STEP    = 1 # At each step boundary in STEPPER mode, every "step_size" ticks otherwise
+    ONCE    = 2 # On the first tick in its scenes
+
+
 class AddressItem:
     '''
     Interface used to know the size and the data type of an particular address.
+    "scenes" (GameDebugger.SceneID) and "rate" tell when the value is needed: None is all the scenes.
     '''
-    def __init__(self, address, byte_size, rep_fmt):
+    def __init__(self, address, byte_size, rep_fmt, scenes=None, rate=SampleRate.TICK):
         self.address    = address
         self.byte_size  = byte_size
         self.rep_fmt    = rep_fmt
+        self.scenes     = scenes
+        self.rate       = rate
 
 
-class TimerWatchpoint(gdb.Breakpoint):
+class MemorySpan:
     '''
-    GDB breakpoint triggered on the game timer write.
-    Serve as base timer to be sync with the game.
+    Contiguous range of the game memory holding several "AddressItem", read at once and decoded by a numpy structured dtype.
+    '''
+    def __init__(self, items):
+        self.start      = items[0].address
+        self.size       = max(item.address + item.byte_size for item in items) - self.start
+        self.addresses  = tuple(item.address for item in items)
+        # The game (ARM) is little endian
+        self.dtype      = np.dtype({
+            'names'     : ['f{}'.format(idx) for idx in range(len(items))],
+            'formats'   : ['<'+item.rep_fmt for item in items],
+            'offsets'   : [item.address - self.start for item in items],
+            'itemsize'  : self.size,
+        })
+
+    def decode(self, data):
+        '''
+        Returns:
+            The values of the items, in the order of "addresses".
+        '''
+        return np.frombuffer(data, dtype=self.dtype, count=1)[0].item()
+
+
+def compile_spans(addr_items, max_gap=1024):
+    '''
+    Group the items into spans: two items less than "max_gap" bytes apart are read together.
+    Parameters:
+        addr_items (list): The "AddressItem" to read.
+        max_gap (int): Maximum number of unused bytes read between two items of a span.
+    Returns:
+        A list of "MemorySpan" sorted by address.
+    '''
+    spans = []
+    group = []
+    for item in sorted(addr_items, key=lambda item: item.address):
+        if group and item.address - max(i.address + i.byte_size for i in group) > max_gap:
+            spans.append(MemorySpan(group))
+            group = []
+        group.append(item)
+    if group:
+        spans.append(MemorySpan(group))
+    return spans
+
+
+class DebuggerSnapshot:
+    '''
+    Immutable view of the debugger values of one tick, indexed by address like a dict ("results[address]", "address in results").
+    The values are stored in a tuple, at the position given by "index" (shared by all the snapshots of the same item set).
+    "generation" is the number of the tick (increasing), "timer" the game timer of the tick,
+    "scene" the scene id of the tick (unsigned, None if the sampler does not follow the scene).
+    '''
+    __slots__ = ('generation', 'timer', 'scene', '_index', '_values')
+
+    # Value not read in the current scene (see "TimerSampler._change_scene")
+    MISSING = object()
+
+    def __init__(self, generation, timer, scene, index, values):
+        self.generation = generation
+        self.timer      = timer
+        self.scene      = scene
+        self._index     = index
+        self._values    = values
+
+    def __contains__(self, address):
+        idx = self._index.get(address)
+        return idx is not None and self._values[idx] is not DebuggerSnapshot.MISSING
+
+    def __getitem__(self, address):
+        value = self._values[self._index[address]]
+        if value is DebuggerSnapshot.MISSING:
+            raise KeyError(address)
+        return value
+
+    def get(self, address, default=None):
+        idx = self._index.get(address)
+        if idx is None or self._values[idx] is DebuggerSnapshot.MISSING:
+            return default
+        return self._values[idx]
+
+
+# No value sampled yet
+_EMPTY_SNAPSHOT = DebuggerSnapshot(0, None, None, {}, ())
+
+
+class TimerSampler:
+    '''
+    Sampling of the game memory on each write of the game timer.
+    Independent of GDB: shared by the GDB watchpoint ("TimerWatchpoint") and the synthetic game (see synthetic.py),
+    "process" only has to provide "read_memory(address, size)".
+    The game is halted during the sampling: the addresses are read by spans (see "compile_spans") to limit the number of GDB round trips,
+    and only the items needed in the current scene, at their rate (see "AddressItem"), are read.
+    The scene is the one read on the previous tick: on a scene change, the values of the items of the previous scene only are dropped
+    and the items of the new scene are read from the next tick.
+    After each tick the values are published as a new "DebuggerSnapshot": the readers get it without lock nor copy,
+    or wait for the next ones (see "wait_for").
     '''
 
     class Mode(enum.IntEnum):
         SAMPLER     = 0 # Sample without pausing the game
         STEPPER     = 1 # Pause the game untile continue
-        SPEED_INIT  = 2 # Used to get the current race instance pointer
+        SPEED_INIT  = 2 # Used to get the current race instance pointer
 
-    def __init__(self, addr_timer, addr_items):
-        super().__init__("(*{})".format(hex(addr_timer)), gdb.BP_WATCHPOINT, gdb.WP_WRITE, internal=False)
-        #
-        self.process            = gdb.inferiors()[0]
+    def __init__(self, process, addr_timer, addr_items, addr_scene=None, max_gap=1024):
+        '''
+        Parameters:
+            process: Provide "read_memory(address, size)" on the game memory.
+            addr_timer (int): Address of the game timer.
+            addr_items (list): The "AddressItem" to sample.
+            addr_scene (int): Address of the scene id. None read all the items on each tick.
+            max_gap (int): See "compile_spans".
+        '''
+        self.process            = process
         self.addr_timer         = addr_timer
-        self.addr_items         = addr_items
+        self.addr_scene         = addr_scene
+        self.max_gap            = max_gap
         self._lock_results      = threading.Lock()
-        self._results           = {}
-        self.mode               = TimerWatchpoint.Mode.SAMPLER
+        self._index             = {} # address -> position in "_values"
+        self._values            = [] # Written by the sampling only
+        self._generation        = 0
+        self._snapshot          = _EMPTY_SNAPSHOT
+        self._published         = threading.Condition() # Notified on each new snapshot
+        self.set_items(addr_items)
+        self.mode               = TimerSampler.Mode.SAMPLER
         self.step_size          = 6 # 1 tick equal ~16.7ms (60fps)
         self._ref_time          = 0
-        self._sync              = threading.Event()
-        self._speed_bp          = SpeedBreakpoint()
+        self._sync              = threading.Event() # Set to release the game held at a step boundary
+        self._boundary          = threading.Event() # Set while the game is held at a step boundary
+        self.boundary_time      = None # time.perf_counter() of the last step boundary
+        self._ticks             = 0
+        self._scene             = None # Unknown: all the items are read
+        self._entering          = False # The previous tick changed the scene
+
+    def set_items(self, addr_items):
+        '''
+        Set the addresses to read, e.g. after the address of an item was changed.
+        '''
+        with self._lock_results:
+            # The values of the addresses kept are preserved
+            old = {address: self._values[idx] for address, idx in self._index.items()}
+            self.addr_items     = addr_items
+            self._index         = {item.address: idx for idx, item in enumerate(addr_items)}
+            self._values        = [old.get(item.address, DebuggerSnapshot.MISSING) for item in addr_items]
+            self._scene_tiers   = {} # scene -> items of each "SampleRate"
+            self._span_cache    = {} # addresses -> spans and positions of their items
+
+    def _tiers(self, scene):
+        tiers = self._scene_tiers.get(scene)
+        if tiers is None:
+            active = [item for item in self.addr_items if item.scenes is None or scene in item.scenes]
+            tiers = self._scene_tiers[scene] = tuple([item for item in active if item.rate == rate] for rate in SampleRate)
+        return tiers
+
+    def _read(self, items):
+        key = tuple(item.address for item in items)
+        spans = self._span_cache.get(key)
+        if spans is None:
+            spans = self._span_cache[key] = [(span, [self._index[address] for address in span.addresses]) for span in compile_spans(items, self.max_gap)]
+        values = self._values
+        for span, positions in spans:
+            data = self.process.read_memory(span.start, span.size)
+            for idx, value in zip(positions, span.decode(data)):
+                values[idx] = value
+
+    def _change_scene(self, scene, first=False):
+        # The values of the items of the previous scene are not updated anymore: drop them instead of serving stale values.
+        # On the first known scene all the items were read, the items of the other scenes (at any rate) are dropped too
+        for item in self.addr_items:
+            if item.scenes is not None and (first or item.rate == SampleRate.TICK) and scene not in item.scenes:
+                self._values[self._index[item.address]] = DebuggerSnapshot.MISSING
 
     def set_mode(self, mode):
-        if mode == TimerWatchpoint.Mode.SAMPLER:
-            self.mode = TimerWatchpoint.Mode.SAMPLER
-        elif mode == TimerWatchpoint.Mode.STEPPER:
-            self.mode = TimerWatchpoint.Mode.STEPPER
+        if mode == TimerSampler.Mode.SAMPLER:
+            self.mode = TimerSampler.Mode.SAMPLER
+        elif mode == TimerSampler.Mode.STEPPER:
+            self.mode = TimerSampler.Mode.STEPPER
             self._ref_time = 0
-        elif mode == TimerWatchpoint.Mode.SPEED_INIT:
+
+    def sample(self):
+        '''
+        Read the addresses needed in the current scene. In STEPPER mode, hold the caller (the game) every "step_size" ticks until "_sync" is set.
+        '''
+        boundary = False
+        with self._lock_results:
+            self._ticks += 1
+            scene = self._scene
+            if scene is None:
+                self._read(self.addr_items)
+            else:
+                tick_items, step_items, once_items = self._tiers(scene)
+                items = tick_items
+                if self._entering:
+                    items = items + once_items
+                if self.mode != TimerSampler.Mode.STEPPER and self._ticks % self.step_size == 0:
+                    items = items + step_items
+                self._read(items)
+            if self.addr_scene is not None:
+                # The scene id is signed in the debugger values (see "MK8_Helper.get_current_scene")
+                new_scene = self._values[self._index[self.addr_scene]] & 0xFFFFFFFF
+                self._entering = new_scene != scene
+                if self._entering:
+                    self._change_scene(new_scene, first=scene is None)
+                self._scene = new_scene
+            timer = self._values[self._index[self.addr_timer]]
+            if self.mode == TimerSampler.Mode.STEPPER:
+                if (timer - self._ref_time) >= self.step_size:
+                    self._ref_time = timer
+                    boundary = True
+                    if self._scene is not None:
+                        self._read(self._tiers(self._scene)[SampleRate.STEP])
+            # Publish the tick: a single reference swap, atomic for the readers
+            self._generation += 1
+            snapshot = DebuggerSnapshot(self._generation, timer, self._scene, self._index, tuple(self._values))
+        with self._published:
+            self._snapshot = snapshot
+            self._published.notify_all()
+        if boundary:
+            # return True # Slower, use Event() instead
+            self.boundary_time = time.perf_counter()
+            self._sync.clear()
+            self._boundary.set()
+            self._sync.wait()
+            self._boundary.clear()
+
+    def get_results(self):
+        '''
+        Returns:
+            The "DebuggerSnapshot" of the last tick (never modified afterwards).
+        '''
+        return self._snapshot
+
+    def wait_for(self, predicate, timeout=None):
+        '''
+        Wait for a snapshot (the last one included) that satisfies "predicate".
+        Parameters:
+            predicate (callable): Called with a "DebuggerSnapshot", returns a bool.
+            timeout (float): Maximum wait in seconds. None wait forever.
+        Returns:
+            The first "DebuggerSnapshot" that satisfies "predicate", None on timeout.
+        '''
+        with self._published:
+            if self._published.wait_for(lambda: predicate(self._snapshot), timeout):
+                return self._snapshot
+        return None
+
+    def wait_for_sample(self, after_generation, timeout=None):
+        '''
+        Returns:
+            The first "DebuggerSnapshot" sampled after the generation "after_generation", None on timeout.
+        '''
+        return self.wait_for(lambda snapshot: snapshot.generation > after_generation, timeout)
+
+    def wait_for_boundary(self, timeout=None):
+        '''
+        Wait until the game is held at a step boundary (STEPPER mode).
+        Returns:
+            The "DebuggerSnapshot" of the boundary, None on timeout.
+        '''
+        if self._boundary.wait(timeout):
+            return self._snapshot
+        return None
+
+    def resume(self):
+        '''
+        Release the game held at a step boundary.
+        '''
+        self._boundary.clear()
+        self._sync.set()
+
+
+class TimerWatchpoint(TimerSampler, _Breakpoint):
+    '''
+    GDB breakpoint triggered on the game timer write.
+    Serve as base timer to be sync with the game.
+    '''
+
+    def __init__(self, addr_timer, addr_items, addr_scene=None):
+        _Breakpoint.__init__(self, "(*{})".format(hex(addr_timer)), gdb.BP_WATCHPOINT, gdb.WP_WRITE, internal=False)
+        TimerSampler.__init__(self, gdb.inferiors()[0], addr_timer, addr_items, addr_scene)
+        #
+        self._speed_bp          = SpeedBreakpoint()
+
+    def set_mode(self, mode):
+        if mode == TimerWatchpoint.Mode.SPEED_INIT:
             self._speed_bp.free()
             self.mode = TimerWatchpoint.Mode.SPEED_INIT
+        else:
+            TimerSampler.set_mode(self, mode)
 
     def speed_init_done(self):
         return self._speed_bp.has_results()
@@ -76,17 +353,7 @@ class TimerWatchpoint(gdb.Breakpoint):
 
     def stop(self):
         try:
-            with self._lock_results:
-                for item in self.addr_items:
-                    data  = self.process.read_memory(item.address, item.byte_size)
-                    value = struct.unpack(item.rep_fmt, bytes(data))[0]
-                    self._results[item.address] = value
-            if self.mode == TimerWatchpoint.Mode.STEPPER:
-                if (self._results[self.addr_timer] - self._ref_time) >= self.step_size:
-                    self._ref_time = self._results[self.addr_timer]
-                    # return True # Slower, use Event() instead
-                    self._sync.clear()
-                    self._sync.wait()
+            self.sample()
             if self.mode == TimerWatchpoint.Mode.SPEED_INIT:
                 if not self._speed_bp.busy:
                     self._speed_bp.go()
@@ -94,12 +361,8 @@ class TimerWatchpoint(gdb.Breakpoint):
             pass
         return False
 
-    def get_results(self):
-        with self._lock_results:
-            return self._results.copy()
-
 
-class SpeedBreakpoint(gdb.Breakpoint):
+class SpeedBreakpoint(_Breakpoint):
     '''
     GDB breakpoint used to grab race instance pointer.
     The instance contain players list and all their stats.
@@ -173,55 +436,66 @@ class GameDebugger(threading.Thread):
         RACE_RESULT = 0x8E74212C
         RACE_END_MENU = 0x8E991F14
 
+    # Memory address of each value (declared next to its data type in common.DEBUGGER_FIELDS)
+    ADDRESSES = {name: address for name, _, address in common.DEBUGGER_FIELDS}
+
+    # Scenes where the race values are meaningful
+    RACE_SCENES = (SceneID.CINEMATIC_INTRO_RACE, SceneID.RACE, SceneID.RACE_AFTER_PAUSE, SceneID.RACE_RESULT)
+
+    # When each value is sampled: (scenes, SampleRate), see "AddressItem". The values not listed are read on each tick in all the scenes
+    # (the scene, the timer and the status are needed to follow the game state).
+    SAMPLING = {
+        'pause_menu_idx'        : ((SceneID.PAUSE_MENU,), SampleRate.TICK),
+        'quit_menu_idx'         : ((SceneID.QUIT_VALIDATION,), SampleRate.TICK),
+        'main_menu_idx'         : ((SceneID.MAIN_MENU,), SampleRate.TICK),
+        'solo_menu_idx'         : ((SceneID.SOLO_MENU,), SampleRate.TICK),
+        'race_end_menu_idx'     : ((SceneID.RACE_END_MENU,), SampleRate.TICK),
+        'player_menu_idx'       : ((SceneID.PLAYER_SELECTION,), SampleRate.TICK),
+        'player_alt_menu_idx'   : ((SceneID.PLAYER_ALT_SELECTION,), SampleRate.TICK),
+        'car_body_idx'          : ((SceneID.CAR_SELECTION,), SampleRate.TICK),
+        'car_wheel_idx'         : ((SceneID.CAR_SELECTION,), SampleRate.TICK),
+        'car_wing_idx'          : ((SceneID.CAR_SELECTION,), SampleRate.TICK),
+        'car_menu_idx'          : ((SceneID.CAR_SELECTION,), SampleRate.TICK),
+        'rule_menu_idx'         : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'track_cup_sel_idx'     : ((SceneID.RACE_TRACK_SELECTION, SceneID.PRIZE_TRACK_SELECTION), SampleRate.TICK),
+        'race_rule_cc'          : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'race_rule_team'        : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'race_rule_item'        : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'race_rule_ai'          : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'race_rule_car_ai'      : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'race_rule_track'       : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'race_rule_num'         : ((SceneID.RACE_RULE_SELECTION,), SampleRate.TICK),
+        'speed'                 : (RACE_SCENES, SampleRate.STEP),
+        'coins'                 : (RACE_SCENES, SampleRate.STEP),
+        'rank'                  : (RACE_SCENES, SampleRate.STEP),
+        'lap_continuous'        : (RACE_SCENES, SampleRate.STEP),
+        'lap_discrete'          : (RACE_SCENES, SampleRate.STEP),
+        'pos_x'                 : (RACE_SCENES, SampleRate.STEP),
+        'pos_y'                 : (RACE_SCENES, SampleRate.STEP),
+        'pos_z'                 : (RACE_SCENES, SampleRate.STEP),
+        'towing'                : (RACE_SCENES, SampleRate.STEP),
+        'track'                 : (RACE_SCENES, SampleRate.ONCE),
+    }
+
     def __init__(self):
         super().__init__()
         # Connect to the GDB stub
         gdb.execute("target remote 127.0.0.1:6543")
         # Delete all breakpoints
         gdb.execute("d")
-        # Register all memory address
-        self.addr_dict = {
-            'scene_id'              : AddressItem(0x846cb88c, 4, 'i'),
-            'pause_menu_idx'        : AddressItem(0x84c38764, 4, 'i'),
-            'quit_menu_idx'         : AddressItem(0x84c38124, 4, 'i'),
-            'main_menu_idx'         : AddressItem(0x84c382c4, 4, 'i'),
-            'solo_menu_idx'         : AddressItem(0x84c382e4, 4, 'i'),
-            'race_end_menu_idx'     : AddressItem(0x84c38794, 4, 'i'),
-            'player_menu_idx'       : AddressItem(0x84c38374, 4, 'i'),
-            'player_alt_menu_idx'   : AddressItem(0x8c9e6974, 4, 'i'),
-            'car_body_idx'          : AddressItem(0x8cabd37c, 4, 'i'),
-            'car_wheel_idx'         : AddressItem(0x8cabde2c, 4, 'i'),
-            'car_wing_idx'          : AddressItem(0x8cabe7ac, 4, 'i'),
-            'car_menu_idx'          : AddressItem(0x84c383a4, 4, 'i'),
-            'rule_menu_idx'         : AddressItem(0x87665654, 4, 'i'),
-            'track_cup_sel_idx'     : AddressItem(0x84c38404, 1, 'B'),
-            'race_rule_cc'          : AddressItem(0x84db2790, 1, 'B'),
-            'race_rule_team'        : AddressItem(0x84db276c, 1, 'B'),
-            'race_rule_item'        : AddressItem(0x84db277c, 1, 'B'),
-            'race_rule_ai'          : AddressItem(0x84db2798, 1, 'B'),
-            'race_rule_car_ai'      : AddressItem(0x84db27ac, 1, 'B'),
-            'race_rule_track'       : AddressItem(0x84db27c0, 1, 'B'),
-            'race_rule_num'         : AddressItem(0x84db27c8, 1, 'B'),
-            'timer'                 : AddressItem(0x96afe398, 4, 'i'),
-            'speed'                 : AddressItem(0x96bfade8, 4, 'f'),
-            'coins'                 : AddressItem(0x96bf4ac4, 4, 'i'),
-            'status'                : AddressItem(0x96bf4ab0, 4, 'i'),
-            'rank'                  : AddressItem(0x96bf4ab4, 4, 'i'),
-            'lap_continuous'        : AddressItem(0x80cc172c, 4, 'f'),
-            'lap_discrete'          : AddressItem(0x8e697f8d, 1, 'B'),
-            'pos_x'                 : AddressItem(0x96af34d4, 4, 'f'),
-            'pos_y'                 : AddressItem(0x96af34d8, 4, 'f'),
-            'pos_z'                 : AddressItem(0x96af34dc, 4, 'f'),
-            'towing'                : AddressItem(0x954def14, 1, 'B'),#0 if in towing else 154 (do not use for the reward)
-            'track'                 : AddressItem(0x84cc187c, 4, 'i'),#start @ 1401
-        }
+        # Register all memory address
+        self.addr_dict = GameDebugger.make_addr_dict()
         # Will contain the main breakpoint to be sync with the game 
         self.watch = None
         # If true the debugger will stop
         self.terminate = False
 
+    @staticmethod
+    def make_addr_dict():
+        return {key: AddressItem(addr, common.DEBUGGER_SCHEMA.scalars[key].size, common.DEBUGGER_SCHEMA.formats[key], *GameDebugger.SAMPLING.get(key, (None, SampleRate.TICK))) for key, addr in GameDebugger.ADDRESSES.items()}
+
     def run(self):
-        self.watch = TimerWatchpoint(self.addr_dict['timer'].address, list(self.addr_dict.values()))
+        self.watch = TimerWatchpoint(self.addr_dict['timer'].address, list(self.addr_dict.values()), self.addr_dict['scene_id'].address)
         # Keep the game running
         while not self.terminate:
             try:
@@ -240,18 +514,63 @@ class GameDebugger(threading.Thread):
             time.sleep(0.1)
         addr = self.watch.get_speed_results()
         self.addr_dict['speed'].address = addr
+        self.watch.set_items(list(self.addr_dict.values()))
         self.watch.set_mode(bak_mode)
 
     def set_mode(self, mode):
         self.watch.set_mode(mode)
         if mode == TimerWatchpoint.Mode.SAMPLER:
-            self.watch._sync.set()
+            self.watch.resume()
 
     def step_finished(self):
-        return not self.watch._sync.is_set()
+        return self.watch._boundary.is_set()
+
+    def check_game(self):
+        '''
+        Raise an exception if the game stopped and will not produce samples anymore. Called by the waits on the debugger values.
+        '''
+        pass
+
+    def wait_step(self, timeout=None):
+        '''
+        Wait until the game is held at the end of a step (STEPPER mode), see "validate_step" to continue.
+        Parameters:
+            timeout (float): Maximum wait in seconds. None wait forever.
+        Returns:
+            The "DebuggerSnapshot" of the end of the step, None on timeout.
+        '''
+        return self.watch.wait_for_boundary(timeout)
+
+    def wait_for(self, predicate, timeout=None):
+        '''
+        See "TimerSampler.wait_for".
+        '''
+        return self.watch.wait_for(predicate, timeout)
+
+    def wait_for_sample(self, after_generation, timeout=None):
+        '''
+        Wait for a new sample of the game.
+        Parameters:
+            after_generation (int): Generation of the last "DebuggerSnapshot" known by the caller.
+            timeout (float): Maximum wait in seconds. None wait forever.
+        Returns:
+            The first "DebuggerSnapshot" newer than "after_generation", None on timeout.
+        '''
+        return self.watch.wait_for_sample(after_generation, timeout)
+
+    def wait_for_scene_change(self, scene, timeout=None):
+        '''
+        Wait until the game leaves a scene.
+        Parameters:
+            scene (int): The GameDebugger.SceneID to leave.
+            timeout (float): Maximum wait in seconds. None wait forever.
+        Returns:
+            The first "DebuggerSnapshot" of another scene, None on timeout.
+        '''
+        return self.watch.wait_for(lambda snapshot: snapshot.scene is not None and snapshot.scene != scene, timeout)
 
     def validate_step(self):
-        self.watch._sync.set()
+        self.watch.resume()
 
     # def delete_breakpoint(self):
     #     gdb.execute("interrupt")
@@ -292,6 +611,8 @@ class MK8_Helper:
         self.debugger   = debugger
         self.monitor    = monitor
         self.controller = controller
+        # Values whose change shows that the game reacted to an input in the menus
+        self._reaction_addrs = [item.address for key, item in debugger.addr_dict.items() if key in ('scene_id', 'status') or (item.scenes is not None and item.rate == SampleRate.TICK)]
 
     def read_debugger_value(self, key):
         '''
@@ -306,7 +627,13 @@ class MK8_Helper:
             results = self.debugger.watch.get_results()
             if addr in results:
                 return results[addr]
-            time.sleep(0.1)
+            if self.debugger.wait_for_sample(results.generation, timeout=1.0) is None:
+                self.debugger.check_game()
+
+    def _wait_reaction(self, before, timeout=0.1):
+        # Wait for the game to react to the last input: the scene, the status or a menu value changed since the snapshot "before"
+        addrs = self._reaction_addrs
+        return self.debugger.wait_for(lambda snapshot: snapshot.generation > before.generation and any(snapshot.get(addr) != before.get(addr) for addr in addrs), timeout)
 
     def get_current_scene(self):
         '''
@@ -345,6 +672,8 @@ class MK8_Helper:
         '''
         state = "INIT"
         while True:
+            # Game state before the input of this iteration
+            before = self.debugger.watch.get_results()
             # if isinstance(state, int):
             #     print(hex(state))
             # else:
@@ -489,8 +818,9 @@ class MK8_Helper:
 
             elif state == GameDebugger.SceneID.PAUSE_MENU:
                 self.controller.instant_pad_down()
-                time.sleep(0.1)
+                self._wait_reaction(before)
                 self.controller.instant_b()
+                self.debugger.wait_for_scene_change(GameDebugger.SceneID.PAUSE_MENU, timeout=0.1)
                 state = GameDebugger.SceneID.QUIT_VALIDATION
                 # item_idx = self.read_debugger_value('pause_menu_idx')
                 # if item_idx != 1:
@@ -501,7 +831,7 @@ class MK8_Helper:
 
             elif state == GameDebugger.SceneID.QUIT_VALIDATION:
                 self.controller.instant_pad_right()
-                time.sleep(0.1)
+                self._wait_reaction(before)
                 self.controller.instant_b()
                 state = "INIT"
                 # item_idx = self.read_debugger_value('quit_menu_idx')
@@ -513,16 +843,20 @@ class MK8_Helper:
 
             elif state == GameDebugger.SceneID.RACE_RESULT:
                 self.controller.instant_b()
-                time.sleep(1.0)
+                self.debugger.wait_for_scene_change(GameDebugger.SceneID.RACE_RESULT, timeout=1.0)
                 state = self.get_current_scene()
             
             elif state == GameDebugger.SceneID.RACE_END_MENU:
-                time.sleep(1.0)
+                # Wait for the menu index sampled in this scene after the last input
+                addr = self.debugger.addr_dict['race_end_menu_idx'].address
+                self.debugger.wait_for(lambda snapshot: snapshot.generation > before.generation and snapshot.scene == GameDebugger.SceneID.RACE_END_MENU and addr in snapshot, timeout=1.0)
                 item_idx = self.read_debugger_value('race_end_menu_idx')
                 if item_idx == 2:
                     self.controller.instant_b()
+                    self.debugger.wait_for_scene_change(GameDebugger.SceneID.RACE_END_MENU, timeout=1.0)
                 else:
                     self.controller.instant_pad_down()
+                    self._wait_reaction(before)
                 state = self.get_current_scene()
                 # self.controller.instant_b()
                 # state = "INIT"
@@ -552,15 +886,21 @@ class MK8_Helper:
             else:
                 state = "INIT"
 
-            time.sleep(0.1)
+            # Next iteration as soon as the game reacted, at most 0.1s later (an input ignored by the game is sent again)
+            self._wait_reaction(before)
     
-    def is_race_finish(self):
+    def is_race_finish(self, results=None):
         '''
         Get the race status.
+        Parameters:
+            results (DebuggerSnapshot): Read the status in this snapshot. None wait for the status.
         Returns:
             True if the race is finished, False otherwise.
         '''
-        value = self.read_debugger_value('status')
+        if results is None:
+            value = self.read_debugger_value('status')
+        else:
+            value = results[self.debugger.addr_dict['status'].address]
         if (value == 16) or (value == 24):
             return False
         return True
@@ -615,49 +955,97 @@ class GameEmulator(threading.Thread):
             pass
 
 
+class YuzuBackend:
+    '''
+    The real game: Yuzu emulator, GDB debugger, screenshots of the emulator window and virtual controller.
+    A backend provides the elements aggregated by the "Manager" (see synthetic.py for the synthetic backend).
+    '''
+    def __init__(self, game_path="../../../game/Mario_Kart_8_Deluxe.xci"):
+        self.game_path = game_path
+
+    def make_game(self):
+        return GameEmulator(game_path=self.game_path)
+
+    def make_monitor(self):
+        from platform_specific import Monitor
+        return Monitor()
+
+    def make_controller(self):
+        from platform_specific import Controller
+        return Controller()
+
+    def make_debugger(self):
+        return GameDebugger()
+
+
 class Server(threading.Thread):
     '''
     The server is in charge of the MQTT IO.
     '''
-    def __init__(self, server_callback, instance_id=None, mqtt_host="127.0.0.1", mqtt_port=1883):
+    def __init__(self, server_callback, instance_id=None, mqtt_host="127.0.0.1", mqtt_port=1883, broker=None):
         super().__init__()
         #
         self.instance_id = instance_id
         if self.instance_id is None:
             self.instance_id = random.randint(0, (2**32)-1).to_bytes(4, 'big').hex().upper()
         #
-        self.mqtt = mqtt.Client()
+        # "broker" (loopback.LoopbackBroker) replaces MQTT by an in-memory broker shared with the clients of the same process
+        self.mqtt = mqtt.Client() if broker is None else broker.client()
         self.mqtt.on_connect = self._on_connect
         self.mqtt.on_message = self._on_message
-        self.mqtt.will_set("Mario_Kart_8/"+self.instance_id+"/status", payload=struct.pack('B', False), qos=1, retain=True)
+        self.mqtt.will_set("Mario_Kart_8/"+self.instance_id+"/status", payload=common.STATUS_SCHEMA.pack_field('status', False), qos=1, retain=True)
         self.mqtt.connect(mqtt_host, mqtt_port, 60)
         #
         self.server_callback = server_callback
+        self._handlers = self._build_handlers()
+
+    def _build_handlers(self):
+        # Topic -> decoder table compiled once from the protocol schemas (see common.py)
+        root        = "Mario_Kart_8/"+self.instance_id+"/order"
+        handlers    = {}
+        handlers[root+"/reset"]     = self._decode_reset
+        handlers[root+"/action"]    = self._decode_action
+        handlers[root+"/keyframe"]  = self._decode_keyframe
+        for name in common.SETUP_SCHEMA.names:
+            handlers[root+"/setup/"+name] = self._setup_decoder(name, common.SETUP_SCHEMA.scalars[name])
+        return handlers
+
+    def _setup_decoder(self, key, scalar):
+        def decode(client, payload):
+            order = (common.Server.Order.GAME_SETUP, (key, scalar.unpack(payload)[0]))
+            self.server_callback(client, order)
+        return decode
 
     def _on_connect(self, client, userdata, flags, rc):
         client.subscribe("Mario_Kart_8/"+self.instance_id+"/order/reset")
         client.subscribe("Mario_Kart_8/"+self.instance_id+"/order/setup/+")
         client.subscribe("Mario_Kart_8/"+self.instance_id+"/order/action")
-        client.publish("Mario_Kart_8/"+self.instance_id+"/status", payload=struct.pack('B', True), qos=1, retain=True)
+        client.subscribe("Mario_Kart_8/"+self.instance_id+"/order/keyframe")
+        client.publish("Mario_Kart_8/"+self.instance_id+"/status", payload=common.STATUS_SCHEMA.pack_field('status', True), qos=1, retain=True)
 
     def _on_message(self, client, userdata, msg):
-        if msg.topic == "Mario_Kart_8/"+self.instance_id+"/order/reset":
-            order = (common.Server.Order.RESET,)
-            self.server_callback(client, order)
-        elif msg.topic.startswith("Mario_Kart_8/"+self.instance_id+"/order/setup/"):
-            key   = msg.topic.split('/')[-1]
-            order = (common.Server.Order.GAME_SETUP, (key, struct.unpack('i', msg.payload)[0]))
-            self.server_callback(client, order)
-        elif msg.topic == "Mario_Kart_8/"+self.instance_id+"/order/action":
-            go_forward      = struct.unpack('b', msg.payload[0:1])[0]
-            go_backward     = struct.unpack('b', msg.payload[1:2])[0]
-            go_x_direction  = struct.unpack('f', msg.payload[2:6])[0]
-            set_y_direction = struct.unpack('f', msg.payload[6:10])[0]
-            look_backward   = struct.unpack('b', msg.payload[10:11])[0]
-            throw_horn      = struct.unpack('b', msg.payload[11:12])[0]
-            bump_drift      = struct.unpack('b', msg.payload[12:13])[0]
-            order = (common.Server.Order.ACTION, (go_forward, go_backward, go_x_direction, set_y_direction, look_backward, throw_horn, bump_drift))
-            self.server_callback(client, order)
+        handler = self._handlers.get(msg.topic)
+        if handler is not None:
+            handler(client, msg.payload)
+        else:
+            print("Unknow order topic '{}'".format(msg.topic))
+
+    def _decode_reset(self, client, payload):
+        order = (common.Server.Order.RESET,)
+        self.server_callback(client, order)
+
+    def _decode_keyframe(self, client, payload):
+        order = (common.Server.Order.KEYFRAME,)
+        self.server_callback(client, order)
+
+    def _decode_action(self, client, payload):
+        if len(payload) == common.ACTION_LEGACY_SCHEMA.size:
+            # Legacy client: no sequence id, 0 is the legacy protocol
+            values = common.ACTION_LEGACY_SCHEMA.unpack(payload) + (0,)
+        else:
+            values = common.ACTION_SCHEMA.unpack(payload)
+        order = (common.Server.Order.ACTION, values)
+        self.server_callback(client, order)
 
     def listen(self):
         self.mqtt.loop_forever()
@@ -674,12 +1062,13 @@ class Manager:
         TRAINING    = 0
         INFERENCE   = 1
 
-    def __init__(self, instance_id="00000000", mqtt_host="192.168.27.66", mqtt_port=1883):
-        self.server     = Server(server_callback=self._receive_order, instance_id=instance_id, mqtt_host=mqtt_host, mqtt_port=mqtt_port)
-        self.game       = GameEmulator(game_path="../../../game/Mario_Kart_8_Deluxe.xci")
+    def __init__(self, instance_id="00000000", mqtt_host="192.168.27.66", mqtt_port=1883, step_layout=common.Server.StepLayout.PACKED, backend=None, broker=None):
+        self.backend    = YuzuBackend() if backend is None else backend
+        self.server     = Server(server_callback=self._receive_order, instance_id=instance_id, mqtt_host=mqtt_host, mqtt_port=mqtt_port, broker=broker)
+        self.game       = self.backend.make_game()
         self.game.launch()
-        self.monitor    = Monitor()
-        self.controller = Controller()
+        self.monitor    = self.backend.make_monitor()
+        self.controller = self.backend.make_controller()
         self._init_debugger()
         #
         self.game_setup = {}
@@ -700,10 +1089,24 @@ class Manager:
         self.game_setup['COURSE_CUP']               = common.GameSetup.Course.Cup.SPECIAL
         self.game_setup['COURSE']                   = common.GameSetup.Course.Cup.Special.RAINBOW_ROAD
         self.game_setup['MAX_STEP']                 = 1600
+        self.game_setup['FRAME_CODEC']              = common.Server.FrameCodec.RAW
+        self.game_setup['FRAME_QUALITY']            = 90
+        self.game_setup['FRAME_KEYFRAME_INTERVAL']  = 30
+        self._frame_codec = None
+        #
+        # Sequenced step protocol: id of the last accepted action, and the messages of the step which replied to it
+        self.action_seq = 0
+        self._last_reply = (0, [])
         #
         self.action_received = threading.Event()
         #
         self.mode = Manager.Mode.TRAINING
+        # Seconds from the hold of the game at a step boundary to the publication of the step (TRAINING mode), last steps only
+        self.boundary_latencies = collections.deque(maxlen=4096)
+        self.step_layout = step_layout
+        self.frame_ring  = None
+        if self.step_layout == common.Server.StepLayout.SHARED_MEMORY:
+            self.frame_ring = frame_ring.FrameRing(instance_id, create=True)
         #
         self.reset = True
         self.server.start()
@@ -713,43 +1116,101 @@ class Manager:
         print("Waiting debugger... OK")
 
     def _init_debugger(self):
-        self.debugger = GameDebugger()
+        self.debugger = self.backend.make_debugger()
         self.mk8_helper = MK8_Helper(self.debugger, self.monitor, self.controller)
         self.debugger.start()
 
-    def _publish_step_results(self):
-        if self.mode == Manager.Mode.INFERENCE:
-            frame   = self.monitor.get_screen_shot()
-            results = self.debugger.watch.get_results()
-            root    = "Mario_Kart_8/"+self.server.instance_id+"/step"
-            self.server.mqtt.publish(root+"/frame"                  , payload=frame.tobytes()                                    , qos=1, retain=True)
-            self.server.mqtt.publish(root+"/terminal"               , payload=struct.pack('B', self.terminal)                    , qos=1, retain=True)
-            self.server.mqtt.publish(root+"/terminated_by_timeout"  , payload=struct.pack('B', self.terminated_by_timeout)       , qos=1, retain=True)
-            self.server.mqtt.publish(root+"/is_race_finish"         , payload=struct.pack('B', False)                            , qos=1, retain=True)
-            self.server.mqtt.publish(root, payload=struct.pack('I'  , self.step_no), qos=1, retain=True)
-        elif self.mode == Manager.Mode.TRAINING:
-            frame   = self.monitor.get_screen_shot()
+    def _collect_step_results(self):
+        values = {}
+        values['no']                    = self.step_no
+        values['seq']                   = self.action_seq
+        values['terminal']              = self.terminal
+        values['terminated_by_timeout'] = self.terminated_by_timeout
+        values['is_race_finish']        = False
+        values['frame_codec']           = self.game_setup['FRAME_CODEC']
+        if self.mode == Manager.Mode.TRAINING:
             results = self.debugger.watch.get_results()
-            root    = "Mario_Kart_8/"+self.server.instance_id+"/step"
-            self.server.mqtt.publish(root+"/frame"                  , payload=frame.tobytes()                                    , qos=1, retain=True)
-            self.server.mqtt.publish(root+"/terminal"               , payload=struct.pack('B', self.terminal)                    , qos=1, retain=True)
-            self.server.mqtt.publish(root+"/terminated_by_timeout"  , payload=struct.pack('B', self.terminated_by_timeout)       , qos=1, retain=True)
-            self.server.mqtt.publish(root+"/is_race_finish"         , payload=struct.pack('B', self.mk8_helper.is_race_finish()) , qos=1, retain=True)
-            for key in ('timer', 'speed', 'coins', 'status', 'rank', 'lap_continuous', 'lap_discrete', 'pos_x', 'pos_y', 'pos_z', 'towing', 'track'):
-                value = results[self.debugger.addr_dict[key].address]
-                self.server.mqtt.publish(root+"/"+key, payload=struct.pack(self.debugger.addr_dict[key].rep_fmt, value), qos=1, retain=True)
-            self.server.mqtt.publish(root, payload=struct.pack('I', self.step_no), qos=1, retain=True)
+            # All the values come from the same tick
+            values['is_race_finish'] = self.mk8_helper.is_race_finish(results)
+            for key in common.STEP_DEBUGGER_FIELDS:
+                # 0 for a value not sampled yet in the current scene (e.g. a step boundary outside the race)
+                values[key] = results.get(self.debugger.addr_dict[key].address, 0)
+        return values
+
+    def _encode_frame(self, frame):
+        # The codec is requested by the client through the game setup, it can change between two steps
+        key = (self.game_setup['FRAME_CODEC'], self.game_setup['FRAME_QUALITY'], self.game_setup['FRAME_KEYFRAME_INTERVAL'])
+        if self._frame_codec is None or self._frame_codec[0] != key:
+            self._frame_codec = (key, codec.get_codec(*key))
+        return self._frame_codec[1].encode(frame)
+
+    def _request_keyframe(self):
+        # The first frame of a game and the frame following a client request are sent without reference to the previous ones
+        if self._frame_codec is not None:
+            self._frame_codec[1].request_keyframe()
+
+    def _publish_step_results(self):
+        frame   = self.monitor.get_screen_shot()
+        values  = self._collect_step_results()
+        root    = "Mario_Kart_8/"+self.server.instance_id+"/step"
+        messages = []
+        if self.step_layout == common.Server.StepLayout.PACKED:
+            # Fields not sampled in the current mode (e.g. debugger values in INFERENCE) are sent as 0
+            header = common.STEP_SCHEMA.pack_dict(values)
+            messages.append((root+"/record", header+self._encode_frame(frame)))
+        elif self.step_layout == common.Server.StepLayout.SHARED_MEMORY:
+            # The frame must be in the ring before the record announce the step (never compressed)
+            values['frame_codec'] = common.Server.FrameCodec.RAW
+            self.frame_ring.write(values['no'], frame)
+            messages.append((root+"/record", common.STEP_SCHEMA.pack_dict(values)))
+        elif self.step_layout == common.Server.StepLayout.PER_TOPIC:
+            # "frame_codec" is published before the frame it describes
+            for key in common.STEP_SCHEMA.names[1:]:
+                if key in values:
+                    messages.append((root+"/"+key, common.STEP_SCHEMA.pack_field(key, values[key])))
+            messages.append((root+"/frame", self._encode_frame(frame)))
+            messages.append((root, common.STEP_SCHEMA.pack_field('no', values['no'])))
+        self._last_reply = (values['seq'], messages)
+        self._publish_reply(messages, values['seq'])
+
+    def _publish_reply(self, messages, seq):
+        # Replies to sequenced actions are sent with qos 0: the client sends the action again if the reply is lost
+        qos = 0 if seq != 0 else 1
+        for topic, payload in messages:
+            self.server.mqtt.publish(topic, payload=payload, qos=qos, retain=True)
+
+    def _is_duplicate_action(self, seq):
+        '''
+        Filter the actions sent again by a client in sequenced mode (see "client.ClientProtocol").
+        The step which replied to an action already handled is published again.
+        Returns:
+            True if the action must be ignored.
+        '''
+        if seq == 0 or seq > self.action_seq:
+            return False
+        reply_seq, messages = self._last_reply
+        if seq == reply_seq:
+            self._publish_reply(messages, seq)
+        return True
 
     def _receive_order(self, client, order):
         if order[0] == common.Server.Order.RESET:
             self.reset = True
+            self.action_seq = 0
+            self._request_keyframe()
             self.action_received.set()
+        elif order[0] == common.Server.Order.KEYFRAME:
+            self._request_keyframe()
         elif order[0] == common.Server.Order.GAME_SETUP:
             try:
                 self.game_setup[order[1][0]] = order[1][1]
             except KeyError:
                 print("Unknow gamesetup key '{}'".format(order[1]))
         elif order[0] == common.Server.Order.ACTION:
+            seq = order[1][7]
+            if self._is_duplicate_action(seq):
+                return
+            self.action_seq = seq
             if order[1][0] != 0:
                 self.controller.go_forward()
             if order[1][1] != 0:
@@ -769,10 +1230,10 @@ class Manager:
 
     def _wait_action(self):
         print("wait...")
-        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/waiting_for_action", payload=struct.pack('B', True), qos=1, retain=True)
+        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/waiting_for_action", payload=common.STATUS_SCHEMA.pack_field('waiting_for_action', True), qos=1, retain=True)
         self.action_received.wait()
         self.action_received.clear()
-        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/waiting_for_action", payload=struct.pack('B', False), qos=1, retain=True)
+        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/waiting_for_action", payload=common.STATUS_SCHEMA.pack_field('waiting_for_action', False), qos=1, retain=True)
         print("wait... OK")
 
     def _standarize_img(self, img):
@@ -817,11 +1278,11 @@ class Manager:
                 raise SanityCheckException("Current track does not match the choosen track.")
 
     def init_game(self):
-        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/initializing_game", payload=struct.pack('B', True), qos=1, retain=True)
+        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/initializing_game", payload=common.STATUS_SCHEMA.pack_field('initializing_game', True), qos=1, retain=True)
         self.debugger.set_mode(TimerWatchpoint.Mode.SAMPLER)
         self.mk8_helper.setup_race(self.game_setup)
         # self._sanity_check()
-        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/initializing_game", payload=struct.pack('B', False), qos=1, retain=True)
+        self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/initializing_game", payload=common.STATUS_SCHEMA.pack_field('initializing_game', False), qos=1, retain=True)
 
     def in_game(self):
         self.terminal = False
@@ -834,7 +1295,7 @@ class Manager:
             _last_time = 0
 
             self.debugger.set_mode(TimerWatchpoint.Mode.SAMPLER)
-            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=struct.pack('B', True), qos=1, retain=True)
+            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=common.STATUS_SCHEMA.pack_field('playing_game', True), qos=1, retain=True)
             while True:
                 self._publish_step_results()
                 self._wait_action()
@@ -851,33 +1312,63 @@ class Manager:
             self.terminal = True
             self._publish_step_results()
             self.debugger.set_mode(TimerWatchpoint.Mode.SAMPLER)
-            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=struct.pack('B', False), qos=1, retain=True)
+            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=common.STATUS_SCHEMA.pack_field('playing_game', False), qos=1, retain=True)
 
 
         elif self.mode == Manager.Mode.TRAINING:
-            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=struct.pack('B', True), qos=1, retain=True)
+            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=common.STATUS_SCHEMA.pack_field('playing_game', True), qos=1, retain=True)
             self.debugger.set_mode(TimerWatchpoint.Mode.STEPPER)
-            while not self.mk8_helper.is_race_finish():
-                if self.debugger.step_finished():
-                    self._publish_step_results()
-                    self._wait_action()
-                    self.debugger.validate_step()
-                    self.step_no += 1
-                    # Timeout
-                    if self.step_no >= self.game_setup['MAX_STEP']:
-                        self.terminated_by_timeout = True
-                        break
-                    if self.reset:
+            while True:
+                # The watchpoint wakes the manager as soon as it holds the game at a step boundary
+                results = self.debugger.wait_step(timeout=0.1)
+                if results is None:
+                    # No step boundary (e.g. loading): only follow the race status
+                    self.debugger.check_game()
+                    if self.mk8_helper.is_race_finish():
                         break
-                time.sleep(1/30)
+                    continue
+                if self.mk8_helper.is_race_finish(results):
+                    break
+                self._publish_step_results()
+                self.boundary_latencies.append(time.perf_counter() - self.debugger.watch.boundary_time)
+                self._wait_action()
+                self.debugger.validate_step()
+                self.step_no += 1
+                # Timeout
+                if self.step_no >= self.game_setup['MAX_STEP']:
+                    self.terminated_by_timeout = True
+                    break
+                if self.reset:
+                    break
             self.terminal = True
             self._publish_step_results()
             self.debugger.set_mode(TimerWatchpoint.Mode.SAMPLER)
-            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=struct.pack('B', False), qos=1, retain=True)
+            self.server.mqtt.publish("Mario_Kart_8/"+self.server.instance_id+"/status/playing_game", payload=common.STATUS_SCHEMA.pack_field('playing_game', False), qos=1, retain=True)
 
     def set_mode(self, mode):
         self.mode = mode
 
+    def get_boundary_latency(self):
+        '''
+        Returns:
+            An dict {'count', 'p50', 'p99', 'max'} of "boundary_latencies" in seconds, the statistics are None without step.
+        '''
+        latencies = np.array(self.boundary_latencies)
+        if len(latencies) == 0:
+            return {'count': 0, 'p50': None, 'p99': None, 'max': None}
+        return {'count': len(latencies), 'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)), 'max': float(np.max(latencies))}
+
+    def close(self):
+        '''
+        Stop the game and the debugger, disconnect from the broker and remove the shared memory frame ring.
+        '''
+        self.debugger.terminate = True
+        self.game.close()
+        self.server.mqtt.disconnect()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+            self.frame_ring = None
+
     def loop(self):
         while True:
             print("Waiting reset order...")
@@ -900,7 +1391,26 @@ class Manager:
             print("Playing... OK")
 
 
+def make_backend(backend_id):
+    '''
+    Parameters:
+        backend_id (common.Server.Backend): The game backend.
+    Returns:
+        The backend given to the "Manager".
+    '''
+    if backend_id == common.Server.Backend.SYNTHETIC:
+        import synthetic
+        return synthetic.SyntheticBackend(tick_rate=float(os.environ.get('SYNTHETIC_TICK_RATE', 60.0)))
+    return YuzuBackend()
+
+
 if __name__ == "__main__":
-    manager = Manager(instance_id=os.environ['INSTANCE_ID'], mqtt_host=os.environ['MQTT_HOST'], mqtt_port=int(os.environ['MQTT_PORT']))
+    backend = make_backend(int(os.environ.get('GAME_BACKEND', common.Server.Backend.YUZU)))
+    manager = Manager(instance_id=os.environ['INSTANCE_ID'], mqtt_host=os.environ['MQTT_HOST'], mqtt_port=int(os.environ['MQTT_PORT']), step_layout=int(os.environ.get('STEP_LAYOUT', common.Server.StepLayout.PACKED)), backend=backend)
     manager.set_mode(int(os.environ['SERVER_MODE']))
-    manager.loop()
+    # A terminated server releases its resources (the shared memory ring outlives the process otherwise)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        manager.loop()
+    finally:
+        manager.close()
@@ -1,9 +1,11 @@
 import paho.mqtt.client as mqtt
 import subprocess
 import threading
+import common
 import psutil
 import signal
 import time
+import sys
 import os
 
 
@@ -16,7 +18,7 @@ class ServerInstance:
     The instance should be run with "launch()" (which is blocking until the end of the instance).
     '''
 
-    def __init__(self, instance_id="00000000", mqtt_host="192.168.27.66", mqtt_port=1883, training=True, watchdog_timeout=120):
+    def __init__(self, instance_id="00000000", mqtt_host="192.168.27.66", mqtt_port=1883, training=True, watchdog_timeout=120, step_layout=common.Server.StepLayout.PACKED, backend=common.Server.Backend.YUZU):
         '''
         Instanciate one server instance.
         Parameters:
@@ -25,6 +27,11 @@ class ServerInstance:
             mqtt_port (int): TCP/IP Port of the MQTT server.
             training (bool): Indicate if the server should be run in training mode or not.
             watchdog_timeout (float): The watchdog will trigger if no activity was observed on the MQTT after the watchdog_timeout in seconds.
+            step_layout (common.Server.StepLayout): How the step results are published. PACKED (default) send one record per step,
+                PER_TOPIC keep the legacy one-topic-per-field layout for older clients,
+                SHARED_MEMORY send the frames through shared memory (client and server on the same host).
+            backend (common.Server.Backend): The game run by the server. YUZU (default) runs the emulator under GDB,
+                SYNTHETIC runs the simulated game of synthetic.py (no emulator, GDB nor display, e.g. for CI and load tests).
         Returns:
             An "ServerInstance" in waiting state.
         '''
@@ -33,6 +40,8 @@ class ServerInstance:
         self.mqtt_port          = mqtt_port
         self.training           = training
         self.watchdog_timeout   = watchdog_timeout
+        self.step_layout        = step_layout
+        self.backend            = backend
 
         # Setup an MQTT client and setup callback
         self.mqtt_client = mqtt.Client()
@@ -95,13 +104,18 @@ class ServerInstance:
         env['MQTT_HOST']    = self.mqtt_host
         env['MQTT_PORT']    = str(self.mqtt_port)
         env['SERVER_MODE']  = '0' if self.training else '1'
+        env['STEP_LAYOUT']  = str(int(self.step_layout))
+        env['GAME_BACKEND'] = str(int(self.backend))
         env['ENV_PATH']     = env['PWD']
-        cmd = [
-            "../rsrc/aarch64-zephyr-elf/bin/aarch64-zephyr-elf-gdb-py",
-            "--batch",
-            "-x",
-            "server.py"
-            ]
+        if self.backend == common.Server.Backend.SYNTHETIC:
+            cmd = [sys.executable, "server.py"]
+        else:
+            cmd = [
+                "../rsrc/aarch64-zephyr-elf/bin/aarch64-zephyr-elf-gdb-py",
+                "--batch",
+                "-x",
+                "server.py"
+                ]
         self.last_activity = time.time()
         self._proc_server = subprocess.Popen(cmd, env=env)
         self._proc_server.wait()
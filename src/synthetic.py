@@ -0,0 +1,549 @@
+import numpy as np
+import traceback
+import threading
+import common
+import server
+import struct
+import bisect
+import queue
+import time
+
+
+SceneID = server.GameDebugger.SceneID
+
+# Number of players of the player menu: "common.GameSetup.Player" is a plain class of int constants, not an enum
+PLAYERS = max(value for value in vars(common.GameSetup.Player).values() if isinstance(value, int)) + 1
+
+# Number of variants of the players that open the variant menu (see common.GameSetup.Player)
+PLAYER_VARIANTS = {
+    common.GameSetup.Player.YOSHI           : len(common.GameSetup.Player.YoshiVariant),
+    common.GameSetup.Player.MASKASS         : len(common.GameSetup.Player.MaskassVariant),
+    common.GameSetup.Player.INKLING_GIRL    : len(common.GameSetup.Player.InklingGirlVariant),
+    common.GameSetup.Player.INKLING_BOY     : len(common.GameSetup.Player.InklingBoyVariant),
+    common.GameSetup.Player.LINK            : len(common.GameSetup.Player.LinkVariant),
+}
+
+# (memory key, first value, number of values) of each line of the race rule menu
+RACE_RULES = (
+    ('race_rule_cc'     , 0, len(common.GameSetup.RaceRule.Mode)),
+    ('race_rule_team'   , 1, len(common.GameSetup.RaceRule.Teams)),
+    ('race_rule_item'   , 1, len(common.GameSetup.RaceRule.Items)),
+    ('race_rule_ai'     , 1, len(common.GameSetup.RaceRule.COM)),
+    ('race_rule_car_ai' , 1, len(common.GameSetup.RaceRule.COMVehicles)),
+    ('race_rule_track'  , 0, len(common.GameSetup.RaceRule.Courses)),
+    ('race_rule_num'    , 0, len(common.GameSetup.RaceRule.RaceCount)),
+)
+
+# (memory key, number of parts) of each line of the car menu
+CAR_PARTS = (
+    ('car_body_idx' , len(common.GameSetup.Car.Body)),
+    ('car_wheel_idx', len(common.GameSetup.Car.Wheel)),
+    ('car_wing_idx' , len(common.GameSetup.Car.Wing)),
+)
+
+# Internal track code (common.INTERNAL_TRACK_TO_ENUM) of each (cup, track) of the track menu
+TRACK_CODES = {(common.INTERNAL_TRACK_TO_CUP[track], common.INTERNAL_TRACK_TO_TRACK[track]): code for code, track in common.INTERNAL_TRACK_TO_ENUM.items() if track in common.INTERNAL_TRACK_TO_CUP and track in common.INTERNAL_TRACK_TO_TRACK}
+
+
+def _grid_move(idx, count, columns, direction):
+    # Cursor of a menu laid out as rows of "columns" items ("count" items in total): "down" change the row, "right" the column
+    row, col = divmod(idx, columns)
+    if direction == 'down':
+        idx = idx + columns
+        return idx if idx < count else col
+    idx = row * columns + (col + 1) % columns
+    return idx if idx < count else row * columns
+
+
+class SyntheticGame:
+    '''
+    Simulated Mario Kart 8: a state machine of the menus used by "server.MK8_Helper.setup_race" and a simple race model.
+    The game state lives in a fake memory read at the addresses of "server.GameDebugger.ADDRESSES",
+    so the "Manager", the "MK8_Helper" and the "TimerSampler" run unchanged without Yuzu, GDB nor display.
+    Only the VS race flow is simulated (the other main / solo modes lead to the same menus).
+    The game ticks at "tick_rate" and calls the attached "watch" after each tick, like the GDB watchpoint on the game timer:
+    in STEPPER mode the tick thread is held by the watch as the emulated game would be.
+    '''
+
+    MAX_SPEED       = 80.0  # Speed reached when going forward without steering
+    LAP_TICKS       = 1800  # Ticks to run one lap at full speed (30s)
+    LAPS            = 3
+    COUNTDOWN_TICKS = 180
+    LOADING_TICKS   = 60
+    FINISH_TICKS    = 120
+    OPPONENTS       = 11
+    TOWING          = 154
+
+    def __init__(self, tick_rate=60.0, seed=None):
+        '''
+        Parameters:
+            tick_rate (float): Game ticks per second. 0 run the game as fast as possible.
+            seed (int): Seed of the random generator (opponents, coins, track textures).
+        Returns:
+            An "SyntheticGame" on the title screen, started by "launch()".
+        '''
+        self.tick_rate  = tick_rate
+        self.seed       = seed
+        self.watch      = None
+        self._items     = server.GameDebugger.make_addr_dict()
+        # The memory is made of the regions around the items, large enough to hold any span read by the sampler
+        self._regions   = server.compile_spans(self._items.values(), max_gap=1 << 16)
+        self._starts    = [region.start for region in self._regions]
+        self._lock      = threading.Lock()
+        self._presses   = queue.Queue()
+        self._thread    = None
+        self._running   = False
+        self.error      = None # Exception that stopped the tick thread
+        self._textures  = {}
+        self._boot()
+
+    def _boot(self):
+        self._rng       = np.random.default_rng(self.seed)
+        self._memory    = [bytearray(region.size) for region in self._regions]
+        self._values    = {}
+        self.inputs     = {}
+        self._next      = None  # Scene reached at the end of a loading
+        self._cup       = 0
+        self._countdown = 0
+        self._opponents = np.zeros(SyntheticGame.OPPONENTS)
+        for key in self._items:
+            self._write(key, 0)
+        self._write('towing', SyntheticGame.TOWING)
+        self._set_scene(SceneID.TITLE_SCREEN)
+
+    def _write(self, key, value):
+        item = self._items[key]
+        self._values[key] = value
+        idx = bisect.bisect_right(self._starts, item.address) - 1
+        struct.pack_into('<'+item.rep_fmt, self._memory[idx], item.address - self._starts[idx], value)
+
+    def _set_scene(self, scene):
+        # The scene is read by the debugger as a signed 32 bits value (see "MK8_Helper.get_current_scene")
+        self.scene = scene
+        self._write('scene_id', int.from_bytes(int(scene).to_bytes(4, 'big'), 'big', signed=True))
+
+    def read_memory(self, address, size):
+        '''
+        Same interface as the GDB inferior used by "server.TimerSampler".
+        '''
+        idx = bisect.bisect_right(self._starts, address) - 1
+        offset = address - self._starts[idx]
+        with self._lock:
+            return bytes(self._memory[idx][offset:offset+size])
+
+    def press(self, button):
+        '''
+        Queue a button press, handled at the next tick.
+        Parameters:
+            button (str): One of 'up', 'down', 'left', 'right', 'a', 'b', 'start'.
+        '''
+        self._presses.put(button)
+
+    def launch(self):
+        if self._running:
+            return
+        self._boot()
+        self.error = None
+        self._running = True
+        self._thread = threading.Thread(target=self._task_tick, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        watch, self.watch = self.watch, None
+        if watch is not None:
+            # Release the tick thread held in STEPPER mode
+            watch.resume()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _task_tick(self):
+        period = 1.0 / self.tick_rate if self.tick_rate > 0 else 0.0
+        deadline = time.monotonic()
+        while self._running:
+            try:
+                with self._lock:
+                    self._tick()
+                watch = self.watch
+                if watch is not None:
+                    watch.sample()
+            except Exception as e:
+                # The game is stopped: the debugger reports the error (see "SyntheticDebugger.check_game") instead of waiting forever
+                traceback.print_exc()
+                self.error = e
+                self._running = False
+                break
+            if period > 0:
+                deadline += period
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Late (e.g. held by the watch): do not try to catch up
+                    deadline = time.monotonic()
+
+    def _tick(self):
+        self._write('timer', self._values['timer'] + 1)
+        try:
+            button = self._presses.get_nowait()
+        except queue.Empty:
+            button = None
+        if self.scene == SceneID.LOADING:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                self._enter(self._next)
+        elif self.scene == SceneID.RACE:
+            self._tick_race(button)
+        elif button is not None:
+            self._tick_menu(button)
+
+    def _load(self, scene):
+        self._next = scene
+        self._countdown = SyntheticGame.LOADING_TICKS
+        self._set_scene(SceneID.LOADING)
+
+    def _enter(self, scene):
+        if scene == SceneID.RACE:
+            self._start_race()
+        self._set_scene(scene)
+
+    def _cycle(self, key, count, first=0):
+        self._write(key, first + (self._values[key] - first + 1) % count)
+
+    def _tick_menu(self, button):
+        v = self._values
+        scene = self.scene
+        if scene == SceneID.TITLE_SCREEN:
+            if button in ('a', 'b'):
+                self._set_scene(SceneID.MAIN_MENU)
+        elif scene == SceneID.MAIN_MENU:
+            if button == 'down':
+                self._cycle('main_menu_idx', len(common.GameSetup.MainMenu))
+            elif button == 'b':
+                self._set_scene(SceneID.SOLO_MENU)
+        elif scene == SceneID.SOLO_MENU:
+            if button == 'down':
+                self._cycle('solo_menu_idx', len(common.GameSetup.GameMode))
+            elif button == 'b':
+                self._set_scene(SceneID.PLAYER_SELECTION)
+        elif scene == SceneID.PLAYER_SELECTION:
+            if button in ('down', 'right'):
+                self._write('player_menu_idx', _grid_move(v['player_menu_idx'], PLAYERS, 7, button))
+            elif button == 'b':
+                if v['player_menu_idx'] in PLAYER_VARIANTS:
+                    self._write('player_alt_menu_idx', 0)
+                    self._set_scene(SceneID.PLAYER_ALT_SELECTION)
+                else:
+                    self._write('car_menu_idx', 0)
+                    self._set_scene(SceneID.CAR_SELECTION)
+        elif scene == SceneID.PLAYER_ALT_SELECTION:
+            if button in ('down', 'right'):
+                self._write('player_alt_menu_idx', _grid_move(v['player_alt_menu_idx'], PLAYER_VARIANTS[v['player_menu_idx']], 3, button))
+            elif button == 'b':
+                self._write('car_menu_idx', 0)
+                self._set_scene(SceneID.CAR_SELECTION)
+        elif scene == SceneID.CAR_SELECTION:
+            key, count = CAR_PARTS[v['car_menu_idx']]
+            if button == 'down':
+                self._cycle(key, count)
+            elif button == 'b':
+                if v['car_menu_idx'] + 1 < len(CAR_PARTS):
+                    self._write('car_menu_idx', v['car_menu_idx'] + 1)
+                else:
+                    self._write('rule_menu_idx', 0)
+                    self._set_scene(SceneID.RACE_RULE_SELECTION)
+        elif scene == SceneID.RACE_RULE_SELECTION:
+            key, first, count = RACE_RULES[v['rule_menu_idx']]
+            if button == 'right':
+                self._cycle(key, count, first)
+            elif button == 'down':
+                self._cycle('rule_menu_idx', len(RACE_RULES))
+            elif button == 'b':
+                if v['race_rule_track'] == common.GameSetup.RaceRule.Courses.CHOOSE:
+                    self._write('track_cup_sel_idx', 0)
+                    self._set_scene(SceneID.RACE_TRACK_SELECTION)
+                else:
+                    self._write('track', int(self._rng.choice(list(common.INTERNAL_TRACK_TO_ENUM))))
+                    self._set_scene(SceneID.GO_VALIDATION)
+        elif scene == SceneID.RACE_TRACK_SELECTION:
+            idx = v['track_cup_sel_idx']
+            if idx < 12:
+                if button in ('down', 'right'):
+                    self._write('track_cup_sel_idx', _grid_move(idx, 12, 6, button))
+                elif button == 'b':
+                    self._cup = idx
+                    self._write('track_cup_sel_idx', 12)
+            else:
+                if button == 'right':
+                    self._write('track_cup_sel_idx', 12 + (idx - 12 + 1) % 4)
+                elif button == 'b':
+                    code = TRACK_CODES.get((self._cup, idx))
+                    self._write('track', int(self._rng.choice(list(common.INTERNAL_TRACK_TO_ENUM))) if code is None else code)
+                    self._set_scene(SceneID.GO_VALIDATION)
+        elif scene == SceneID.GO_VALIDATION:
+            if button == 'b':
+                self._load(SceneID.CINEMATIC_INTRO_RACE)
+        elif scene == SceneID.CINEMATIC_INTRO_RACE:
+            if button in ('a', 'b'):
+                self._enter(SceneID.RACE)
+        elif scene == SceneID.PAUSE_MENU:
+            if button == 'down':
+                self._cycle('pause_menu_idx', 2)
+            elif button == 'b':
+                self._write('quit_menu_idx', 0)
+                self._set_scene(SceneID.QUIT_VALIDATION if v['pause_menu_idx'] == 1 else SceneID.RACE)
+            elif button == 'start':
+                self._set_scene(SceneID.RACE)
+        elif scene == SceneID.QUIT_VALIDATION:
+            if button == 'right':
+                self._cycle('quit_menu_idx', 2)
+            elif button == 'b':
+                if v['quit_menu_idx'] == 1:
+                    self._load(SceneID.MAIN_MENU)
+                else:
+                    self._set_scene(SceneID.PAUSE_MENU)
+        elif scene == SceneID.RACE_RESULT:
+            if button in ('a', 'b'):
+                self._write('race_end_menu_idx', 0)
+                self._set_scene(SceneID.RACE_END_MENU)
+        elif scene == SceneID.RACE_END_MENU:
+            if button == 'down':
+                self._cycle('race_end_menu_idx', 3)
+            elif button == 'b':
+                self._load(SceneID.MAIN_MENU)
+
+    def _start_race(self):
+        self.inputs = {}
+        self._countdown = SyntheticGame.COUNTDOWN_TICKS
+        self._opponents = self._rng.uniform(-0.02, 0.0, size=SyntheticGame.OPPONENTS)
+        self._opponent_speeds = self._rng.normal(0.9, 0.05, size=SyntheticGame.OPPONENTS) / SyntheticGame.LAP_TICKS
+        for key, value in (('status', 0), ('speed', 0.0), ('coins', 0), ('lap_continuous', 0.0), ('lap_discrete', 1), ('rank', SyntheticGame.OPPONENTS)):
+            self._write(key, value)
+        self._update_position(0.0)
+
+    def _tick_race(self, button):
+        v = self._values
+        if button == 'start' and v['status'] == 16:
+            self._write('pause_menu_idx', 0)
+            self._set_scene(SceneID.PAUSE_MENU)
+            return
+        if v['status'] == 0:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                self._write('status', 16)
+            return
+        if v['status'] == 64:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                self._set_scene(SceneID.RACE_RESULT)
+            return
+        # Race model: the throttle accelerates toward MAX_SPEED, steering costs speed and moves along the track
+        inputs      = self.inputs
+        throttle    = float(inputs.get('forward', 0)) - float(inputs.get('backward', 0))
+        steer       = min(abs(float(inputs.get('x', 0.0))), 1.0)
+        target      = throttle * SyntheticGame.MAX_SPEED * (1.0 - 0.3 * steer)
+        speed       = v['speed'] + 0.05 * (target - v['speed'])
+        lap         = v['lap_continuous'] + speed / (SyntheticGame.MAX_SPEED * SyntheticGame.LAP_TICKS)
+        self._opponents += self._opponent_speeds * self._rng.uniform(0.5, 1.5, size=SyntheticGame.OPPONENTS)
+        if speed > 1.0 and v['coins'] < 10 and self._rng.random() < 0.002:
+            self._write('coins', v['coins'] + 1)
+        self._write('speed', speed)
+        self._write('lap_continuous', lap)
+        self._write('lap_discrete', int(min(max(lap, 0.0), SyntheticGame.LAPS - 1)) + 1)
+        self._write('rank', int(np.count_nonzero(self._opponents > lap)))
+        self._update_position(lap)
+        if lap >= SyntheticGame.LAPS:
+            self._write('status', 64)
+            self._countdown = SyntheticGame.FINISH_TICKS
+
+    def _update_position(self, lap):
+        # The track is a circle of one lap
+        angle = 2.0 * np.pi * (lap % 1.0)
+        self._write('pos_x', 1000.0 * float(np.cos(angle)))
+        self._write('pos_y', 0.0)
+        self._write('pos_z', 1000.0 * float(np.sin(angle)))
+
+    def _texture(self, track):
+        # Periodic texture of a track, stacked twice so any window of one frame is a slice of it
+        if track not in self._textures:
+            rng = np.random.default_rng(track)
+            tile = rng.integers(0, 256, size=(64, 16, 3), dtype=np.uint8).repeat(8, axis=0).repeat(8, axis=1)
+            self._textures[track] = np.concatenate([tile, tile])
+        return self._textures[track]
+
+    def render(self):
+        '''
+        Returns:
+            A procedural RGB frame (common.STEP_FRAME_SHAPE, uint8): the track texture scrolled by the race progress, or a menu with its cursor.
+        '''
+        height, width, _ = common.STEP_FRAME_SHAPE
+        with self._lock:
+            scene   = self.scene
+            values  = dict(self._values)
+        if scene in (SceneID.RACE, SceneID.RACE_AFTER_PAUSE, SceneID.PAUSE_MENU):
+            texture = self._texture(values['track'])
+            offset  = int((values['lap_continuous'] % 1.0) * (len(texture) // 2))
+            frame   = texture[offset:offset+height, :width].copy()
+            if scene == SceneID.PAUSE_MENU:
+                frame //= 2
+            return frame
+        frame = np.empty(common.STEP_FRAME_SHAPE, dtype=np.uint8)
+        frame[:] = np.frombuffer(int(scene).to_bytes(4, 'big')[1:], dtype=np.uint8)
+        # One bar per menu item: the cursor is the row of the first menu index of the scene that is not 0
+        cursor = next((values[key] for key in self._items if key.endswith('_idx') and values[key] != 0), 0)
+        row = (cursor * 8) % height
+        frame[row:row+8] = 255
+        return frame
+
+
+class SyntheticController:
+    '''
+    Controller of the "SyntheticGame", with the interface of "platform_specific.Controller".
+    The instant actions are pressed for one tick, the race inputs are held from one "apply()" to the next.
+    '''
+
+    def __init__(self, game, instant_duration=0.05):
+        self.game               = game
+        self.instant_duration   = instant_duration
+        self._inputs            = {}
+
+    def _instant(self, button):
+        self.game.press(button)
+        time.sleep(self.instant_duration)
+
+    def apply(self):
+        self.game.inputs = self._inputs
+        self._inputs = {}
+
+    def instant_pad_up(self):
+        self._instant('up')
+
+    def instant_pad_down(self):
+        self._instant('down')
+
+    def instant_pad_left(self):
+        self._instant('left')
+
+    def instant_pad_right(self):
+        self._instant('right')
+
+    def instant_a(self):
+        self._instant('a')
+
+    def instant_b(self):
+        self._instant('b')
+
+    def instant_start(self):
+        self._instant('start')
+
+    def go_forward(self):
+        self._inputs['forward'] = 1
+
+    def go_backward(self):
+        self._inputs['backward'] = 1
+
+    def go_x_direction(self, strengh):
+        self._inputs['x'] = strengh
+
+    def set_y_direction(self, strengh):
+        self._inputs['y'] = strengh
+
+    def look_backward(self):
+        self._inputs['look_backward'] = 1
+
+    def throw_horn(self):
+        self._inputs['horn'] = 1
+
+    def bump_drift(self):
+        self._inputs['drift'] = 1
+
+
+class SyntheticMonitor:
+    '''
+    Monitor of the "SyntheticGame", with the interface of "platform_specific.Monitor".
+    '''
+
+    def __init__(self, game):
+        self.game = game
+
+    def get_screen_shot(self):
+        '''
+        Returns:
+            The RGB screenshot in the shape [128, 128, 3]
+        '''
+        return self.game.render()
+
+
+class SyntheticWatchpoint(server.TimerSampler):
+    '''
+    Timer sampler called by the "SyntheticGame" after each tick. The speed address is fixed, no search is needed.
+    '''
+
+    def speed_init_done(self):
+        return True
+
+    def get_speed_results(self):
+        return server.GameDebugger.ADDRESSES['speed']
+
+
+class SyntheticDebugger(server.GameDebugger):
+    '''
+    "GameDebugger" of the "SyntheticGame": the watch is attached to the game instead of a GDB watchpoint.
+    '''
+
+    def __init__(self, game):
+        threading.Thread.__init__(self, daemon=True)
+        self.game       = game
+        self.addr_dict  = server.GameDebugger.make_addr_dict()
+        self.watch      = None
+        self.terminate  = False
+
+    def run(self):
+        watch = SyntheticWatchpoint(self.game, self.addr_dict['timer'].address, list(self.addr_dict.values()), self.addr_dict['scene_id'].address)
+        self.game.watch = watch
+        self.watch = watch
+
+    def init_race(self):
+        pass
+
+    def check_game(self):
+        if self.game.error is not None:
+            raise RuntimeError("The synthetic game stopped on an error.") from self.game.error
+        if not self.game._running:
+            raise RuntimeError("The synthetic game is not running.")
+
+
+class SyntheticBackend:
+    '''
+    Backend of the "server.Manager" running the "SyntheticGame": no emulator, GDB, display nor controller device.
+    Usage:
+        manager = server.Manager(instance_id="00000000", mqtt_host="127.0.0.1", backend=SyntheticBackend(tick_rate=0))
+    '''
+
+    def __init__(self, tick_rate=60.0, seed=None, instant_duration=0.05):
+        '''
+        Parameters:
+            tick_rate (float): Game ticks per second. 0 run the game as fast as possible.
+            seed (int): Seed of the game random generator.
+            instant_duration (float): Time in seconds the instant actions of the controller wait for the game.
+        Returns:
+            An "SyntheticBackend".
+        '''
+        self.tick_rate          = tick_rate
+        self.seed               = seed
+        self.instant_duration   = instant_duration
+        self.game               = None
+
+    def make_game(self):
+        self.game = SyntheticGame(tick_rate=self.tick_rate, seed=self.seed)
+        return self.game
+
+    def make_monitor(self):
+        return SyntheticMonitor(self.game)
+
+    def make_controller(self):
+        return SyntheticController(self.game, instant_duration=self.instant_duration)
+
+    def make_debugger(self):
+        return SyntheticDebugger(self.game)